@@ -3,23 +3,41 @@
 Main chat API module
 """
 
-import json
+import argparse
+import asyncio
+import hashlib
 import os
+import re
 import signal
 import traceback
+import uuid
 
 import tornado.escape
 import tornado.gen
 import tornado.httpserver
 import tornado.ioloop
 import tornado.locks
+import tornado.log
+import tornado.process
 import tornado.web
+import tornado.websocket
 from jsonschema.exceptions import ValidationError
 
-from db import DB, DatabaseError
-from logging_utils import get_logger, init_logging
+from content_encoding import CompressedContentEncoding
+from db import DatabaseError, DBType, open_database
+from logging_utils import REQUEST_ID, get_logger, init_logging, stop_logging
+from messages import MessagesBatchAPI
 from messages import MessagesNewAPI
+from messages import MessagesSubscribeAPI
 from messages import MessagesUpdatesAPI
+from messages import message_response
+import metrics
+from notifier import MessageNotifier
+from request_profiling import PROFILE_NAME, RequestProfiler
+from schemas import validate
+import serialization
+from streaming import is_streamed, iter_json_chunks
+from utils import CryptoExecutor
 from users import UsersAPI
 from chats import ChatsAPI, ChatsUserAPI
 from contacts import ContactsAPI
@@ -28,18 +46,38 @@ LOGGER = get_logger(__name__)
 SERVER_VERSION = os.getenv('VERSION', 'unknown')
 PUBLIC_API_PORT = 8888
 DATABASE_LOCATION = os.getenv('DATABASE_LOCATION', '/tmp/cryptochat_db.json')
+MESSAGE_POLL_TIMEOUT = float(os.getenv('MESSAGE_POLL_TIMEOUT', '30'))
+MAX_POLL_WAITERS = int(os.getenv('MAX_POLL_WAITERS', '10000'))
+WEBSOCKET_SEND_QUEUE = int(os.getenv('WEBSOCKET_SEND_QUEUE', '100'))
+WORKERS = int(os.getenv('WORKERS', '1'))
 _SHUTDOWN_TIMEOUT = 3
+# seconds between runs of the message retention and the database compaction
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', '60'))
+# milliseconds between checks for changes made by other workers
+_REFRESH_INTERVAL = 50
+# request IDs accepted from the X-Request-Id header of the clients
+_REQUEST_ID = re.compile(r'[\w.:-]{1,64}')
 
 
 class BaseHandler(tornado.web.RequestHandler):
     """Base handler setting CORS headers."""
 
     messages_new_api = None
+    messages_batch_api = None
     messages_updates_api = None
     users_api = None
     chats_api = None
     chats_user_api = None
     contacts_new_api = None
+    cryptochat_db = None
+    profiler = None
+    request_id = None
+    # set by prepare, which is skipped for the requests rejected before, e.g. with 405
+    in_flight = False
+    # tables the GET responses are read from, their versions make up the ETag
+    versioned_types = ()
+    # the request bodies hold message signatures, see serialization.loads
+    signed_input = False
 
     def data_received(self, chunk):
         pass
@@ -47,6 +85,21 @@ class BaseHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "Content-Type")
+        if self.request_id is None:
+            request_id = self.request.headers.get('X-Request-Id', '')
+            self.request_id = request_id if _REQUEST_ID.fullmatch(request_id) \
+                else uuid.uuid4().hex
+        self.set_header('X-Request-Id', self.request_id)
+
+    def prepare(self):
+        # the handler runs in its own task, the ID is added to the records it logs
+        REQUEST_ID.set(self.request_id)
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        self.in_flight = True
+
+    def on_finish(self):
+        if self.in_flight:
+            metrics.REQUESTS_IN_FLIGHT.dec()
 
     def options(self):
         """Answer OPTIONS request."""
@@ -64,16 +117,26 @@ class BaseHandler(tornado.web.RequestHandler):
             json_data = self.request.body
 
         try:
-            data = json.loads(json_data)
+            data = serialization.loads(json_data, big_integers=self.signed_input)
         except ValueError:
             data = None
         return data
 
     async def handle_request(self, api_endpoint, api_version):
         """Takes care of validation of input and execution of POST and GET methods."""
+        if self.profiler is not None and self.profiler.sample():
+            with self.profiler.profile(type(self).__name__, self.request.method):
+                await self._handle_request(api_endpoint, api_version)
+        else:
+            await self._handle_request(api_endpoint, api_version)
+
+    async def _handle_request(self, api_endpoint, api_version):
         code = 400
         data = self.get_post_data()
         request_method = self.request.method.lower()
+        if data and request_method == 'get' and self.versioned_types and \
+                await self.check_version():
+            return
         if data:
             try:
                 # will call process_get or process_post methods for the given API
@@ -95,15 +158,18 @@ class BaseHandler(tornado.web.RequestHandler):
                 err_id = dberr.__hash__()
                 res = str(dberr.reason)
                 LOGGER.error(res)
-                LOGGER.info("Input data for <%s>: %s", err_id, data)
+                LOGGER.debug("Input data for <%s>: %s", err_id, data)
                 raise dberr
+            except tornado.web.HTTPError as httperr:
+                LOGGER.warning(httperr.reason)
+                raise httperr
             except Exception as err:  # pylint: disable=broad-except
                 err_id = err.__hash__()
                 res = 'Internal server error <%s>:' \
                       'please include this error id in bug report.' % err_id
                 code = 500
                 LOGGER.exception(res)
-                LOGGER.info("Input data for <%s>: %s", err_id, data)
+                LOGGER.debug("Input data for <%s>: %s", err_id, data)
                 raise tornado.web.HTTPError(reason=res)
         else:
             res = 'Error: malformed input JSON.'
@@ -112,7 +178,38 @@ class BaseHandler(tornado.web.RequestHandler):
 
         # raise tornado.web.HTTPError(status_code=444, reason='error happened')
         self.set_status(code)
-        self.write(res)
+        if is_streamed(res):
+            await self.write_stream(res)
+        else:
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.write(serialization.dumpb(res, html_safe=True))
+
+    async def check_version(self):
+        """
+        Set the ETag of the response from the versions of the tables and the request body.
+        :return: True if the client has the response already, it gets 304 Not Modified
+        """
+        # read before the response, a change in between only makes the next request miss
+        version = await self.cryptochat_db.data_version(*self.versioned_types)
+        digest = hashlib.sha1(version.encode('utf8'))
+        digest.update(self.request.body)
+        self.set_header('Etag', '"{}"'.format(digest.hexdigest()))
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    async def write_stream(self, response):
+        """Send the response holding JSONArrayStream values in chunks as it is encoded."""
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        written = False
+        async for chunk in iter_json_chunks(response):
+            if written:
+                await self.flush()
+            self.write(chunk)
+            written = True
+        # the last chunk is sent by finish, a short response goes out whole with
+        # its Content-Length and is compressed only when it is long enough
 
     def write_error(self, status_code, **kwargs):
 
@@ -122,7 +219,7 @@ class BaseHandler(tornado.web.RequestHandler):
             lines = []
             for line in traceback.format_exception(*kwargs["exc_info"]):
                 lines.append(line)
-            self.finish(json.dumps({
+            self.finish(serialization.dumpb({
                 'error': {
                     'code': status_code,
                     'message': self._reason,
@@ -130,7 +227,7 @@ class BaseHandler(tornado.web.RequestHandler):
                 }
             }))
         else:
-            self.finish(json.dumps({
+            self.finish(serialization.dumpb({
                 'error': {
                     'code': status_code,
                     'message': self._reason,
@@ -148,9 +245,83 @@ class MainHandler(BaseHandler):
             'please refer to /api/message/new or /api/message/updates"}')
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """Handler exporting the metrics of the process in the Prometheus text format."""
+
+    cryptochat_db = None
+    crypto_executor = None
+
+    def data_received(self, chunk):
+        pass
+
+    def get(self):
+        """Returns the current values of all metrics."""
+        if self.cryptochat_db is not None:
+            metrics.DATABASE_SIZE.set(self.cryptochat_db.file_size())
+            for cache, stats in self.cryptochat_db.cache_stats().items():
+                metrics.CACHE_LOOKUPS.set(stats['hits'], cache, 'hit')
+                metrics.CACHE_LOOKUPS.set(stats['misses'], cache, 'miss')
+                metrics.CACHE_SIZE.set(stats['size'], cache)
+        if self.crypto_executor is not None:
+            stats = self.crypto_executor.stats()
+            metrics.CRYPTO_PENDING.set(stats['pending'])
+            metrics.CRYPTO_REJECTED.set(stats['rejected'])
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(metrics.render())
+
+
+class ProfilesHandler(tornado.web.RequestHandler):
+    """Admin handler listing the request profiles and changing the sample rate.
+
+    Only requests from the loopback interface are allowed.
+    """
+
+    profiler = None
+
+    def data_received(self, chunk):
+        pass
+
+    def prepare(self):
+        if self.request.remote_ip not in ('127.0.0.1', '::1'):
+            raise tornado.web.HTTPError(403)
+        if self.profiler is None:
+            raise tornado.web.HTTPError(404)
+
+    def get(self, name=None):
+        """Returns the profiler status, or the statistics of the named profile."""
+        if name is None:
+            self.write(self.profiler.status())
+            return
+        try:
+            report = self.profiler.report(name, self.get_argument('sort', 'cumulative'))
+        except ValueError as valuerr:
+            raise tornado.web.HTTPError(400, reason=str(valuerr))
+        if report is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.write(report)
+
+    def post(self, name=None):
+        """Changes the fraction of the profiled requests of this process."""
+        if name is not None:
+            raise tornado.web.HTTPError(405)
+        try:
+            data = serialization.loads(self.request.body)
+            validate(data, 'profiling_post')
+        except ValidationError as validerr:
+            raise tornado.web.HTTPError(400, reason=validerr.message)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason='Error: malformed input JSON.')
+        self.profiler.sample_rate = data['sample_rate']
+        LOGGER.warning('Profiling %s of the requests.', self.profiler.sample_rate)
+        self.write(self.profiler.status())
+
+
 class MessageNewHandler(BaseHandler):
     """Post a new message to the chat room."""
 
+    signed_input = True
+
     async def post(self):
         """
         Add a new message to the server.
@@ -158,24 +329,160 @@ class MessageNewHandler(BaseHandler):
         await self.handle_request(self.messages_new_api, 1)
 
 
+class MessageBatchHandler(BaseHandler):
+    """Post a batch of new messages, possibly to several chats."""
+
+    signed_input = True
+
+    async def post(self):
+        """
+        Add new messages to the server.
+        """
+        await self.handle_request(self.messages_batch_api, 1)
+
+
 class MessageUpdatesHandler(BaseHandler):
     """Long-polling request for new messages.
 
     Waits until new messages are available before returning anything.
     """
 
+    wait_future = None
+
     async def post(self):
         """Checks for the new message updates, waits until
         new messages are available."""
-        await self.handle_request(self.messages_updates_api, 1)
+        self.wait_future = asyncio.ensure_future(
+            self.handle_request(self.messages_updates_api, 1))
+        try:
+            await self.wait_future
+        except asyncio.CancelledError:
+            # the client went away while waiting
+            return
+
+    def on_connection_close(self):
+        if self.wait_future is not None:
+            self.wait_future.cancel()
+
+
+class MessagesSocketHandler(tornado.websocket.WebSocketHandler):
+    """WebSocket pushing new messages of the subscribed chats to the client.
+
+    Every frame is a JSON object with the "action" field. The client sends
+    "subscribe" frames with the /api/message/ws subscription data and "message"
+    frames with the /api/message/new data. The server answers each of them with
+    a frame of the same action holding either "result" or "error" and pushes
+    "new_message" frames with the messages of the subscribed chats.
+    """
+
+    messages_new_api = None
+    messages_subscribe_api = None
+    message_notifier = None
+    send_queue_size = WEBSOCKET_SEND_QUEUE
+
+    chat_ids = None
+    send_queue = None
+    sender = None
+
+    def data_received(self, chunk):
+        pass
 
-    # def on_connection_close(self):
-    #     self.wait_future.cancel()
+    def check_origin(self, origin):
+        # the HTTP API allows any origin as well
+        return True
+
+    def open(self, *args, **kwargs):
+        self.chat_ids = set()
+        self.send_queue = asyncio.Queue(self.send_queue_size)
+        self.sender = asyncio.ensure_future(self._send_loop())
+
+    async def on_message(self, message):  # pylint: disable=invalid-overridden-method
+        try:
+            data = serialization.loads(message)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            self._reply(None, error='Error: malformed input JSON.')
+            return
+
+        action = data.pop('action', None)
+        api_endpoint = {'subscribe': self.messages_subscribe_api,
+                        'message': self.messages_new_api}.get(action)
+        if api_endpoint is None:
+            self._reply(action, error='Error: unknown action "{}".'.format(action))
+            return
+        try:
+            res = await api_endpoint.process_post(1, data)
+        except ValidationError as validerr:
+            self._reply(action, error=validerr.message)
+            return
+        except DatabaseError as dberr:
+            self._reply(action, error=dberr.reason)
+            return
+        except tornado.web.HTTPError as httperr:
+            self._reply(action, error=httperr.reason, code=httperr.status_code)
+            return
+        except Exception as err:  # pylint: disable=broad-except
+            err_id = err.__hash__()
+            LOGGER.exception('Internal server error <%s> in WebSocket action %s.', err_id, action)
+            self._reply(action, error='Internal server error <%s>:'
+                                      'please include this error id in bug report.' % err_id,
+                        code=500)
+            return
+
+        if action == 'subscribe':
+            for chat_id in set(res['chat_ids']) - self.chat_ids:
+                self.message_notifier.subscribe(chat_id, self.push_message)
+                self.chat_ids.add(chat_id)
+        self._reply(action, result=res)
+
+    def _reply(self, action, result=None, error=None, code=400):
+        if error is None:
+            self._enqueue({'action': action, 'result': result})
+        else:
+            self._enqueue({'action': action, 'error': {'code': code, 'message': error}})
+
+    def push_message(self, message):
+        """Queue a new message of a subscribed chat, called by the notifier."""
+        self._enqueue({'action': 'new_message', 'result': message})
+
+    def _enqueue(self, frame):
+        if self.send_queue is None:
+            return
+        try:
+            self.send_queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            LOGGER.warning('Dropping WebSocket client %s, it does not keep up with %d frames.',
+                           self.request.remote_ip, self.send_queue_size)
+            self._unsubscribe()
+            self.close(1013, 'Send queue overflow.')
+
+    async def _send_loop(self):
+        while True:
+            frame = await self.send_queue.get()
+            try:
+                # waits until the frame is handed over to the socket
+                await self.write_message(serialization.dumps(frame))
+            except tornado.websocket.WebSocketClosedError:
+                return
+
+    def _unsubscribe(self):
+        for chat_id in self.chat_ids:
+            self.message_notifier.unsubscribe(chat_id, self.push_message)
+        self.chat_ids.clear()
+        self.send_queue = None
+
+    def on_close(self):
+        self._unsubscribe()
+        if self.sender is not None:
+            self.sender.cancel()
 
 
 class UsersHandler(BaseHandler):
     """Handler class providing /users POST requests."""
 
+    versioned_types = (DBType.USERS,)
+
     async def post(self):
         """Adds a new user to the database."""
         await self.handle_request(self.users_api, 1)
@@ -188,6 +495,8 @@ class UsersHandler(BaseHandler):
 class ChatsHandler(BaseHandler):
     """Handler providing /chats POST requests"""
 
+    versioned_types = (DBType.CHATS,)
+
     async def post(self):
         """Adds a new chat to the database."""
         await self.handle_request(self.chats_api, 1)
@@ -200,6 +509,8 @@ class ChatsHandler(BaseHandler):
 class ChatsUserHandler(BaseHandler):
     """Handler providing /chats/user GET requests"""
 
+    versioned_types = (DBType.USERS, DBType.CHATS)
+
     async def get(self):
         """Returns chats for the given user."""
         await self.handle_request(self.chats_user_api, 1)
@@ -208,6 +519,8 @@ class ChatsUserHandler(BaseHandler):
 class ContactsNewHandler(BaseHandler):
     """Handler providing /contacts POST requests"""
 
+    versioned_types = (DBType.USERS, DBType.CONTACTS)
+
     async def post(self):
         """Adds a new contact to the database"""
         await self.handle_request(self.contacts_new_api, 1)
@@ -220,55 +533,172 @@ class ContactsNewHandler(BaseHandler):
 class Application(tornado.web.Application):
     """ main cryptochat application class """
 
-    def __init__(self):
+    def __init__(self, autoreload=True):
         handlers = [
             (r"/", MainHandler),
             (r"/api/message/new", MessageNewHandler),
+            (r"/api/message/batch", MessageBatchHandler),
             (r"/api/message/updates", MessageUpdatesHandler),
+            (r"/api/message/ws", MessagesSocketHandler),
             (r"/api/users", UsersHandler),
             (r"/api/chats", ChatsHandler),
             (r"/api/chats/user", ChatsUserHandler),
             (r"/api/contacts", ContactsNewHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/admin/profiles", ProfilesHandler),
+            (r"/admin/profiles/({})".format(PROFILE_NAME), ProfilesHandler),
         ]
 
-        tornado.web.Application.__init__(self, handlers, debug=True, serve_traceback=False)
+        # autoreload does not work with several worker processes
+        tornado.web.Application.__init__(self, handlers, transforms=[CompressedContentEncoding],
+                                         debug=True, serve_traceback=False,
+                                         autoreload=autoreload)
+
+    def log_request(self, handler):
+        name = type(handler).__name__
+        request = handler.request
+        status = handler.get_status()
+        duration = request.request_time()
+        if status < 400:
+            log_method = tornado.log.access_log.info
+        elif status < 500:
+            log_method = tornado.log.access_log.warning
+        else:
+            log_method = tornado.log.access_log.error
+        log_method('%d %s %s (%s) %.2fms', status, request.method, request.uri,
+                   request.remote_ip, 1000 * duration,
+                   extra={'status': status, 'handler': name,
+                          'duration_ms': round(1000 * duration, 2)})
+        metrics.REQUESTS.inc(name, request.method, status)
+        metrics.REQUEST_DURATION.observe(duration, name, request.method)
+
+
+def setup_handlers(cryptochat_db, message_notifier, crypto_executor,
+                   poll_timeout=MESSAGE_POLL_TIMEOUT):
+    """
+    Connect the request handlers to the APIs working with the database.
+    :param cryptochat_db: DB or SQLiteDB instance
+    :param message_notifier: MessageNotifier waking up the clients waiting for messages
+    :param crypto_executor: CryptoExecutor verifying the signatures of messages
+    :param poll_timeout: Seconds /api/message/updates waits for new messages
+    """
+    BaseHandler.messages_new_api = MessagesNewAPI(cryptochat_db, message_notifier,
+                                                  crypto_executor)
+    BaseHandler.messages_batch_api = MessagesBatchAPI(cryptochat_db, message_notifier,
+                                                      crypto_executor)
+    BaseHandler.messages_updates_api = MessagesUpdatesAPI(cryptochat_db, message_notifier,
+                                                          poll_timeout)
+    MessagesSocketHandler.messages_new_api = BaseHandler.messages_new_api
+    MessagesSocketHandler.messages_subscribe_api = MessagesSubscribeAPI(cryptochat_db)
+    MessagesSocketHandler.message_notifier = message_notifier
+    BaseHandler.users_api = UsersAPI(cryptochat_db)
+    BaseHandler.chats_api = ChatsAPI(cryptochat_db)
+    BaseHandler.chats_user_api = ChatsUserAPI(cryptochat_db)
+    BaseHandler.contacts_new_api = ContactsAPI(cryptochat_db)
+    BaseHandler.cryptochat_db = cryptochat_db
+    MetricsHandler.cryptochat_db = cryptochat_db
+    MetricsHandler.crypto_executor = crypto_executor
+    BaseHandler.profiler = ProfilesHandler.profiler = RequestProfiler()
+
+
+async def maintain_database(cryptochat_db):
+    """
+    Remove the messages over the retention limits and compact the database.
+    :param cryptochat_db: DB or SQLiteDB instance
+    """
+    try:
+        removed = await cryptochat_db.enforce_retention()
+        if removed:
+            LOGGER.info('Removed %d messages over the retention limits.', removed)
+        await cryptochat_db.compact()
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.exception('Database maintenance failed.')
+
+
+def parse_args():
+    """Parse the command line options."""
+    parser = argparse.ArgumentParser(description='Cryptochat server.')
+    parser.add_argument('--port', type=int, default=PUBLIC_API_PORT,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of server processes sharing the database, '
+                             '0 for one per CPU (default: $WORKERS or %(default)s)')
+    return parser.parse_args()
 
 
 def main():
     """ The main function. It creates cryptochat application, run everything."""
+    args = parse_args()
 
-    async def shutdown():
+    shutting_down = False
+
+    async def shutdown(sig):
+        nonlocal shutting_down
+        if shutting_down:
+            return
+        shutting_down = True
+        LOGGER.warning("Registered %s, shutting down.", signal.Signals(sig).name)
         server.stop()
         await tornado.gen.sleep(_SHUTDOWN_TIMEOUT)
+        if refresh_callback is not None:
+            refresh_callback.stop()
+        if maintenance_callback is not None:
+            maintenance_callback.stop()
+        LOGGER.info("Database cache statistics: %s", cryptochat_db.cache_stats())
+        cryptochat_db.close()
+        crypto_executor.shutdown()
         tornado.ioloop.IOLoop.current().stop()
         LOGGER.info("Server was successfully shut down.")
+        stop_logging()
 
     def exit_handler(sig, frame):  # pylint: disable=unused-argument
-        def get_sig_name(sig):
-            return dict((k, v) for v, k in reversed(sorted(signal.__dict__.items()))
-                        if v.startswith('SIG') and not v.startswith('SIG_')).pop(sig)
+        # logging here could deadlock on the locks of the logging handler which the
+        # interrupted code may hold, the IOLoop logs the signal instead
+        tornado.ioloop.IOLoop.instance().add_callback_from_signal(shutdown, sig)
 
-        LOGGER.warning("Registered %s, shutting down.", get_sig_name(sig))
-        tornado.ioloop.IOLoop.instance().add_callback_from_signal(shutdown)
-
-    signal.signal(signal.SIGTERM, exit_handler)
-    signal.signal(signal.SIGINT, exit_handler)
+    def forward_handler(sig, frame):  # pylint: disable=unused-argument
+        # the parent of the workers passes the signal on to them
+        signal.signal(sig, signal.SIG_IGN)
+        os.killpg(0, sig)
 
     init_logging()
-    cryptochat_db = DB(DATABASE_LOCATION)
+    multi_process = args.workers != 1
 
-    cryptochat_app = Application()
+    cryptochat_app = Application(autoreload=not multi_process)
     server = tornado.httpserver.HTTPServer(cryptochat_app)
-    server.bind(PUBLIC_API_PORT)
-    server.start()
-    LOGGER.info("Starting cryptochat (version %s).", SERVER_VERSION)
+    server.bind(args.port)
+    if multi_process:
+        signal.signal(signal.SIGTERM, forward_handler)
+        signal.signal(signal.SIGINT, forward_handler)
+    # forks the workers when there should be more of them
+    server.start(args.workers)
 
-    BaseHandler.messages_new_api = MessagesNewAPI(cryptochat_db)
-    BaseHandler.messages_updates_api = MessagesUpdatesAPI(cryptochat_db)
-    BaseHandler.users_api = UsersAPI(cryptochat_db)
-    BaseHandler.chats_api = ChatsAPI(cryptochat_db)
-    BaseHandler.chats_user_api = ChatsUserAPI(cryptochat_db)
-    BaseHandler.contacts_new_api = ContactsAPI(cryptochat_db)
+    signal.signal(signal.SIGTERM, exit_handler)
+    signal.signal(signal.SIGINT, exit_handler)
+    LOGGER.info("Starting cryptochat (version %s, JSON library %s).", SERVER_VERSION,
+                serialization.LIBRARY)
+
+    cryptochat_db = open_database(DATABASE_LOCATION, shared=multi_process)
+    message_notifier = MessageNotifier(MAX_POLL_WAITERS)
+    refresh_callback = None
+    if multi_process:
+        # wake up clients waiting for messages stored by the other workers
+        # pushed in the same shape as the messages stored by this worker
+        cryptochat_db.add_message_listener(
+            lambda message: message_notifier.notify(message['chat_id'], message_response(
+                message['chat_id'], message['sender_id'], message['timestamp'],
+                message['message'])))
+        refresh_callback = tornado.ioloop.PeriodicCallback(cryptochat_db.refresh,
+                                                           _REFRESH_INTERVAL)
+        refresh_callback.start()
+    crypto_executor = CryptoExecutor()
+    setup_handlers(cryptochat_db, message_notifier, crypto_executor)
+    maintenance_callback = None
+    # one worker is enough to maintain the shared database
+    if MAINTENANCE_INTERVAL > 0 and tornado.process.task_id() in (None, 0):
+        maintenance_callback = tornado.ioloop.PeriodicCallback(
+            lambda: maintain_database(cryptochat_db), MAINTENANCE_INTERVAL * 1000)
+        maintenance_callback.start()
 
     tornado.ioloop.IOLoop.current().start()
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark of concurrent message inserts with and without group commit.
+
+Inserts messages from many concurrent coroutines into a temporary database,
+once with an fsync of the write-ahead log per insert and once with the inserts
+sharing fsyncs, and prints the reached throughput.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import DB  # pylint: disable=wrong-import-position
+from storage import DEFAULT_COMMIT_BATCH, DEFAULT_COMMIT_DELAY  # pylint: disable=wrong-import-position
+
+CHATS = 10
+
+
+async def insert_messages(database, concurrency, count):
+    """Insert count messages from concurrent writers, return the elapsed time."""
+    for user_id in range(CHATS + 1):
+        await database.insert_user(user_id, 'public key {}'.format(user_id))
+    chat_ids = [await database.insert_chat([0, user_id], ['key', 'key'])
+                for user_id in range(1, CHATS + 1)]
+
+    async def writer(number):
+        for message_number in range(number, count, concurrency):
+            await database.insert_message(chat_ids[message_number % CHATS], 0,
+                                          'message {}'.format(message_number))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(number) for number in range(concurrency)))
+    return time.perf_counter() - start
+
+
+def measure(commit_delay, commit_batch, args):
+    """Return messages per second inserted with the commit settings."""
+    with tempfile.TemporaryDirectory() as db_dir:
+        database = DB(os.path.join(db_dir, 'db.json'))
+        # pylint: disable=protected-access
+        database._storage.group_commit.delay = commit_delay
+        database._storage.group_commit.batch_size = commit_batch
+        elapsed = asyncio.run(insert_messages(database, args.concurrency, args.messages))
+        batches = database._storage.group_commit.batches
+        database.close()
+    return args.messages / elapsed, args.messages / max(batches, 1)
+
+
+def main():
+    """Run the benchmark and print the throughput of both settings."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--messages', type=int, default=5000,
+                        help='messages to insert (default: 5000)')
+    parser.add_argument('-c', '--concurrency', type=int, default=100,
+                        help='concurrent writers (default: 100)')
+    args = parser.parse_args()
+
+    print('{:<16} {:>12} {:>16}'.format('commit', 'messages/s', 'messages/fsync'))
+    for name, delay, batch in (('fsync per write', 0, 1),
+                               ('group commit', DEFAULT_COMMIT_DELAY, DEFAULT_COMMIT_BATCH)):
+        throughput, per_fsync = measure(delay, batch, args)
+        print('{:<16} {:>12.0f} {:>16.1f}'.format(name, throughput, per_fsync))
+
+
+if __name__ == '__main__':
+    main()
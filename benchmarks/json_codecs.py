@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of JSON encoding and decoding with the available libraries.
+
+Measures the operations of the server on realistic payloads: parsing a signed
+message request and a request for message updates, encoding a response with a
+page of messages, appending a message to the write-ahead log and encoding
+a checkpoint of the database. Signed messages hold an integer too large for
+orjson, so both libraries parse them with the json module; "scan message"
+parses one without telling serialization.loads, which then searches for it.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serialization  # pylint: disable=wrong-import-position
+
+MESSAGE = {'type': 3, 'chat_id': 42, 'sender_id': 123456,
+           'timestamp': 1546300800.123456, 'message': 'x' * 344}
+# signature of the message, an integer of the RSA key size
+SIGNED_MESSAGE = serialization.dumpb({'chat_id': 42, 'sender_id': 123456,
+                                      'message': 'x' * 344, 'hash': 2 ** 2047 + 12345})
+UPDATES_REQUEST = serialization.dumpb({'chat_id': 42, 'cursor': 1546300800.123456,
+                                       'limit': 100})
+MESSAGES_PAGE = {'messages': [dict(MESSAGE, timestamp=MESSAGE['timestamp'] + number)
+                              for number in range(100)], 'next_cursor': None}
+WAL_RECORD = {'op': 'insert', 'table': 'messages', 'id': 1000, 'doc': MESSAGE}
+CHECKPOINT = {'messages': {str(number): dict(MESSAGE, timestamp=MESSAGE['timestamp'] + number)
+                           for number in range(10000)}}
+
+OPERATIONS = {
+    'parse message': lambda: serialization.loads(SIGNED_MESSAGE, big_integers=True),
+    'scan message': lambda: serialization.loads(SIGNED_MESSAGE),
+    'parse updates': lambda: serialization.loads(UPDATES_REQUEST),
+    'encode page': lambda: serialization.dumpb(MESSAGES_PAGE, html_safe=True),
+    'wal record': lambda: serialization.loads(serialization.dumpb(WAL_RECORD)),
+    'checkpoint': lambda: serialization.dumpb(CHECKPOINT),
+}
+
+
+def main():
+    """Run the benchmark and print the cost of the operations with each library."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=200,
+                        help='operations per measurement (default: 200)')
+    args = parser.parse_args()
+
+    libraries = ['json'] + (['orjson'] if serialization.orjson is not None else [])
+    print('{:<14}'.format('operation') +
+          ''.join('{:>14}'.format(library + ' [us]') for library in libraries))
+    for name, operation in OPERATIONS.items():
+        costs = []
+        for library in libraries:
+            serialization.use_library(library)
+            costs.append(min(timeit.repeat(operation, number=args.number,
+                                           repeat=3)) / args.number)
+        print('{:<14}'.format(name) + ''.join('{:>14.1f}'.format(cost * 1e6) for cost in costs))
+    serialization.use_library(serialization.JSON_LIBRARY)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Load test of the API endpoints and of the database coroutines behind them.
+
+Fills a temporary database with users, chats, contacts and messages, starts
+app.Application on a local port in a separate process and runs one workload
+per endpoint: client processes send requests from concurrent coroutines for
+a fixed time. The database coroutines are then measured the same way without
+the HTTP layer. Messages are signed by pre-generated RSA keys before the load
+starts, so the clients do not spend their time signing.
+
+Throughput and p50/p95/p99 latencies of every workload are printed and stored
+as JSON, by default in benchmarks/results/ under the current git revision.
+Pass the file of an earlier run to --compare to see the changes.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import rsa
+import tornado.httpclient
+from rsa.transform import bytes2int
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app  # pylint: disable=wrong-import-position
+import serialization  # pylint: disable=wrong-import-position
+from database_error import DatabaseError  # pylint: disable=wrong-import-position
+from db import open_database  # pylint: disable=wrong-import-position
+from notifier import MessageNotifier  # pylint: disable=wrong-import-position
+from utils import CryptoExecutor  # pylint: disable=wrong-import-position
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+# users with a key pair, they own the chats and sign the messages
+SIGNING_USERS = 8
+MESSAGE_TEXT = 'x' * 344  # base64 of a 256 bytes ciphertext
+BATCH_SIZE = 10
+# IDs of the users registered during the load, clear of the pre-filled ones
+NEW_USER_ID = 10 ** 9
+
+
+def sign(private_key, chat_id, sender_id, message):
+    """Return the hash field of a message, as the clients compute it."""
+    digest = hashlib.sha256((str(chat_id) + str(sender_id) + str(message)).encode()).hexdigest()
+    return bytes2int(rsa.sign(digest.encode('utf-8'), private_key, 'SHA-256'))
+
+
+def revision():
+    """Return the git revision of the tree, with '+' when it has local changes."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT,
+                                stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+' if dirty else '')
+
+
+async def populate(database, args, keys):
+    """
+    Fill the database and return the fixture the workloads send their requests about.
+    """
+    users = list(range(SIGNING_USERS + args.users))
+    for user_id in users:
+        public_key = keys[user_id][0].save_pkcs1().decode() if user_id < SIGNING_USERS \
+            else 'public key {}'.format(user_id)
+        await database.insert_user(user_id, public_key)
+    chats = {}
+    for user_id in range(1, SIGNING_USERS):
+        chats[await database.insert_chat([0, user_id], ['key', 'key'])] = 0
+    for user_id in users[SIGNING_USERS:]:
+        chats[await database.insert_chat([user_id % SIGNING_USERS, user_id],
+                                         ['key', 'key'])] = user_id % SIGNING_USERS
+        await database.insert_contact(0, user_id, 'alias {}'.format(user_id))
+    for chat_id, sender_id in chats.items():
+        await database.insert_messages([{'chat_id': chat_id, 'sender_id': sender_id,
+                                         'message': MESSAGE_TEXT}] * args.history)
+    signed_chats = list(itertools.islice(chats.items(), args.signed_messages))
+    messages = [{'chat_id': chat_id, 'sender_id': sender_id, 'message': MESSAGE_TEXT,
+                 'hash': sign(keys[sender_id][1], chat_id, sender_id, MESSAGE_TEXT)}
+                for chat_id, sender_id in signed_chats]
+    return {'users': users, 'chats': list(chats), 'messages': messages}
+
+
+def _unique_chat(users, number):
+    """Return the number-th new chat, the users 0, 1 and 2 plus the users of its bits."""
+    members = [0, 1, 2] + [users[3 + bit] for bit in range(number.bit_length())
+                           if number >> bit & 1]
+    return {'users': members, 'sym_key_enc_by_owners_pub_keys': ['key'] * len(members)}
+
+
+def _unique_contact(users, number):
+    """Return the number-th new contact, the pre-filled ones are all owned by the user 0."""
+    owner = 1 + number % (len(users) - 1)
+    return {'owner_id': users[owner],
+            'user_id': users[(owner + 1 + number // (len(users) - 1)) % len(users)],
+            'encrypted_alias': 'alias'}
+
+
+# every workload returns the method, path and body of the number-th request of a client,
+# unique is a number never returned to any other request of the run
+WORKLOADS = {
+    'users_post': lambda fixture, number, unique: (
+        'POST', '/api/users', {'user_id': NEW_USER_ID + unique,
+                               'public_key': 'new public key {}'.format(unique)}),
+    'users_get': lambda fixture, number, unique: (
+        'GET', '/api/users', {'user_id': fixture['users'][number % len(fixture['users'])]}),
+    'chats_post': lambda fixture, number, unique: (
+        'POST', '/api/chats', _unique_chat(fixture['users'], unique)),
+    'chats_get': lambda fixture, number, unique: (
+        'GET', '/api/chats', {'chat_id': fixture['chats'][number % len(fixture['chats'])]}),
+    'chats_user_get': lambda fixture, number, unique: (
+        'GET', '/api/chats/user', {'user_id': number % SIGNING_USERS, 'limit': 100}),
+    'contacts_post': lambda fixture, number, unique: (
+        'POST', '/api/contacts', _unique_contact(fixture['users'], unique)),
+    'contacts_get': lambda fixture, number, unique: (
+        'GET', '/api/contacts', {'owner_id': 0, 'limit': 100}),
+    'message_new': lambda fixture, number, unique: (
+        'POST', '/api/message/new', fixture['messages'][number % len(fixture['messages'])]),
+    'message_batch': lambda fixture, number, unique: (
+        'POST', '/api/message/batch', {'messages': [
+            fixture['messages'][(number * BATCH_SIZE + item) % len(fixture['messages'])]
+            for item in range(BATCH_SIZE)]}),
+    'message_updates': lambda fixture, number, unique: (
+        'POST', '/api/message/updates', {'chat_id': fixture['chats'][number %
+                                                                     len(fixture['chats'])],
+                                         'cursor': 0, 'limit': 50}),
+}
+
+
+def percentiles(latencies, duration):
+    """Return throughput and latency statistics of a workload, latencies in milliseconds."""
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))], 3)
+
+    return {'requests': len(latencies), 'throughput': round(len(latencies) / duration, 1),
+            'p50': percentile(0.50), 'p95': percentile(0.95), 'p99': percentile(0.99)}
+
+
+def run_http_client(task):
+    """Send the requests of a workload for the given time, return latencies and errors."""
+    port, workload, fixture, client_number, args = task
+    make_request = WORKLOADS[workload]
+
+    async def worker(client, deadline, worker_number, latencies, errors):
+        for number in itertools.count(worker_number, args.concurrency):
+            if time.perf_counter() >= deadline:
+                return
+            unique = number * args.clients + client_number
+            method, path, body = make_request(fixture, number, unique)
+            start = time.perf_counter()
+            response = await client.fetch('http://localhost:{}{}'.format(port, path),
+                                          method=method, body=serialization.dumpb(body),
+                                          allow_nonstandard_methods=True, raise_error=False)
+            if response.code == 200:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors.append(response.code)
+
+    async def send_requests():
+        client = tornado.httpclient.AsyncHTTPClient(max_clients=args.concurrency)
+        deadline = time.perf_counter() + args.duration
+        latencies, errors = [], []
+        await asyncio.gather(*(worker(client, deadline, number, latencies, errors)
+                               for number in range(args.concurrency)))
+        return latencies, errors
+
+    return asyncio.run(send_requests())
+
+
+def serve(port, db_path, ready):
+    """Run the application on the database in this process until it gets SIGTERM."""
+    # the rejected requests are counted by the clients
+    logging.disable(logging.ERROR)
+
+    async def start():
+        stopped = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+        cryptochat_db = open_database(db_path)
+        crypto_executor = CryptoExecutor()
+        # the update requests must not wait, their latency would be the poll timeout
+        app.setup_handlers(cryptochat_db, MessageNotifier(app.MAX_POLL_WAITERS),
+                           crypto_executor, poll_timeout=0)
+        server = app.Application(autoreload=False).listen(port, address='127.0.0.1')
+        ready.set()
+        await stopped.wait()
+        server.stop()
+        # the workers of the pool would outlive the server otherwise
+        crypto_executor.shutdown()
+        cryptochat_db.close()
+
+    asyncio.run(start())
+
+
+def run_http(args, db_path, fixture):
+    """Run every HTTP workload against a server process, return their statistics."""
+    ready = multiprocessing.Event()
+    # not a daemon, the server starts the processes verifying the signatures
+    server = multiprocessing.Process(target=serve, args=(args.port, db_path, ready))
+    server.start()
+    if not ready.wait(30):
+        server.terminate()
+        raise RuntimeError('The server did not start.')
+    results = {}
+    try:
+        with multiprocessing.Pool(args.clients) as pool:
+            for workload in args.workloads:
+                outcomes = pool.map(run_http_client, [
+                    (args.port, workload, fixture, client_number, args)
+                    for client_number in range(args.clients)])
+                latencies = [latency for latencies, _ in outcomes for latency in latencies]
+                results[workload] = percentiles(latencies, args.duration)
+                results[workload]['errors'] = sum(len(errors) for _, errors in outcomes)
+                print_row(workload, results[workload])
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+# database coroutines measured without the HTTP layer, taking the fixture, number and unique
+DB_WORKLOADS = {
+    'insert_user': lambda database, fixture, number, unique: database.insert_user(
+        NEW_USER_ID + unique, 'new public key {}'.format(unique)),
+    'select_user': lambda database, fixture, number, unique: database.select_user(
+        fixture['users'][number % len(fixture['users'])]),
+    'insert_chat': lambda database, fixture, number, unique: database.insert_chat(
+        **_unique_chat(fixture['users'], unique)),
+    'select_chat': lambda database, fixture, number, unique: database.select_chat(
+        fixture['chats'][number % len(fixture['chats'])]),
+    'select_my_chats': lambda database, fixture, number, unique: database.select_my_chats(
+        number % SIGNING_USERS, limit=100),
+    'select_my_contacts': lambda database, fixture, number, unique: database.select_my_contacts(
+        0, limit=100),
+    'insert_message': lambda database, fixture, number, unique: database.insert_message(
+        **{key: value for key, value in
+           fixture['messages'][number % len(fixture['messages'])].items() if key != 'hash'}),
+    'select_my_messages': lambda database, fixture, number, unique: database.select_my_messages(
+        fixture['chats'][number % len(fixture['chats'])], after=0, limit=50),
+}
+
+
+async def run_db_workload(database, fixture, workload, args):
+    """Call the coroutine of a workload for the given time, return its statistics."""
+    call = DB_WORKLOADS[workload]
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + args.duration
+
+    async def worker(worker_number):
+        for number in itertools.count(worker_number, args.concurrency):
+            if time.perf_counter() >= deadline:
+                return
+            start = time.perf_counter()
+            try:
+                await call(database, fixture, number, number)
+            except DatabaseError as error:
+                errors.append(error.reason)
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(worker(number) for number in range(args.concurrency)))
+    stats = percentiles(latencies, args.duration)
+    stats['errors'] = len(errors)
+    return stats
+
+
+def run_db(args, db_path, fixture):
+    """Run every database workload directly on the database, return their statistics."""
+    async def run():
+        database = open_database(db_path)
+        try:
+            results = {}
+            for workload in DB_WORKLOADS:
+                results[workload] = await run_db_workload(database, fixture, workload, args)
+                print_row(workload, results[workload])
+            return results
+        finally:
+            database.close()
+
+    return asyncio.run(run())
+
+
+def print_row(name, stats):
+    """Print the statistics of a workload."""
+    print('{:<20} {:>10} {:>10} {:>7} {:>9} {:>9} {:>9}'.format(
+        name, stats['requests'], stats['throughput'], stats['errors'],
+        *('-' if stats[key] is None else '{:.2f}'.format(stats[key])
+          for key in ('p50', 'p95', 'p99'))))
+
+
+def compare(results, previous_path):
+    """Print the changes of throughput and p99 latency against an earlier run."""
+    with open(previous_path, encoding='utf8') as previous_file:
+        previous = json.load(previous_file)
+    print('\nchanges against {} ({})'.format(previous['revision'], previous_path))
+    print('{:<20} {:>12} {:>12}'.format('workload', 'throughput', 'p99'))
+    for part in ('http', 'db'):
+        for workload, stats in results.get(part, {}).items():
+            old = previous.get(part, {}).get(workload)
+            if not old or not old['throughput'] or not old['p99'] or not stats['p99']:
+                continue
+            print('{:<20} {:>+11.1f}% {:>+11.1f}%'.format(
+                '{}/{}'.format(part, workload),
+                (stats['throughput'] / old['throughput'] - 1) * 100,
+                (stats['p99'] / old['p99'] - 1) * 100))
+
+
+def main():
+    """Fill a database, run the workloads and store their results."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json',
+                        help='database backend (default: json)')
+    parser.add_argument('--workloads', nargs='+', choices=sorted(WORKLOADS),
+                        default=list(WORKLOADS), help='HTTP workloads to run (default: all)')
+    parser.add_argument('--no-http', action='store_true', help='skip the HTTP workloads')
+    parser.add_argument('--no-db', action='store_true', help='skip the database workloads')
+    parser.add_argument('--clients', type=int, default=2,
+                        help='client processes (default: 2)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='concurrent requests per client (default: 16)')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds of each workload (default: 5)')
+    parser.add_argument('--users', type=int, default=200,
+                        help='users filled into the database (default: 200)')
+    parser.add_argument('--history', type=int, default=20,
+                        help='messages filled into every chat (default: 20)')
+    parser.add_argument('--signed-messages', type=int, default=100,
+                        help='distinct signed messages sent (default: 100)')
+    parser.add_argument('--key-bits', type=int, default=1024,
+                        help='size of the RSA keys of the users (default: 1024)')
+    parser.add_argument('--port', type=int, default=8878,
+                        help='port of the tested server (default: 8878)')
+    parser.add_argument('--output',
+                        help='file to store the results in (default: '
+                             'benchmarks/results/load-<revision>-<backend>.json)')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    keys = [rsa.newkeys(args.key_bits) for _ in range(SIGNING_USERS)]
+    results = {'revision': revision(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'python': platform.python_version(), 'json_library': serialization.LIBRARY,
+               'config': {key: value for key, value in vars(args).items()
+                          if key not in ('output', 'compare')}}
+    header = '{:<20} {:>10} {:>10} {:>7} {:>9} {:>9} {:>9}'.format(
+        'workload', 'requests', 'req/s', 'errors', 'p50 [ms]', 'p95 [ms]', 'p99 [ms]')
+    with tempfile.TemporaryDirectory() as db_dir:
+        suffix = '.sqlite' if args.backend == 'sqlite' else '.json'
+        for part, run in (('http', run_http), ('db', run_db)):
+            if getattr(args, 'no_' + part):
+                continue
+            # every part starts from the same data
+            db_path = os.path.join(db_dir, part + suffix)
+            database = open_database(db_path)
+            fixture = asyncio.run(populate(database, args, keys))
+            database.close()
+            print('\n{} ({} backend)\n{}'.format(part, args.backend, header))
+            results[part] = run(args, db_path, fixture)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, 'load-{}-{}.json'.format(results['revision'], args.backend))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf8') as output_file:
+        json.dump(results, output_file, indent=2)
+    print('\nresults stored in {}'.format(output))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
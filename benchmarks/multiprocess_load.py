@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Load test of the server running in one and in several worker processes.
+
+Starts app.py on a temporary database, registers users and chats, then lets
+client processes send a mix of chat listings and signed messages for a fixed
+time and prints the throughput reached with each number of workers.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import rsa
+import tornado.httpclient
+from rsa.transform import bytes2int
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS = 8
+
+
+def sign(private_key, chat_id, sender_id, message):
+    """Return the hash field of a message, as the clients compute it."""
+    digest = hashlib.sha256((str(chat_id) + str(sender_id) + str(message)).encode()).hexdigest()
+    return bytes2int(rsa.sign(digest.encode('utf-8'), private_key, 'SHA-256'))
+
+
+def start_server(workers, port, db_path):
+    """Start the server and wait until it accepts connections."""
+    env = dict(os.environ, DATABASE_LOCATION=db_path)
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, 'app.py', '--workers', str(workers), '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        # the server passes signals to its whole process group
+        start_new_session=True)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('The server did not start.')
+
+
+def post(port, path, data):
+    """Send a POST request and return the parsed response."""
+    request = urllib.request.Request('http://localhost:{}{}'.format(port, path),
+                                     data=json.dumps(data).encode(), method='POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def populate(port, keys):
+    """Register the users and a chat of the first user with each of the others."""
+    for user_id, (public_key, _) in enumerate(keys):
+        post(port, '/api/users', {'user_id': user_id,
+                                  'public_key': public_key.save_pkcs1().decode()})
+    return [post(port, '/api/chats', {'users': [0, user_id],
+                                      'sym_key_enc_by_owners_pub_keys': ['key', 'key']})['chat_id']
+            for user_id in range(1, len(keys))]
+
+
+def run_client(args):
+    """Send requests for the given time, return the number of successful ones."""
+    port, duration, concurrency, messages = args
+
+    async def worker(client, deadline, done):
+        request_number = 0
+        while time.time() < deadline:
+            request_number += 1
+            if request_number % 2:
+                path, method, body = '/api/chats/user', 'GET', {'user_id': 0}
+            else:
+                path, method, body = '/api/message/new', 'POST', \
+                    messages[request_number % len(messages)]
+            response = await client.fetch('http://localhost:{}{}'.format(port, path),
+                                          method=method, body=json.dumps(body),
+                                          allow_nonstandard_methods=True, raise_error=False)
+            if response.code == 200:
+                done.append(1)
+
+    async def send_requests():
+        client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+        deadline = time.time() + duration
+        done = []
+        await asyncio.gather(*(worker(client, deadline, done) for _ in range(concurrency)))
+        return len(done)
+
+    return asyncio.run(send_requests())
+
+
+def measure(workers, args, keys):
+    """Start a server with the given number of workers and return its requests per second."""
+    with tempfile.TemporaryDirectory() as db_dir:
+        server = start_server(workers, args.port, os.path.join(db_dir, 'db.json'))
+        try:
+            chat_ids = populate(args.port, keys)
+            messages = []
+            for chat_id in chat_ids:
+                for text in ('hello', 'how are you'):
+                    messages.append({'chat_id': chat_id, 'sender_id': 0, 'message': text,
+                                     'hash': sign(keys[0][1], chat_id, 0, text)})
+            with multiprocessing.Pool(args.clients) as pool:
+                done = sum(pool.map(run_client, [(args.port, args.duration, args.concurrency,
+                                                  messages)] * args.clients))
+        finally:
+            server.terminate()
+            server.wait()
+    return done / args.duration
+
+
+def main():
+    """Run the load test and print the throughput of each configuration."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='workers of the multi-process run (default: number of CPUs)')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='client processes (default: 4)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='concurrent requests per client (default: 16)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds of load per run (default: 10)')
+    parser.add_argument('--port', type=int, default=8877,
+                        help='port of the tested server (default: 8877)')
+    args = parser.parse_args()
+
+    keys = [rsa.newkeys(512) for _ in range(USERS)]
+    print('{:>8} {:>10}'.format('workers', 'req/s'))
+    for workers in sorted({1, args.workers}):
+        print('{:>8} {:>10.1f}'.format(workers, measure(workers, args, keys)))
+
+
+if __name__ == '__main__':
+    main()
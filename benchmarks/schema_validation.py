@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the per-request JSON schema validation cost.
+
+Compares jsonschema.validate with a schema literal, as the API classes used to
+validate requests, with the validators precompiled by the schemas module.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import jsonschema
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schemas  # pylint: disable=wrong-import-position
+
+REQUESTS = {
+    'messages_new': {'chat_id': 1, 'sender_id': 123, 'message': 'x' * 256, 'hash': 2 ** 1000},
+    'messages_updates': {'chat_id': 1, 'cursor': 1546300800.123456},
+    'users_post': {'user_id': 123, 'public_key': '-----BEGIN RSA PUBLIC KEY-----'},
+    'chats_post': {'users': [123, 123456], 'sym_key_enc_by_owners_pub_keys': ['a', 'b']},
+    'contacts_post': {'owner_id': 123, 'user_id': 123456, 'encrypted_alias': 'alias'},
+}
+
+
+def main():
+    """Run the benchmark and print the cost of one validation."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='validations per measurement (default: 2000)')
+    args = parser.parse_args()
+
+    print('{:<18} {:>14} {:>14} {:>8}'.format('schema', 'validate [us]', 'compiled [us]',
+                                               'speedup'))
+    for name, data in REQUESTS.items():
+        schema = schemas.SCHEMAS[name]
+        before = min(timeit.repeat(lambda: jsonschema.validate(data, schema),  # pylint: disable=cell-var-from-loop
+                                   number=args.number, repeat=3)) / args.number
+        after = min(timeit.repeat(lambda: schemas.validate(data, name),  # pylint: disable=cell-var-from-loop
+                                  number=args.number, repeat=3)) / args.number
+        print('{:<18} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(name, before * 1e6, after * 1e6,
+                                                          before / after))
+
+
+if __name__ == "__main__":
+    main()
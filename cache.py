@@ -0,0 +1,97 @@
+"""
+Module with in-process caches.
+"""
+
+import functools
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Mapping bounded by size, evicting the least recently used entries first.
+    With a ttl, entries also expire that many seconds after they were cached.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Return the cached value and mark it as recently used.
+        :param key: Key of the entry
+        :param default: Value returned when the key is not cached
+        """
+        try:
+            value, expires = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self._clock():
+            del self._entries[key]
+            self.expired += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Cache the value, evicting the least recently used entry when full.
+        :param key: Key of the entry
+        :param value: Value to cache
+        """
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        self._entries[key] = value, expires
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Drop the entry from the cache.
+        :param key: Key of the entry
+        """
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop all entries."""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return hit and miss counters, the hit rate and the current size."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries), 'max_size': self.max_size}
+
+
+def read_through(cache_name):
+    """
+    Serve the results of a coroutine method taking a single key from a cache.
+    Results which are None or empty are not cached, so that a record created
+    meanwhile, possibly by another process, is found by the next call.
+    :param cache_name: Name of the LRUCache attribute of the instance
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, key):
+            cache = getattr(self, cache_name)
+            value = cache.get(key)
+            if value is None:
+                value = await method(self, key)
+                if value:
+                    cache.put(key, value)
+            return value
+        return wrapper
+    return decorator
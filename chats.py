@@ -2,7 +2,11 @@
 Module to handle /chats API calls.
 """
 
-from jsonschema import validate
+import functools
+
+from pagination import select_page
+from schemas import validate
+from streaming import JSONArrayStream
 
 
 class ChatsAPI:
@@ -17,26 +21,12 @@ class ChatsAPI:
         :param data: json request parsed into data structure
         :returns: json response with inserted chat
         """
-        json_schema = {
-            'type': 'object',
-            'properties': {
-                'users': {'type': 'array',
-                          'items': {'type': 'integer'}
-                          },
-                'sym_key_enc_by_owners_pub_keys': {'type': 'array',
-                                                   'items': {'type': 'string'}
-                                                   },
-            },
-            'required': ['users', 'sym_key_enc_by_owners_pub_keys']
-        }
-
-        validate(data, json_schema)
+        validate(data, 'chats_post')
 
         users = data.get('users')
         sym_key_enc_by_owners_pub_keys = data.get('sym_key_enc_by_owners_pub_keys')
 
-        await self.my_db.insert_chat(users, sym_key_enc_by_owners_pub_keys)
-        chat_id = await self.my_db.get_last_chat()
+        chat_id = await self.my_db.insert_chat(users, sym_key_enc_by_owners_pub_keys)
 
         response = {
             'chat_id': chat_id,
@@ -52,15 +42,7 @@ class ChatsAPI:
         :param data: json request parsed into data structure
         :returns: json response with chat info
         """
-        json_schema = {
-            'type': 'object',
-            'properties': {
-                'chat_id': {'type': 'integer'},
-            },
-            'required': ['chat_id']
-        }
-
-        validate(data, json_schema)
+        validate(data, 'chats_get')
 
         chat_id = data.get('chat_id')
 
@@ -86,27 +68,32 @@ class ChatsUserAPI:
 
     async def process_get(self, api_version, data):  # pylint: disable=unused-argument
         """
-        Process the data in request and return info about particular chat.
+        Process the data in request and return chats of the user, ordered by their IDs.
+        With a limit, returns a page of chats and the cursor of the next one.
         :param data: json request parsed into data structure
         :returns: json response with chat info
         """
-        json_schema = {
-            'type': 'object',
-            'properties': {
-                'user_id': {'type': 'integer'},
-            },
-            'required': ['user_id']
-        }
-
-        validate(data, json_schema)
+        validate(data, 'chats_user_get')
 
         user_id = data.get('user_id')
-
-        db_response = await self.my_db.select_my_chats(user_id)
+        after = data.get('after')
+        before = data.get('before')
+        limit = data.get('limit')
+
+        next_cursor = None
+        if limit is not None:
+            chats, next_cursor = await select_page(
+                functools.partial(self.my_db.select_my_chats, user_id), 'id',
+                after=after, before=before, limit=limit)
+        elif after is not None or before is not None:
+            chats = await self.my_db.select_my_chats(user_id, after=after, before=before)
+        else:
+            chats = JSONArrayStream(await self.my_db.iter_my_chats(user_id))
 
         response = {
             'user_id': user_id,
-            'chats': db_response,
+            'chats': chats,
+            'next_cursor': next_cursor,
         }
 
         return response
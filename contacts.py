@@ -2,7 +2,10 @@
 Module to handle /contacts API calls.
 """
 
-from jsonschema import validate
+import functools
+
+from pagination import select_page
+from schemas import validate
 
 
 class ContactsAPI:
@@ -17,17 +20,7 @@ class ContactsAPI:
         :param data: json request parsed into data structure
         :returns: json response with inserted contact
         """
-        json_schema = {
-            'type': 'object',
-            'properties': {
-                'owner_id': {'type': 'integer'},
-                'user_id': {'type': 'integer'},
-                'encrypted_alias': {'type': 'string'},
-            },
-            'required': ['owner_id', 'user_id', 'encrypted_alias']
-        }
-
-        validate(data, json_schema)
+        validate(data, 'contacts_post')
 
         owner_id = data.get('owner_id')
         user_id = data.get('user_id')
@@ -47,25 +40,29 @@ class ContactsAPI:
         """
         Process the data in request and return info about particular contact.
         :param data: json request parsed into data structure
-        :returns: json response with all contacts of the given user
+        With a limit, returns a page of contacts and the cursor of the next one.
+        :returns: json response with contacts of the given user
         """
-        json_schema = {
-            'type': 'object',
-            'properties': {
-                'owner_id': {'type': 'integer'},
-            },
-            'required': ['owner_id']
-        }
-
-        validate(data, json_schema)
+        validate(data, 'contacts_get')
 
         owner_id = data.get('owner_id')
-
-        api_response = await self.my_db.select_my_contacts(owner_id)
+        after = data.get('after')
+        before = data.get('before')
+        limit = data.get('limit')
+
+        next_cursor = None
+        if limit is not None:
+            api_response, next_cursor = await select_page(
+                functools.partial(self.my_db.select_my_contacts, owner_id), 'user_id',
+                after=after, before=before, limit=limit)
+        else:
+            api_response = await self.my_db.select_my_contacts(owner_id, after=after,
+                                                               before=before)
 
         response = {
             'owner_id': owner_id,
             'contacts': api_response,
+            'next_cursor': next_cursor,
         }
 
         return response
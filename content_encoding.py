@@ -0,0 +1,86 @@
+"""
+Module to compress the responses with gzip or deflate.
+
+Responses of at least COMPRESS_MIN_LENGTH bytes are compressed when the client
+accepts either encoding. Streamed responses are compressed chunk by chunk when
+their first chunk is that long.
+"""
+
+import os
+import zlib
+
+import tornado.escape
+import tornado.web
+
+COMPRESS_MIN_LENGTH = int(os.getenv('COMPRESS_MIN_LENGTH', '1024'))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+
+# window bits selecting the container of the compressed data
+_ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def accepted_encoding(accept_encoding):
+    """
+    Choose the encoding for the Accept-Encoding header, preferring gzip.
+    :param accept_encoding: Value of the header, e.g. 'gzip, deflate;q=0.5'
+    :return: 'gzip', 'deflate' or None when the client accepts neither
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, parameters = item.partition(';')
+        quality = 1.0
+        parameter, _, value = parameters.partition('=')
+        if parameter.strip() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    accepted = [encoding for encoding in _ENCODINGS
+                if qualities.get(encoding, qualities.get('*', 0.0)) > 0]
+    return max(accepted, key=lambda encoding: qualities.get(encoding, 0.0), default=None)
+
+
+class CompressedContentEncoding(tornado.web.GZipContentEncoding):
+    """
+    Output transform applying the gzip or deflate content encoding.
+    Replaces tornado.web.GZipContentEncoding, which supports gzip only.
+    """
+
+    MIN_LENGTH = COMPRESS_MIN_LENGTH
+    GZIP_LEVEL = COMPRESS_LEVEL
+
+    def __init__(self, request):  # pylint: disable=super-init-not-called
+        self._encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+        self._gzipping = self._encoding is not None
+        self._compressor = None
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if self._gzipping:
+            ctype = tornado.escape.native_str(headers.get('Content-Type', '')).split(';')[0]
+            # the length of a streamed response is not known yet, a short first
+            # chunk is not worth compressing whether more follows or not
+            self._gzipping = self._compressible_type(ctype) and \
+                len(chunk) >= self.MIN_LENGTH and 'Content-Encoding' not in headers
+        if self._gzipping:
+            headers['Content-Encoding'] = self._encoding
+            self._compressor = zlib.compressobj(self.GZIP_LEVEL, zlib.DEFLATED,
+                                                _ENCODINGS[self._encoding])
+            chunk = self.transform_chunk(chunk, finishing)
+            if 'Content-Length' in headers:
+                if finishing:
+                    headers['Content-Length'] = str(len(chunk))
+                else:
+                    del headers['Content-Length']
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._gzipping:
+            # a sync flush lets the client decode every streamed chunk as it arrives
+            chunk = self._compressor.compress(chunk) + \
+                self._compressor.flush(zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+        return chunk
@@ -3,26 +3,49 @@ Module to handle database calls.
 """
 
 import asyncio
+import contextlib
+import functools
 import hashlib
 import os
+import tempfile
 import time
 from enum import Enum
+from operator import itemgetter
 
-import numpy
 import rsa
-from aiotinydb import AIOTinyDB
-from tinydb import Query, where
 
+from cache import LRUCache, read_through
 from database_error import DatabaseError
 from logging_utils import get_logger
+from metrics import DB_CALL_DURATION, time_coroutines
+from storage import DEFAULT_TABLE, Storage
 
 # TYPES
 # 1: users
 # 2: chats
 # 3: messages
 # 4: contacts
+# every type is stored in its own table, see DBType.table
 
 LOGGER = get_logger(__name__)
+_TIMESTAMP_STEP = 1e-6
+# last allocated IDs of the entities, {'name': table, 'value': last ID}
+_SEQUENCES_TABLE = 'sequences'
+PUBLIC_KEY_CACHE_SIZE = int(os.getenv('PUBLIC_KEY_CACHE_SIZE', '10000'))
+# users and chats cached by ID, they are never deleted, the TTL bounds the memory of idle ones
+ENTITY_CACHE_SIZE = int(os.getenv('ENTITY_CACHE_SIZE', '10000'))
+ENTITY_CACHE_TTL = float(os.getenv('ENTITY_CACHE_TTL', '300'))
+# 'json' or 'sqlite', by default chosen by the suffix of the database location
+DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', '')
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+# documents read at once by the iter_* coroutines
+ITER_CHUNK_SIZE = int(os.getenv('DB_ITER_CHUNK_SIZE', '100'))
+# messages older than this many seconds are removed, 0 keeps them forever
+MESSAGE_RETENTION_AGE = float(os.getenv('MESSAGE_RETENTION_AGE', '0'))
+# messages kept per chat, the oldest ones are removed first, 0 for no limit
+MESSAGE_RETENTION_COUNT = int(os.getenv('MESSAGE_RETENTION_COUNT', '0'))
+# messages removed by a single write of enforce_retention
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '500'))
 
 
 # all selects return strings
@@ -43,6 +66,23 @@ def input_validator(public_key, sign, json_data):
     return 1
 
 
+def _membership_key(users):
+    """Key of the chat members, equal for chats of the same users in any order."""
+    return tuple(sorted(users))
+
+
+def _retention_batch(count, expired, max_count, batch_size):
+    """
+    Return how many of the oldest messages of a chat to remove in the next batch.
+    :param count: Number of messages of the chat
+    :param expired: Number of messages older than the maximum age, at most batch_size
+    :param max_count: Number of messages kept per chat, 0 for no limit
+    :param batch_size: Maximum number of messages removed at once
+    """
+    over_count = count - max_count if max_count else 0
+    return min(max(expired, over_count, 0), batch_size)
+
+
 def _get_default_db_path():
     project_root = os.path.dirname(os.path.abspath(__file__))
     full_path = project_root + '/.data/db.json'
@@ -58,17 +98,268 @@ class DBType(Enum):
     MESSAGES = 3
     CONTACTS = 4
 
+    @property
+    def table(self):
+        """Name of the storage table holding records of this type."""
+        return self.name.lower()
+
+
+class EntityLocks:
+    """
+    Asyncio locks of database entities, created on demand and dropped once unused.
+    """
+
+    def __init__(self):
+        # key: [lock, number of coroutines holding or waiting for the lock]
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, keys):
+        """
+        Hold the locks of all the keys.
+        :param keys: Hashable keys of the locked entities
+        """
+        held = []
+        try:
+            # always lock in the same order, so that coroutines do not deadlock
+            for key in sorted(set(keys), key=repr):
+                entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+                entry[1] += 1
+                try:
+                    await entry[0].acquire()
+                except BaseException:
+                    self._leave(key)
+                    raise
+                held.append(key)
+            yield
+        finally:
+            for key in reversed(held):
+                self._locks[key][0].release()
+                self._leave(key)
+
+    def _leave(self, key):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def _write_transaction(lock_keys):
+    """
+    Run the DB method under the locks of the entities it changes and in a storage
+    transaction, so that neither coroutines nor processes sharing the storage clash.
+    The method returns once its changes are durable.
+    :param lock_keys: Callable taking the arguments of the method and returning the lock keys
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            # pylint: disable=protected-access
+            async with self._locks.hold(lock_keys(*args, **kwargs)):
+                with self._storage.transaction():
+                    result = await method(self, *args, **kwargs)
+            # outside of the locks, so that writers of the same entity share the fsync
+            await self._storage.wait_durable()
+            return result
+
+        return wrapper
+
+    return decorator
+
 
-class DB:
+@time_coroutines(DB_CALL_DURATION)
+class DB:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """
     Database class for handling the database queries
     """
 
-    def __init__(self, db_string=_get_default_db_path()):
+    def __init__(self, db_string=_get_default_db_path(),
+                 public_key_cache_size=PUBLIC_KEY_CACHE_SIZE, shared=False):
         self.db_string = db_string
-        self.query = Query()
+        self.public_keys = LRUCache(public_key_cache_size)
+        self.users = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        self.chats = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        # all contacts of a user by the owner ID
+        self.contacts = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        self._message_listeners = []
+        self._locks = EntityLocks()
+        self._storage = Storage(db_string, shared=shared)
+        if self._storage.count(DEFAULT_TABLE):
+            self._storage.close()
+            raise DatabaseError(reason='Database {} uses the single table layout, '
+                                       'convert it with migrate_db.py first.'.format(db_string))
+        self._create_indexes()
+        self._storage.add_listener(self._on_change)
         LOGGER.info('Using database located at %s', db_string)
 
+    def _on_change(self, table_name, document, remote, removed):
+        if table_name == DBType.USERS.table:
+            self.public_keys.invalidate(document['id'])
+            self.users.invalidate(document['id'])
+        elif table_name == DBType.CHATS.table:
+            self.chats.invalidate(document['id'])
+        elif table_name == DBType.CONTACTS.table:
+            self.contacts.invalidate(document['owner_id'])
+        elif table_name == DBType.MESSAGES.table and remote and not removed:
+            for callback in self._message_listeners:
+                callback(document)
+
+    def add_message_listener(self, callback):
+        """
+        Call the callback with every message inserted by another process sharing the database.
+        :param callback: Callable taking the inserted message
+        """
+        self._message_listeners.append(callback)
+
+    async def refresh(self):
+        """Apply the changes made by other processes sharing the database."""
+        self._storage.refresh()
+
+    def cache_stats(self):
+        """Return the statistics of the caches of the database."""
+        return {'users': self.users.stats(), 'chats': self.chats.stats(),
+                'contacts': self.contacts.stats(), 'public_keys': self.public_keys.stats()}
+
+    def file_size(self):
+        """Return the size of the database file and of its write-ahead log in bytes."""
+        return sum(os.path.getsize(path) for path in (self._storage.path, self._storage.wal_path)
+                   if os.path.exists(path))
+
+    def _create_indexes(self):
+        storage = self._storage
+        storage.create_index(DBType.USERS.table, 'id', itemgetter('id'))
+        storage.create_index(DBType.USERS.table, 'public_key', itemgetter('public_key'))
+        storage.create_index(DBType.CHATS.table, 'id', itemgetter('id'))
+        storage.create_index(DBType.CHATS.table, 'users', itemgetter('users'), multi=True,
+                             sort_key=itemgetter('id'))
+        storage.create_index(DBType.CHATS.table, 'members',
+                             lambda chat: _membership_key(chat['users']))
+        storage.create_index(DBType.MESSAGES.table, 'chat_id', itemgetter('chat_id'),
+                             sort_key=itemgetter('timestamp'))
+        storage.create_index(DBType.CONTACTS.table, 'contact', itemgetter('owner_id', 'user_id'))
+        storage.create_index(DBType.CONTACTS.table, 'owner_id', itemgetter('owner_id'),
+                             sort_key=itemgetter('user_id'))
+        storage.create_index(_SEQUENCES_TABLE, 'name', itemgetter('name'))
+
+    def close(self):
+        """Persist all pending changes and release the database file."""
+        self._storage.close()
+
+    async def data_version(self, *db_types):
+        """
+        Return a token which changes whenever any of the tables changes, e.g. to build ETags.
+        :param db_types: DBType of the tables
+        """
+        return '-'.join(self._storage.version(db_type.table) for db_type in db_types)
+
+    async def compact(self):
+        """
+        Fold the write-ahead log, including the records of removed documents, into the
+        database file, which is written in a thread.
+        :return: True if the database was compacted
+        """
+        if not self._storage.wal_records:
+            return False
+        return await self._storage.compact()
+
+    async def enforce_retention(self, max_age=MESSAGE_RETENTION_AGE,
+                                max_count=MESSAGE_RETENTION_COUNT,
+                                batch_size=RETENTION_BATCH_SIZE):
+        """
+        Remove the messages older than max_age and the oldest messages of chats with
+        more than max_count of them. At most batch_size messages are removed by one
+        write, other coroutines run between the writes.
+        :param max_age: Maximum age of messages in seconds, 0 for no limit
+        :param max_count: Number of messages kept per chat, 0 for no limit
+        :param batch_size: Maximum number of messages removed at once
+        :return: Number of removed messages
+        """
+        if not max_age and not max_count:
+            return 0
+        oldest_kept = time.time() - max_age if max_age else None
+        removed = 0
+        for chat_id in self._storage.index_keys(DBType.MESSAGES.table, 'chat_id'):
+            while True:
+                batch = await self._remove_old_messages(chat_id, oldest_kept, max_count,
+                                                        batch_size)
+                removed += batch
+                await asyncio.sleep(0)
+                if batch < batch_size:
+                    break
+        return removed
+
+    @_write_transaction(lambda chat_id, oldest_kept, max_count, batch_size:
+                        [(DBType.MESSAGES.table, chat_id)])
+    async def _remove_old_messages(self, chat_id, oldest_kept, max_count, batch_size):
+        table = DBType.MESSAGES.table
+        expired = 0
+        if oldest_kept is not None:
+            expired = len(self._storage.lookup_range(table, 'chat_id', chat_id,
+                                                     before=oldest_kept, limit=batch_size))
+        batch = _retention_batch(self._storage.index_count(table, 'chat_id', chat_id),
+                                 expired, max_count, batch_size)
+        if batch:
+            self._storage.remove_many(table, [doc_id for doc_id, _ in self._storage.lookup_range(
+                table, 'chat_id', chat_id, limit=batch)])
+        return batch
+
+    def _lookup(self, db_type, index_name, key):
+        return [document for _, document in self._storage.lookup(db_type.table, index_name, key)]
+
+    def _get(self, db_type, index_name, key):
+        found = self._storage.lookup(db_type.table, index_name, key)
+        return found[0][1] if found else None
+
+    def _exist(self, db_type, index_name, key):
+        return bool(self._storage.lookup(db_type.table, index_name, key))
+
+    async def _iter_range(self, db_type, index_name, key,  # pylint: disable=too-many-arguments
+                          sort_field, *, after=None, chunk_size=ITER_CHUNK_SIZE):
+        """Yield the documents of an ordered index, reading chunk_size of them at once."""
+        while True:
+            found = self._storage.lookup_range(db_type.table, index_name, key, after=after,
+                                               limit=chunk_size)
+            for _, document in found:
+                yield document
+            if len(found) < chunk_size:
+                return
+            after = found[-1][1][sort_field]
+
+    def _range(self, db_type, index_name, key, *, after=None, before=None, limit=None):  # pylint: disable=too-many-arguments
+        """
+        Return the documents of an ordered index within the range of the sort key.
+        With a limit, the documents closest to before are returned when it is given,
+        the ones closest to after otherwise, always ordered by the sort key.
+        """
+        return [document for _, document in self._storage.lookup_range(
+            db_type.table, index_name, key, after=after, before=before, limit=limit,
+            from_end=before is not None)]
+
+    def _next_id(self, db_type):
+        """
+        Allocate a new ID of the entity. The last allocated ID is stored with the data,
+        so IDs are never handed out twice, not even after the entity was deleted.
+        :param db_type: Type of the entity
+        :return: The allocated ID
+        """
+        with self._storage.transaction():
+            found = self._storage.lookup(_SEQUENCES_TABLE, 'name', db_type.table)
+            if found:
+                doc_id, sequence = found[0]
+                new_id = sequence['value'] + 1
+                self._storage.update(_SEQUENCES_TABLE, doc_id, {'value': new_id})
+            else:
+                # databases written before the sequences were introduced
+                new_id = max(self._storage.index_keys(db_type.table, 'id'), default=0) + 1
+                self._storage.insert(_SEQUENCES_TABLE, {'name': db_type.table,
+                                                        'value': new_id})
+        return new_id
+
+    @_write_transaction(lambda user_id, public_key: [DBType.USERS.table])
     async def insert_user(self, user_id, public_key):
         """
         Insert a new user to database.
@@ -76,97 +367,98 @@ class DB:
         :param public_key: Public key of user
         :return: 0 if the user was added, else 1
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            if my_db.contains((where('type') == DBType.USERS.value) & (where('id') == user_id)):
-                raise DatabaseError(reason=
-                                    'Can not insert user into the database. '
-                                    'User with ID "{}" already exist.'.format(user_id))
-
-            if await self.user_pubkey_exist(public_key):
-                raise DatabaseError(reason='Can not insert user into the database. '
-                                           'User with public key "{}" already exist.'
-                                    .format(public_key))
-            my_db.insert({'type': DBType.USERS.value,
-                          'id': user_id,
-                          'public_key': public_key})
-
-            return
-
+        if self._get(DBType.USERS, 'id', user_id):
+            raise DatabaseError(reason=
+                                'Can not insert user into the database. '
+                                'User with ID "{}" already exist.'.format(user_id))
+
+        if await self.user_pubkey_exist(public_key):
+            raise DatabaseError(reason='Can not insert user into the database. '
+                                       'User with public key "{}" already exist.'
+                                .format(public_key))
+        self._storage.insert(DBType.USERS.table, {'type': DBType.USERS.value,
+                                                  'id': user_id,
+                                                  'public_key': public_key})
+
+    @read_through('users')
     async def select_user(self, user_id):
         """
-        Return the user that was searched.
+        Return the user that was searched, cached by user ID.
         :param user_id: Users ID
         :return: user
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            return my_db.get((where('type') == DBType.USERS.value) & (where('id') == user_id))
+        return self._get(DBType.USERS, 'id', user_id)
+
+    async def select_public_key(self, user_id):
+        """
+        Return the parsed public key of the user, cached by user ID.
+        :param user_id: Users ID
+        :return: rsa.PublicKey of the user
+        """
+        public_key = self.public_keys.get(user_id)
+        if public_key is None:
+            user = await self.select_user(user_id)
+            if not user:
+                raise DatabaseError(reason='User with ID {} not found in the database.'
+                                    .format(user_id))
+            public_key = rsa.PublicKey.load_pkcs1(user['public_key'])
+            self.public_keys.put(user_id, public_key)
+        return public_key
 
     async def user_pubkey_exist(self, pubkey):
         """Check if the given pubkey exist in the database.
         :param pubkey: Public key of the user
         :return: True if the public key is found in the database, false otherwise
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            exist = my_db.contains((where('type') == DBType.USERS.value) &
-                                   (where('public_key') == pubkey))
-            return exist
+        return self._exist(DBType.USERS, 'public_key', pubkey)
 
     async def select_all_user_ids(self):
         """
         Get all user ids and return them.
         :return: array: all user IDs stored in the database in
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            all_users = my_db.search(where('type') == DBType.USERS.value)
-            user_ids = []
-            for user in all_users:
-                user_ids.append(user['id'])
-            return user_ids
+        return self._storage.index_keys(DBType.USERS.table, 'id')
 
+    @_write_transaction(lambda users, sym_key_enc_by_owners_pub_keys:
+                        [(DBType.CHATS.table, _membership_key(users))])
     async def insert_chat(self, users, sym_key_enc_by_owners_pub_keys):
         """
         Inserts the new entry to the particular chat.
         :param users: IDs of users in chat
         :param sym_key_enc_by_owners_pub_keys: encrypted symmetric keys using public keys of user
-        :return: 0 if the chat was inserted into the database, else 1
-        """
-        async with AIOTinyDB(self.db_string) as my_db:
-            chat_id = await self.get_last_chat() + 1
-            all_user_ids = await self.select_all_user_ids()
-            try:
-                # check that the users are present in the DB
-                assert set(users).issubset(all_user_ids)
-            except AssertionError:
-                # show which users are not in the DB
-                all_user_ids_str = [str(x) for x in all_user_ids]
-                users_str = [str(x) for x in users]
-                users_diff = ','.join(numpy.setdiff1d(users_str, all_user_ids_str))
-                raise DatabaseError(reason=
-                                    'Can not insert chat into the database. '
-                                    'User/users {} not found in the database.'.format(users_diff))
-            # check for the duplicate chats
-            chats = my_db.search((where('type') == DBType.CHATS.value))
-            users_sorted = sorted(users)
-            for chat in chats:
-                if sorted(chat['users']) == users_sorted:
-                    raise DatabaseError(reason=
-                                        'Can not insert chat into the database. '
-                                        'Chat with users "{}" already exist.'
-                                        .format(','.join(str(x) for x in users)))
-
-            try:
-                # check if we have the same count for users as for symmetric keys
-                assert len(users) == len(sym_key_enc_by_owners_pub_keys)
-            except AssertionError:
-                raise DatabaseError(reason=
-                                    'Can not insert chat into the database. '
-                                    'Number of users should be the same as number of '
-                                    'symmetric keys.')
-
-            my_db.insert({'type': DBType.CHATS.value,
-                          'id': chat_id,
-                          'users': users,
-                          'sym_key_enc_by_owners_pub_keys': sym_key_enc_by_owners_pub_keys})
+        :return: ID of the inserted chat
+        """
+        # check that the users are present in the DB
+        missing_users = {str(user_id) for user_id in users
+                         if not await self.select_user(user_id)}
+        if missing_users:
+            raise DatabaseError(reason=
+                                'Can not insert chat into the database. '
+                                'User/users {} not found in the database.'
+                                .format(','.join(sorted(missing_users))))
+        # check for the duplicate chats
+        if self._exist(DBType.CHATS, 'members', _membership_key(users)):
+            raise DatabaseError(reason=
+                                'Can not insert chat into the database. '
+                                'Chat with users "{}" already exist.'
+                                .format(','.join(str(x) for x in users)))
+
+        try:
+            # check if we have the same count for users as for symmetric keys
+            assert len(users) == len(sym_key_enc_by_owners_pub_keys)
+        except AssertionError:
+            raise DatabaseError(reason=
+                                'Can not insert chat into the database. '
+                                'Number of users should be the same as number of '
+                                'symmetric keys.')
+
+        chat_id = self._next_id(DBType.CHATS)
+        self._storage.insert(DBType.CHATS.table, {'type': DBType.CHATS.value,
+                                                  'id': chat_id,
+                                                  'users': users,
+                                                  'sym_key_enc_by_owners_pub_keys':
+                                                      sym_key_enc_by_owners_pub_keys})
+        return chat_id
 
     async def select_chat(self, chat_id):
         """
@@ -174,26 +466,39 @@ class DB:
         :param chat_id: ID of chat
         :return: Chat that was searched for user's id
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            db_response = my_db.get((where('type') == DBType.CHATS.value) &
-                                    (where('id') == chat_id))
-            if not db_response:
-                raise DatabaseError(reason='Chat with ID {} does not exist in the database.'
-                                    .format(chat_id))
-            return db_response
+        db_response = await self._select_chat(chat_id)
+        if not db_response:
+            raise DatabaseError(reason='Chat with ID {} does not exist in the database.'
+                                .format(chat_id))
+        return db_response
 
-    async def select_my_chats(self, my_id):
+    async def select_my_chats(self, my_id, after=None, before=None, limit=None):
         """
-        Return the chats for the particular user.
+        Return the chats for the particular user, ordered by chat ID.
         :param my_id: User ID
+        :param after: Return only chats with a higher ID
+        :param before: Return only chats with a lower ID
+        :param limit: Maximum number of chats, the closest to before if given, else to after
         :return: Chats ID for the particular user
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            if not await self.select_user(my_id):
-                raise DatabaseError(reason='User with ID {} not found in the database.'
-                                    .format(my_id))
-            return my_db.search(
-                (where('type') == DBType.CHATS.value) & ((where('users').any([my_id]))))
+        if not await self.select_user(my_id):
+            raise DatabaseError(reason='User with ID {} not found in the database.'
+                                .format(my_id))
+        return self._range(DBType.CHATS, 'users', my_id,
+                           after=after, before=before, limit=limit)
+
+    async def iter_my_chats(self, my_id, chunk_size=ITER_CHUNK_SIZE):
+        """
+        Return the chats of the user as an asynchronous iterator, ordered by chat ID.
+        Only chunk_size chats are held in memory at once.
+        :param my_id: User ID
+        :param chunk_size: Number of chats read at once
+        :return: Asynchronous iterator of chats
+        """
+        if not await self.select_user(my_id):
+            raise DatabaseError(reason='User with ID {} not found in the database.'
+                                .format(my_id))
+        return self._iter_range(DBType.CHATS, 'users', my_id, 'id', chunk_size=chunk_size)
 
     async def get_last_chat(self):
         """
@@ -207,9 +512,11 @@ class DB:
         Check whether the chat exist.
         :return: true if the chat exist, false otherwise
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            return my_db.contains((where('type') == DBType.CHATS.value) &
-                                  (where('id') == chat_id))
+        return await self._select_chat(chat_id) is not None
+
+    @read_through('chats')
+    async def _select_chat(self, chat_id):
+        return self._get(DBType.CHATS, 'id', chat_id)
 
     async def insert_message(self, chat_id, sender_id, message):
         """
@@ -217,36 +524,93 @@ class DB:
         :param chat_id: Chat of ID
         :param sender_id: ID of user that sends message
         :param message: Message content (encrypted)
-        :return: Returns nothing
+        :return: Timestamp of the message, unique and increasing within the chat
+        """
+        timestamps = await self.insert_messages([{'chat_id': chat_id,
+                                                  'sender_id': sender_id,
+                                                  'message': message}])
+        return timestamps[0]
+
+    @_write_transaction(lambda messages: [(DBType.MESSAGES.table, item['chat_id'])
+                                          for item in messages])
+    async def insert_messages(self, messages):
+        """
+        Insert messages, possibly into several chats, in a single write.
+        Either all the messages are inserted or none of them.
+        :param messages: list of dicts with chat_id, sender_id and message
+        :return: Timestamps of the messages, unique and increasing within each chat
         """
-        async with AIOTinyDB(self.db_string) as my_db:
+        last_timestamps = {}
+        documents = []
+        for item in messages:
+            chat_id = item['chat_id']
+            sender_id = item['sender_id']
             if not await self.select_user(sender_id):
                 raise DatabaseError(reason='User with ID {} not found in the database.'
                                     .format(sender_id))
             if not await self.chat_id_exist(chat_id):
                 raise DatabaseError(reason='Chat with ID {} not found in the database.'
                                     .format(chat_id))
-            timestamp = time.time()
-            my_db.insert({'type': DBType.MESSAGES.value,
-                          'chat_id': chat_id,
-                          'sender_id': sender_id,
-                          'timestamp': timestamp,
-                          'message': message})
-            return timestamp
-
-    async def select_my_messages(self, chat_id):
+            if chat_id not in last_timestamps:
+                last_message = self._storage.lookup_last(DBType.MESSAGES.table, 'chat_id',
+                                                         chat_id)
+                last_timestamps[chat_id] = last_message['timestamp'] if last_message else 0
+            # timestamps serve as cursors, keep them strictly increasing within the chat
+            timestamp = max(time.time(), last_timestamps[chat_id] + _TIMESTAMP_STEP)
+            last_timestamps[chat_id] = timestamp
+            documents.append({'type': DBType.MESSAGES.value,
+                              'chat_id': chat_id,
+                              'sender_id': sender_id,
+                              'timestamp': timestamp,
+                              'message': item['message']})
+        self._storage.insert_many(DBType.MESSAGES.table, documents)
+        return [document['timestamp'] for document in documents]
+
+    async def select_my_messages(self, chat_id, after=None, before=None, limit=None):
         """
-        TODO
+        Return messages of the chat ordered by their timestamps.
         :param chat_id: ID of chat
+        :param after: Return only messages newer than this timestamp (cursor)
+        :param before: Return only messages older than this timestamp
+        :param limit: Maximum number of messages, the closest to before if given, else to after
         :return: Returns json of all messages in chat
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            if not await self.chat_id_exist(chat_id):
-                raise DatabaseError(reason='Chat with ID {} not found in the database.'
-                                    .format(chat_id))
-            return my_db.search((where('type') == DBType.MESSAGES.value) &
-                                (where('chat_id') == chat_id))
+        if not await self.chat_id_exist(chat_id):
+            raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                .format(chat_id))
+        return self._range(DBType.MESSAGES, 'chat_id', chat_id,
+                           after=after, before=before, limit=limit)
+
+    async def iter_my_messages(self, chat_id, after=None, chunk_size=ITER_CHUNK_SIZE):
+        """
+        Return messages of the chat as an asynchronous iterator, ordered by their timestamps.
+        Only chunk_size messages are held in memory at once.
+        :param chat_id: ID of chat
+        :param after: Return only messages newer than this timestamp (cursor)
+        :param chunk_size: Number of messages read at once
+        :return: Asynchronous iterator of messages
+        """
+        if not await self.chat_id_exist(chat_id):
+            raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                .format(chat_id))
+        return self._iter_range(DBType.MESSAGES, 'chat_id', chat_id, 'timestamp',
+                                after=after, chunk_size=chunk_size)
 
+    async def has_new_messages(self, chat_id, after=None):
+        """
+        Check whether the chat has messages newer than the cursor.
+        :param chat_id: ID of chat
+        :param after: Timestamp of the last seen message (cursor)
+        :return: True if there are newer messages, False otherwise
+        """
+        if not await self.chat_id_exist(chat_id):
+            raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                .format(chat_id))
+        last_message = self._storage.lookup_last(DBType.MESSAGES.table, 'chat_id', chat_id)
+        return last_message is not None and (after is None or last_message['timestamp'] > after)
+
+    @_write_transaction(lambda owner_id, user_id, encrypted_alias:
+                        [(DBType.CONTACTS.table, owner_id)])
     async def insert_contact(self, owner_id, user_id, encrypted_alias):
         """
         Inserts a contact into the database.
@@ -255,45 +619,57 @@ class DB:
         :param encrypted_alias: Encrypted alias of contact
         :return: 0 if the user was successfully inserted, else 1
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            if (my_db.contains(
-                    (where('type') == DBType.CONTACTS.value) & (where('owner_id') == owner_id) &
-                    (where('user_id') == user_id))):
-                raise DatabaseError(reason=
-                                    'Can not insert contact into the database. User with ID '
-                                    '{} already exist in the contacts for the user with ID {}.'
-                                    .format(user_id, owner_id))
-            if not await self.select_user(owner_id):
-                raise DatabaseError(reason=
-                                    'Can not insert contact into the database. User with ID '
-                                    '{} does not exist in the database.'.format(owner_id))
-            if not await self.select_user(user_id):
-                raise DatabaseError(reason=
-                                    'Can not insert contact into the database. User with ID '
-                                    '{} does not exist in the database.'.format(user_id))
-            my_db.insert({'type': DBType.CONTACTS.value, 'owner_id': owner_id,
-                          'user_id': user_id, 'alias': encrypted_alias})
-
-    async def select_my_contacts(self, owner_id):
-        """
-        TODO
+        if self._get(DBType.CONTACTS, 'contact', (owner_id, user_id)):
+            raise DatabaseError(reason=
+                                'Can not insert contact into the database. User with ID '
+                                '{} already exist in the contacts for the user with ID {}.'
+                                .format(user_id, owner_id))
+        if not await self.select_user(owner_id):
+            raise DatabaseError(reason=
+                                'Can not insert contact into the database. User with ID '
+                                '{} does not exist in the database.'.format(owner_id))
+        if not await self.select_user(user_id):
+            raise DatabaseError(reason=
+                                'Can not insert contact into the database. User with ID '
+                                '{} does not exist in the database.'.format(user_id))
+        self._storage.insert(DBType.CONTACTS.table, {'type': DBType.CONTACTS.value,
+                                                     'owner_id': owner_id,
+                                                     'user_id': user_id,
+                                                     'alias': encrypted_alias})
+
+    async def select_my_contacts(self, owner_id, after=None, before=None, limit=None):
+        """
+        Return contacts of the user, ordered by the user ID of the contact.
         :param owner_id: User ID which wants his contacts.
+        :param after: Return only contacts with a higher user ID
+        :param before: Return only contacts with a lower user ID
+        :param limit: Maximum number of contacts, the closest to before if given, else to after
         :return: Returns user's contacts in json.
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            if not await self.select_user(owner_id):
-                raise DatabaseError(reason='User with ID {} does not exist in the database.'
-                                    .format(owner_id))
-            return my_db.search((where('type') == DBType.CONTACTS.value)
-                                & (where('owner_id') == owner_id))
-
+        if not await self.select_user(owner_id):
+            raise DatabaseError(reason='User with ID {} does not exist in the database.'
+                                .format(owner_id))
+        if after is None and before is None and limit is None:
+            return list(await self._select_all_contacts(owner_id))
+        return self._range(DBType.CONTACTS, 'owner_id', owner_id,
+                           after=after, before=before, limit=limit)
+
+    @read_through('contacts')
+    async def _select_all_contacts(self, owner_id):
+        return self._range(DBType.CONTACTS, 'owner_id', owner_id)
+
+    @_write_transaction(lambda owner_id, user_id: [(DBType.CONTACTS.table, owner_id)])
     async def delete_my_contact(self, owner_id, user_id):
         """Delete contact of the selected user."""
-        async with AIOTinyDB(self.db_string) as my_db:
-            return my_db.remove(
-                (where('type') == DBType.CONTACTS.value) & (where('owner_id') == owner_id) &
-                (where('user_id') == user_id))
-
+        removed = []
+        for doc_id, _ in self._storage.lookup(DBType.CONTACTS.table, 'contact',
+                                                 (owner_id, user_id)):
+            self._storage.remove(DBType.CONTACTS.table, doc_id)
+            removed.append(doc_id)
+        return removed
+
+    @_write_transaction(lambda owner_id, user_id, new_alias:
+                        [(DBType.CONTACTS.table, owner_id)])
     async def alter_my_contact(self, owner_id, user_id, new_alias):
         """
         Alters the contact for the specified user.
@@ -302,127 +678,174 @@ class DB:
         :param new_alias: New alias for user in contact
         :return: Nothing
         """
-        async with AIOTinyDB(self.db_string) as my_db:
-            results = my_db.search(
-                (where('type') == DBType.CONTACTS.value) &
-                (where('owner_id') == owner_id) &
-                (where('user_id') == user_id))
-            for result in results:
-                result['alias'] = new_alias
-            my_db.write_back(results)
+        for doc_id, _ in self._storage.lookup(DBType.CONTACTS.table, 'contact',
+                                                 (owner_id, user_id)):
+            self._storage.update(DBType.CONTACTS.table, doc_id, {'alias': new_alias})
 
-    async def __get_last_entity_id(self, entity, entity_id_name):
-        async with AIOTinyDB(self.db_string) as my_db:
-            db_search = my_db.search(where('type') == entity.value)
-            if not db_search:
-                return 0
-            sorted_entities = sorted(db_search, key=lambda entity_id: entity_id[entity_id_name])
-            return sorted_entities[-1].get(entity_id_name)
+    async def __get_last_entity_id(self, entity, entity_index_name):
+        return max(self._storage.index_keys(entity.table, entity_index_name), default=0)
 
 
-if __name__ == "__main__":
-    DATABASE = DB()
-    LOOP = asyncio.new_event_loop()
-
-    USER1 = {'user_id': 123, 'public_key': 'public_key_data'}
-    USER2 = {'user_id': 123456, 'public_key': 'public_key_data2'}
-    CONTACT1 = {'owner_id': USER1.get('user_id'),
-                'user_id': USER2.get('user_id'),
+def open_database(db_string, backend=DATABASE_BACKEND, **kwargs):
+    """
+    Open the database using the backend.
+    :param db_string: Location of the database
+    :param backend: 'json' for DB, 'sqlite' for sqlite_db.SQLiteDB, empty to choose by the suffix
+    :param kwargs: Passed to the database class
+    :return: DB or SQLiteDB instance
+    """
+    if not backend:
+        backend = 'sqlite' if db_string.endswith(SQLITE_SUFFIXES) else 'json'
+    if backend == 'json':
+        return DB(db_string, **kwargs)
+    if backend == 'sqlite':
+        # sqlite_db builds on this module
+        from sqlite_db import SQLiteDB  # pylint: disable=import-outside-toplevel,cyclic-import
+        return SQLiteDB(db_string, **kwargs)
+    raise ValueError('Unknown database backend "{}", use "json" or "sqlite".'.format(backend))
+
+
+async def run_scenario(database):  # pylint: disable=too-many-locals,too-many-statements
+    """
+    Exercise the coroutines of the database and check what they return.
+    :param database: Empty database of any backend
+    :return: Documents read back, equal for all backends apart from message timestamps
+    """
+    user1 = {'user_id': 123, 'public_key': 'public_key_data'}
+    user2 = {'user_id': 123456, 'public_key': 'public_key_data2'}
+    contact1 = {'owner_id': user1.get('user_id'),
+                'user_id': user2.get('user_id'),
                 'encrypted_alias': 'USER2 in contacts of USER1'}
-    CONTACT2 = {'owner_id': USER2.get('user_id'),
-                'user_id': USER1.get('user_id'),
+    contact2 = {'owner_id': user2.get('user_id'),
+                'user_id': user1.get('user_id'),
                 'encrypted_alias': 'USER1 in contacts of USER2'}
-    CHAT1 = {'users': [USER1.get('user_id'), USER2.get('user_id')],
-             'sym_key_enc_by_owners_pub_keys': [USER1.get('public_key_encrypted'),
-                                                USER2.get('public_key_encrypted')]}
-    MESSAGES = [{'chat_id': CHAT1.get('chat_id'),
-                 'sender_id': CHAT1.get('users')[0],
+    chat1 = {'users': [user1.get('user_id'), user2.get('user_id')],
+             'sym_key_enc_by_owners_pub_keys': [user1.get('public_key_encrypted'),
+                                                user2.get('public_key_encrypted')]}
+    messages = [{'sender_id': chat1.get('users')[0],
                  'message': "Hi there!"},
-                {'chat_id': CHAT1.get('chat_id'),
-                 'sender_id': CHAT1.get('users')[1],
+                {'sender_id': chat1.get('users')[1],
                  'message': 'Oh hi! I have some news for you!'},
-                {'chat_id': CHAT1.get('chat_id'),
-                 'sender_id': CHAT1.get('users')[0],
+                {'sender_id': chat1.get('users')[0],
                  'message': 'I am curious, tell me...'},
-                {'chat_id': CHAT1.get('chat_id'),
-                 'sender_id': CHAT1.get('users')[1],
+                {'sender_id': chat1.get('users')[1],
                  'message': 'We are not real... :-('}
                 ]
+    results = {}
 
-    LOOP.run_until_complete(DATABASE.insert_user(USER1.get('user_id'),
-                                                 USER1.get('public_key')))
+    await database.insert_user(user1.get('user_id'), user1.get('public_key'))
     try:
-        LOOP.run_until_complete(DATABASE.insert_user(USER1.get('user_id'),
-                                                     USER1.get('public_key')))
-    except DatabaseError:
-        print('Duplicate user won\'t be added.')
-
-    LOOP.run_until_complete(DATABASE.insert_user(USER2.get('user_id'),
-                                                 USER2.get('public_key')))
-
-    GET_USER2 = LOOP.run_until_complete(DATABASE.select_user(USER2.get('user_id')))
-    print(GET_USER2)
-    ASSERTION = GET_USER2.get('id') == USER2.get('user_id') and \
-                GET_USER2.get('public_key') == USER2.get('public_key')
-    assert ASSERTION
-
-    LOOP.run_until_complete(DATABASE.insert_contact(CONTACT1.get('owner_id'),
-                                                    CONTACT1.get('user_id'),
-                                                    CONTACT1.get('encrypted_alias')))
-    LOOP.run_until_complete(DATABASE.insert_contact(CONTACT2.get('owner_id'),
-                                                    CONTACT2.get('user_id'),
-                                                    CONTACT2.get('encrypted_alias')))
+        await database.insert_user(user1.get('user_id'), user1.get('public_key'))
+        raise AssertionError('Duplicate user was added.')
+    except DatabaseError as error:
+        results['duplicate_user'] = error.reason
+
+    await database.insert_user(user2.get('user_id'), user2.get('public_key'))
+
+    get_user2 = results['user'] = await database.select_user(user2.get('user_id'))
+    assert get_user2.get('id') == user2.get('user_id') and \
+        get_user2.get('public_key') == user2.get('public_key')
+
+    users_version = await database.data_version(DBType.USERS)
+    contacts_version = await database.data_version(DBType.CONTACTS)
+    await database.insert_contact(contact1.get('owner_id'), contact1.get('user_id'),
+                                  contact1.get('encrypted_alias'))
+    assert await database.data_version(DBType.USERS) == users_version
+    assert await database.data_version(DBType.CONTACTS) != contacts_version
+    await database.insert_contact(contact2.get('owner_id'), contact2.get('user_id'),
+                                  contact2.get('encrypted_alias'))
     try:
-        LOOP.run_until_complete(DATABASE.insert_contact(CONTACT1.get('owner_id'),
-                                                        CONTACT1.get('user_id'),
-                                                        CONTACT1.get('encrypted_alias')))
-    except DatabaseError:
-        print('Duplicate contact won\'t be added')
-
-    RESULT = LOOP.run_until_complete(DATABASE.select_my_contacts(USER2.get('user_id')))
-    print(RESULT[0])
-
-    ALTERED_FIELD = CONTACT2.get('encrypted_alias') + '_changed'
-    LOOP.run_until_complete(DATABASE.alter_my_contact(CONTACT2.get('owner_id'),
-                                                      CONTACT2.get('user_id'),
-                                                      ALTERED_FIELD))
-
-    RESULT = LOOP.run_until_complete(DATABASE.select_my_contacts(USER2.get('user_id')))
-    assert RESULT[0].pop('alias') == ALTERED_FIELD
-
-    LOOP.run_until_complete(DATABASE.delete_my_contact(CONTACT1.get('owner_id'),
-                                                       CONTACT1.get('user_id')))
+        await database.insert_contact(contact1.get('owner_id'), contact1.get('user_id'),
+                                      contact1.get('encrypted_alias'))
+        raise AssertionError('Duplicate contact was added.')
+    except DatabaseError as error:
+        results['duplicate_contact'] = error.reason
+
+    results['contacts'] = await database.select_my_contacts(user2.get('user_id'))
+    assert await database.select_my_contacts(user2.get('user_id'), before=contact2.get('user_id'),
+                                             limit=1) == []
+
+    altered_field = contact2.get('encrypted_alias') + '_changed'
+    await database.alter_my_contact(contact2.get('owner_id'), contact2.get('user_id'),
+                                    altered_field)
+    altered_contacts = results['altered_contacts'] = \
+        await database.select_my_contacts(user2.get('user_id'))
+    assert altered_contacts[0].get('alias') == altered_field
+
+    await database.delete_my_contact(contact1.get('owner_id'), contact1.get('user_id'))
+    results['deleted_contacts'] = await database.select_my_contacts(user1.get('user_id'))
+    assert not results['deleted_contacts']
+
+    chat1['chat_id'] = await database.insert_chat(chat1.get('users'),
+                                                  chat1.get('sym_key_enc_by_owners_pub_keys'))
+    try:
+        await database.insert_chat(list(reversed(chat1.get('users'))),
+                                   chat1.get('sym_key_enc_by_owners_pub_keys'))
+        raise AssertionError('Duplicate chat was added.')
+    except DatabaseError as error:
+        results['duplicate_chat'] = error.reason
+
+    user_chats = results['chats'] = await database.select_my_chats(user1.get('user_id'))
+    get_chat1 = await database.select_chat(user_chats[0].get('id'))
+    assert user_chats[0] == get_chat1
+    assert get_chat1.get('id') == chat1.get('chat_id')
+    assert await database.get_last_chat() == chat1.get('chat_id')
+
+    timestamps = [await database.insert_message(chat1.get('chat_id'),
+                                                it_message.get('sender_id'),
+                                                it_message.get('message'))
+                  for it_message in messages]
+    assert timestamps == sorted(set(timestamps))
+
+    result = await database.select_my_messages(chat1.get('chat_id'))
+    assert [it_message.pop('timestamp') for it_message in result] == timestamps
+    for idx, it_message in enumerate(result):
+        assert it_message.get('chat_id') == chat1.get('chat_id')
+        assert it_message.get('sender_id') == messages[idx].get('sender_id')
+        assert it_message.get('message') == messages[idx].get('message')
+    results['messages'] = result
+
+    newer = await database.select_my_messages(chat1.get('chat_id'), after=timestamps[1])
+    assert [it_message.get('timestamp') for it_message in newer] == timestamps[2:]
+    iterated = [it_message async for it_message in
+                await database.iter_my_messages(chat1.get('chat_id'), after=timestamps[0],
+                                                chunk_size=2)]
+    assert len(iterated) == 3 and iterated[1:] == newer
+    assert await database.has_new_messages(chat1.get('chat_id'), timestamps[-2])
+    assert not await database.has_new_messages(chat1.get('chat_id'), timestamps[-1])
+    assert [chat async for chat in await database.iter_my_chats(user2.get('user_id'),
+                                                               chunk_size=1)] == user_chats
+
+    first = await database.select_my_messages(chat1.get('chat_id'), limit=2)
+    assert [it_message.get('timestamp') for it_message in first] == timestamps[:2]
+    last = await database.select_my_messages(chat1.get('chat_id'), before=timestamps[-1],
+                                             limit=2)
+    assert [it_message.get('timestamp') for it_message in last] == timestamps[-3:-1]
+    between = await database.select_my_messages(chat1.get('chat_id'), after=timestamps[0],
+                                                before=timestamps[-1])
+    assert [it_message.get('timestamp') for it_message in between] == timestamps[1:-1]
+    assert await database.select_my_chats(user1.get('user_id'), after=chat1.get('chat_id')) \
+        == []
+    assert await database.select_my_chats(user1.get('user_id'), before=chat1.get('chat_id') + 1,
+                                          limit=1) == user_chats[-1:]
+
+    assert await database.enforce_retention(max_count=3, batch_size=1) == 1
+    kept = await database.select_my_messages(chat1.get('chat_id'))
+    assert [it_message.get('timestamp') for it_message in kept] == timestamps[1:]
+    assert await database.enforce_retention(max_age=time.time() - timestamps[1] + 3600) == 0
+    await database.compact()
+    assert await database.select_my_messages(chat1.get('chat_id')) == kept
+    return results
 
-    LOOP.run_until_complete(DATABASE.insert_chat(CHAT1.get('users'),
-                                                 CHAT1.get('sym_key_enc_by_owners_pub_keys')))
 
-    try:
-        LOOP.run_until_complete(DATABASE.insert_chat(CHAT1.get('users'),
-                                                     CHAT1.get('sym_key_enc_by_owners_pub_keys')))
-    except DatabaseError:
-        print('Duplicate chat won\'t be added')
-
-    GET_USER_CHATS = LOOP.run_until_complete(DATABASE.select_my_chats(USER1.get('user_id')))
-    USER_FIRST_CHAT = GET_USER_CHATS[0]
-    GET_CHAT1 = LOOP.run_until_complete(DATABASE.select_chat(USER_FIRST_CHAT.get('id')))
-    ASSERTION = GET_CHAT1.get('id') == USER_FIRST_CHAT.get('id') and \
-                GET_CHAT1.get('users') == USER_FIRST_CHAT.get('users') and \
-                GET_CHAT1.get('sym_key_enc_by_owners_pub_keys') == \
-                USER_FIRST_CHAT.get('sym_key_enc_by_owners_pub_keys')
-    assert ASSERTION
-    assert USER_FIRST_CHAT == GET_CHAT1
-
-    for it_message in MESSAGES:
-        LOOP.run_until_complete(DATABASE.insert_message(it_message.get('chat_id'),
-                                                        it_message.get('sender_id'),
-                                                        it_message.get('message')))
-
-    RESULT = LOOP.run_until_complete(DATABASE.select_my_messages(CHAT1.get('chat_id')))
-    RESULT.sort(key=lambda x: x.get('timestamp'))
-
-    for idx, it_message in enumerate(RESULT):
-        assert it_message.get('chat_id') == MESSAGES[idx].get('chat_id')
-        assert it_message.get('sender_id') == MESSAGES[idx].get('sender_id')
-        assert it_message.get('message') == MESSAGES[idx].get('message')
-
-    LOOP.close()
+if __name__ == "__main__":
+    # runs the scenario against every backend and compares the results
+    RESULTS = {}
+    with tempfile.TemporaryDirectory() as DB_DIR:
+        for BACKEND, FILE_NAME in (('json', 'db.json'), ('sqlite', 'db.sqlite')):
+            DATABASE = open_database(os.path.join(DB_DIR, FILE_NAME), BACKEND)
+            RESULTS[BACKEND] = asyncio.run(run_scenario(DATABASE))
+            DATABASE.close()
+            print('Scenario passed with the {} backend.'.format(BACKEND))
+    assert RESULTS['json'] == RESULTS['sqlite'], RESULTS
+    print('Both backends returned the same results.')
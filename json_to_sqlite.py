@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Import a database of the JSON backend into a new SQLite database.
+
+Users, chats with their IDs, messages with their timestamps and contacts are
+copied as they are, so clients can continue with the same IDs and cursors.
+"""
+
+import argparse
+import json
+import os
+
+from db import _SEQUENCES_TABLE, DBType, _get_default_db_path, _membership_key
+from logging_utils import get_logger, init_logging
+from sqlite_db import connect
+from storage import DEFAULT_TABLE, Storage
+
+LOGGER = get_logger(__name__)
+
+
+def _documents(storage, db_type):
+    return [document for _, document in sorted(storage.search(db_type.table, lambda _: True),
+                                               key=lambda item: item[0])]
+
+
+def import_database(json_path, sqlite_path):
+    """
+    Copy all records of the JSON database into the SQLite database.
+    :param json_path: Path to the database file of the JSON backend
+    :param sqlite_path: Path to the SQLite database, must not contain any data yet
+    :return: Number of imported records
+    """
+    storage = Storage(json_path)
+    try:
+        if storage.count(DEFAULT_TABLE):
+            raise ValueError('Database {} uses the single table layout, '
+                             'convert it with migrate_db.py first.'.format(json_path))
+        users = _documents(storage, DBType.USERS)
+        chats = _documents(storage, DBType.CHATS)
+        messages = _documents(storage, DBType.MESSAGES)
+        contacts = _documents(storage, DBType.CONTACTS)
+        last_chat_id = max([chat['id'] for chat in chats] +
+                           [sequence['value'] for _, sequence in storage.search(
+                               _SEQUENCES_TABLE, lambda sequence: sequence['name'] ==
+                               DBType.CHATS.table)], default=0)
+    finally:
+        storage.close()
+
+    connection = connect(sqlite_path)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        if any(connection.execute('SELECT 1 FROM {} LIMIT 1'.format(db_type.table)).fetchone()
+               for db_type in DBType):
+            raise ValueError('Database {} is not empty.'.format(sqlite_path))
+        connection.executemany('INSERT INTO users (id, public_key) VALUES (?, ?)',
+                               [(user['id'], user['public_key']) for user in users])
+        connection.executemany(
+            'INSERT INTO chats (id, members, users, sym_key_enc_by_owners_pub_keys) '
+            'VALUES (?, ?, ?, ?)',
+            [(chat['id'], json.dumps(_membership_key(chat['users'])), json.dumps(chat['users']),
+              json.dumps(chat['sym_key_enc_by_owners_pub_keys'])) for chat in chats])
+        connection.executemany('INSERT OR IGNORE INTO chat_users (user_id, chat_id) '
+                               'VALUES (?, ?)',
+                               [(user_id, chat['id']) for chat in chats
+                                for user_id in chat['users']])
+        # chat IDs are never reused, not even IDs of chats which are gone
+        connection.execute("DELETE FROM sqlite_sequence WHERE name = 'chats'")
+        connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('chats', ?)",
+                           (last_chat_id,))
+        connection.executemany('INSERT INTO messages (chat_id, sender_id, timestamp, message) '
+                               'VALUES (?, ?, ?, ?)',
+                               [(message['chat_id'], message['sender_id'], message['timestamp'],
+                                 message['message']) for message in messages])
+        connection.executemany('INSERT INTO contacts (owner_id, user_id, alias) '
+                               'VALUES (?, ?, ?)',
+                               [(contact['owner_id'], contact['user_id'], contact['alias'])
+                                for contact in contacts])
+        connection.execute('COMMIT')
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+
+    imported = len(users) + len(chats) + len(messages) + len(contacts)
+    LOGGER.info('Imported %d records of %s into %s.', imported, json_path, sqlite_path)
+    return imported
+
+
+def main():
+    """Parse the command line and import the database."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('json_path', nargs='?',
+                        default=os.getenv('DATABASE_LOCATION', _get_default_db_path()),
+                        help='path to the JSON database file (default: $DATABASE_LOCATION)')
+    parser.add_argument('sqlite_path', help='path to the new SQLite database file')
+    args = parser.parse_args()
+
+    init_logging()
+    import_database(args.json_path, args.sqlite_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,36 @@
 """
 Common logging functionality
+
+Records are passed through a queue to a listener thread which formats and
+writes them, so that slow log output does not block the IOLoop. LOG_FORMAT
+selects JSON lines ("json", default) or the one line text format ("text").
+Repeated warnings and errors are rate limited.
 """
 
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
+
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# records waiting for the listener, further ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# warnings and errors logged with the same message per interval, 0 disables the limit
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', '10'))
+LOG_RATE_INTERVAL = float(os.getenv('LOG_RATE_INTERVAL', '60'))
+
+# ID of the request being processed, added to its records
+REQUEST_ID = contextvars.ContextVar('request_id', default=None)
+
+# attributes of every LogRecord, the others were passed in extra
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener = None  # pylint: disable=invalid-name
 
 
 class OneLineExceptionFormatter(logging.Formatter):
@@ -31,6 +58,125 @@ class OneLineExceptionFormatter(logging.Formatter):
         return fmt_str
 
 
+class JSONFormatter(logging.Formatter):
+    """
+    Formatter writing each record as a JSON object on one line, with the
+    request ID and the values passed in extra as separate fields.
+    """
+
+    def __init__(self, host):
+        super().__init__()
+        self.host = host
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'host': self.host,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items()
+                     if key not in _RECORD_ATTRIBUTES and value is not None)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return '{}.{:03d}'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+                                  int(record.msecs))
+
+
+class RequestContextFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Add the ID of the request being processed to the records."""
+
+    def filter(self, record):
+        record.request_id = REQUEST_ID.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """
+    Let at most limit warnings and errors with the same message through per
+    interval. The first record let through after some were dropped carries
+    their number in the suppressed field.
+    :param limit: Records with the same message per interval
+    :param interval: Length of the interval in seconds
+    :param exempt: Names of the loggers which are not limited
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL,
+                 exempt=('tornado.access',), clock=time.monotonic):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.exempt = frozenset(exempt)
+        self._clock = clock
+        # {(logger, message template): [start of the interval, records, suppressed]}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or not self.limit or record.name in self.exempt:
+            return True
+        key = record.name, str(record.msg)
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                if len(self._windows) > 10000:
+                    self._windows.clear()
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which drops the records when the queue is full and leaves
+    formatting of the records and tracebacks to the listener thread.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        # the arguments may be changed by the caller before the listener formats them
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _start_listener(queue_handler, handler):
+    global _listener  # pylint: disable=global-statement,invalid-name
+    queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(queue_handler.queue, handler,
+                                               respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Write the queued records and stop the listener thread."""
+    global _listener  # pylint: disable=global-statement,invalid-name
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
 def init_logging():
     """Setup root logger handler."""
     logger = logging.getLogger()
@@ -39,9 +185,18 @@ def init_logging():
     log_fmt = uuid + " %(asctime)s %(name)s: [%(levelname)s] %(message)s"
     if not logger.handlers:
         handler = logging.StreamHandler()
-        formatter = OneLineExceptionFormatter(log_fmt)
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+        if LOG_FORMAT == 'text':
+            handler.setFormatter(OneLineExceptionFormatter(log_fmt))
+        else:
+            handler.setFormatter(JSONFormatter(os.uname().nodename))
+        queue_handler = NonBlockingQueueHandler(None)
+        queue_handler.addFilter(RequestContextFilter())
+        queue_handler.addFilter(RateLimitFilter())
+        _start_listener(queue_handler, handler)
+        logger.addHandler(queue_handler)
+        atexit.register(stop_logging)
+        # the listener thread does not survive fork, e.g. of the worker processes
+        os.register_at_fork(after_in_child=lambda: _start_listener(queue_handler, handler))
 
 
 def get_logger(name):
@@ -2,31 +2,65 @@
 Module to handle /messages API calls.
 """
 
+import asyncio
+import functools
 import hashlib
+from datetime import timedelta
 
-from jsonschema import validate
-from rsa.key import PublicKey as rsa_public_key
+import tornado.gen
+import tornado.util
 from rsa.transform import int2bytes
 from database_error import DatabaseError
-
+from metrics import SIGNATURE_DURATION
+from pagination import select_page
+from schemas import validate
+from streaming import JSONArrayStream
 from utils import rsa_verification
 
 
+def message_response(chat_id, sender_id, timestamp, message):
+    """
+    Return a new message as the API returns and pushes it to the subscribers,
+    whether it was stored by this process or by another one.
+    """
+    return {
+        'chat_id': chat_id,
+        'sender_id': sender_id,
+        'timestamp': timestamp,
+        'message': message
+    }
+
+
 class MessagesNewAPI:
     """ Main /messages/new API class."""
 
-    def __init__(self, my_db):
+    def __init__(self, my_db, notifier=None, crypto_executor=None):
         self.my_db = my_db
-        self.json_schema = {
-            'type': 'object',
-            'properties': {
-                'chat_id': {'type': 'integer'},
-                'sender_id': {'type': 'integer'},
-                'message': {'type': 'string'},
-                'hash': {'type': 'integer'}
-            },
-            'required': ['chat_id', 'sender_id', 'message', 'hash']
-        }
+        self.notifier = notifier
+        self.crypto_executor = crypto_executor
+
+    async def verify_signature(self, data):
+        """
+        Check that the message was signed by its sender.
+        :param data: message parsed into data structure
+        :returns: True if the signature matches, False otherwise
+        """
+        message = data.get('message')
+        chat_id = data.get('chat_id')
+        sender_id = data.get('sender_id')
+        received_hash_signed = int2bytes(data.get('hash'))
+
+        user_public_key = await self.my_db.select_public_key(sender_id)
+
+        generated_hash = hashlib.sha256(
+            (str(chat_id) + str(sender_id) + str(message)).encode()).hexdigest()
+
+        with SIGNATURE_DURATION.time():
+            if self.crypto_executor:
+                return await self.crypto_executor.rsa_verification(
+                    user_public_key, received_hash_signed, generated_hash.encode('utf-8'))
+            return rsa_verification(user_public_key, received_hash_signed,
+                                    generated_hash.encode('utf-8'))
 
     async def process_post(self, api_version, data):  # pylint: disable=unused-argument
         """
@@ -34,37 +68,68 @@ class MessagesNewAPI:
         :param data: json request parsed into data structure
         :returns: json response with inserted message
         """
-        validate(data, self.json_schema)
+        validate(data, 'messages_new')
 
         message = data.get('message')
         chat_id = data.get('chat_id')
         sender_id = data.get('sender_id')
-        received_hash_signed = data.get('hash')
 
-        received_hash_signed = int2bytes(received_hash_signed)
+        if await self.verify_signature(data):
+            timestamp = await self.my_db.insert_message(chat_id, sender_id, message)
+        else:
+            raise DatabaseError(reason='Message sign does not match the expected sign.')
 
-        response = await self.my_db.select_user(sender_id)
-        user_public_key = response['public_key']
-        user_public_key = rsa_public_key.load_pkcs1(user_public_key)
+        response = message_response(chat_id, sender_id, timestamp, message)
 
-        generated_hash = hashlib.sha256((str(chat_id) + str(sender_id) + str(message)).encode()).hexdigest()
+        if self.notifier:
+            self.notifier.notify(chat_id, response)
 
-        decrypted_hash = rsa_verification(user_public_key, received_hash_signed, generated_hash.encode('utf-8'))
+        return response
 
-        # FIXME: insert message and retrieve timestamp, do not call insert twice
-        # timestamp = await self.my_db.insert_message(chat_id, sender_id, message)
-        timestamp = None
 
-        if decrypted_hash:
-            await self.my_db.insert_message(chat_id, sender_id, message)
-        else:
-            raise DatabaseError(reason='Message sign does not match the expected sign.')
+class MessagesBatchAPI(MessagesNewAPI):
+    """ Main /messages/batch API class."""
+
+    async def _check(self, data):
+        """Return None if the message can be stored, the error message otherwise."""
+        try:
+            if not await self.my_db.chat_id_exist(data.get('chat_id')):
+                return 'Chat with ID {} not found in the database.'.format(data.get('chat_id'))
+            if not await self.verify_signature(data):
+                return 'Message sign does not match the expected sign.'
+        except DatabaseError as dberr:
+            return dberr.reason
+        return None
+
+    async def process_post(self, api_version, data):  # pylint: disable=unused-argument
+        """
+        Process inserting a batch of messages, possibly into several chats.
+        Signatures are verified in parallel and the valid messages are stored
+        in a single write.
+        :param data: json request parsed into data structure
+        :returns: json response with a result for every message of the batch
+        """
+        validate(data, 'messages_batch')
+
+        messages = data.get('messages')
+        errors = await asyncio.gather(*(self._check(item) for item in messages))
+
+        valid_messages = [item for item, error in zip(messages, errors) if error is None]
+        timestamps = iter(await self.my_db.insert_messages(valid_messages))
+
+        results = []
+        for item, error in zip(messages, errors):
+            if error is not None:
+                results.append({'error': {'code': 400, 'message': error}})
+                continue
+            result = message_response(item.get('chat_id'), item.get('sender_id'),
+                                      next(timestamps), item.get('message'))
+            if self.notifier:
+                self.notifier.notify(result['chat_id'], result)
+            results.append(result)
 
         response = {
-            'chat_id': chat_id,
-            'sender_id': sender_id,
-            'timestamp': timestamp,
-            'message': message
+            'results': results
         }
 
         return response
@@ -73,39 +138,91 @@ class MessagesNewAPI:
 class MessagesUpdatesAPI:
     """ Main /messages/updates API class."""
 
-    def __init__(self, my_db):
+    def __init__(self, my_db, notifier=None, poll_timeout=0):
         self.my_db = my_db
-        self.json_schema = {
-            'type': 'object',
-            'properties': {
-                'cursor': {'type': 'number'},
-                'chat_id': {'type': 'integer'}
-            },
-            'required': ['cursor', 'chat_id']
-        }
+        self.notifier = notifier
+        self.poll_timeout = poll_timeout
+
+    async def _select_messages(self, chat_id, after, before, limit):
+        if limit is None:
+            return {'messages': await self.my_db.select_my_messages(
+                chat_id, after=after, before=before), 'next_cursor': None}
+        messages, next_cursor = await select_page(
+            functools.partial(self.my_db.select_my_messages, chat_id), 'timestamp',
+            after=after, before=before, limit=limit)
+        return {'messages': messages, 'next_cursor': next_cursor}
 
     async def process_post(self, api_version, data):  # pylint: disable=unused-argument
         """
         Process the request for new messages since the cursor.
+        The cursor is the timestamp of the last message the client has seen.
+        When there is no new message, waits up to poll_timeout seconds for one.
+        With a limit, returns a page of messages and the cursor of the next one,
+        the page of the newest messages older than before if it is given.
         :param data: json request parsed into data structure
         :returns: json response with a list of messages
         """
-        validate(data, self.json_schema)
+        validate(data, 'messages_updates')
 
         cursor = data.get('cursor')
+        before = data.get('before')
+        limit = data.get('limit')
         chat_id = data.get('chat_id')
-        db_response = await self.my_db.select_my_messages(chat_id)
-        db_response.sort(key=lambda x: x.get('timestamp'), reverse=True)
 
-        results = []
-        for msg in db_response:
-            if msg['timestamp'] == cursor:
-                break
-            results.append(msg)
-        results.reverse()
+        if before is not None:
+            # older messages are history, there is nothing to wait for
+            return await self._select_messages(chat_id, cursor, before, limit)
+
+        wait_future = None
+        if self.notifier and self.poll_timeout > 0:
+            # park before reading so that a message stored meanwhile is not missed
+            wait_future = self.notifier.wait(chat_id)
+        try:
+            if wait_future is not None and \
+                    not await self.my_db.has_new_messages(chat_id, after=cursor):
+                try:
+                    await tornado.gen.with_timeout(timedelta(seconds=self.poll_timeout),
+                                                   wait_future)
+                except tornado.util.TimeoutError:
+                    pass
+            if limit is not None:
+                return await self._select_messages(chat_id, cursor, None, limit)
+            results = await self.my_db.iter_my_messages(chat_id, after=cursor)
+        finally:
+            if wait_future is not None:
+                wait_future.cancel()
+
+        response = {
+            # a stale cursor may match many messages, send them as they are read
+            'messages': JSONArrayStream(results),
+            'next_cursor': None,
+        }
+
+        return response
+
+
+class MessagesSubscribeAPI:
+    """ Subscription of WebSocket clients to new messages of chats."""
+
+    def __init__(self, my_db):
+        self.my_db = my_db
+
+    async def process_post(self, api_version, data):  # pylint: disable=unused-argument
+        """
+        Process the request for a subscription to new messages of chats.
+        :param data: json request parsed into data structure
+        :returns: json response with the subscribed chats
+        """
+        validate(data, 'messages_subscribe')
+
+        chat_ids = data.get('chat_ids')
+        for chat_id in chat_ids:
+            if not await self.my_db.chat_id_exist(chat_id):
+                raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                    .format(chat_id))
 
         response = {
-            'messages': results
+            'chat_ids': chat_ids
         }
 
         return response
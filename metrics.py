@@ -0,0 +1,261 @@
+"""
+Module with in-process metrics, exported in the Prometheus text format.
+
+Every metric keeps its values in the memory of the process, recording one is
+a dictionary lookup and a few additions under a lock. With several workers
+each of them exports its own values.
+"""
+
+import bisect
+import functools
+import inspect
+import math
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds of the buckets in seconds, for requests and database calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+# for operations taking microseconds, such as JSON encoding
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                0.01, 0.05)
+
+# all metrics in the order they are exported
+REGISTRY = []
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    """
+    Named metric with values for combinations of its labels.
+    :param name: Name of the metric
+    :param documentation: One line description exported as HELP
+    :param labels: Names of the labels, their values are passed in the same order
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _label_string(self, label_values, extra=''):
+        pairs = ['{}="{}"'.format(name, _escape(value))
+                 for name, value in zip(self.labels, label_values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        """Return (suffix, label string, value) of every exported sample."""
+        with self._lock:
+            values = list(self._values.items())
+        return [('', self._label_string(label_values), value)
+                for label_values, value in sorted(values)]
+
+    def render(self):
+        """Return the lines of the metric in the Prometheus text format."""
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend('{}{}{} {}'.format(self.name, suffix, labels, _format_value(value))
+                     for suffix, labels, value in self.samples())
+        return lines
+
+    def clear(self):
+        """Drop the values of all label combinations."""
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """Metric which only goes up, such as the number of requests."""
+
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        """
+        Increase the counter.
+        :param label_values: Values of the labels
+        :param amount: Non-negative number to add
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def set(self, value, *label_values):
+        """Copy the total of a counter maintained elsewhere, e.g. when the metrics are read."""
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Gauge(Metric):
+    """Metric which goes up and down, such as the number of requests in flight."""
+
+    kind = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        """Increase the gauge, see Counter.inc."""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        """Decrease the gauge."""
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        """Set the gauge to the value."""
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, such as durations, counted in buckets.
+    :param buckets: Increasing upper bounds of the buckets
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        """
+        Record the value.
+        :param value: Observed value, e.g. seconds
+        :param label_values: Values of the labels
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # count of every bucket and of the +Inf one, sum of the values
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *label_values):
+        """
+        Observe the duration of a with block, or of every call of a decorated
+        function or coroutine function.
+        :param label_values: Values of the labels
+        """
+        return _Timer(self, label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts), total)
+                      for label_values, (counts, total) in self._values.items()]
+        samples = []
+        for label_values, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(('_bucket', self._label_string(
+                    label_values, 'le="{}"'.format(_format_value(bound))), cumulative))
+            samples.append(('_sum', self._label_string(label_values), total))
+            samples.append(('_count', self._label_string(label_values), cumulative))
+        return samples
+
+
+class _Timer:
+    """Context manager and decorator returned by Histogram.time."""
+
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start, *self._label_values)
+
+    def __call__(self, func):
+        histogram, label_values = self._histogram, self._label_values
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, *label_values)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *label_values)
+        return wrapper
+
+
+def time_coroutines(histogram):
+    """
+    Class decorator observing the duration of every public coroutine method,
+    labelled by the name of the method.
+    :param histogram: Histogram with a single label
+    """
+    def decorator(cls):
+        for name, method in list(vars(cls).items()):
+            if not name.startswith('_') and inspect.iscoroutinefunction(method):
+                setattr(cls, name, histogram.time(name)(method))
+        return cls
+    return decorator
+
+
+def render():
+    """Return all metrics in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter('cryptochat_http_requests_total',
+                   'Finished HTTP requests by handler, method and status code.',
+                   ('handler', 'method', 'code'))
+REQUEST_DURATION = Histogram('cryptochat_http_request_duration_seconds',
+                             'Time from receiving an HTTP request until it was finished.',
+                             ('handler', 'method'))
+REQUESTS_IN_FLIGHT = Gauge('cryptochat_http_requests_in_flight',
+                           'HTTP requests being processed, including held long polls.')
+DB_CALL_DURATION = Histogram('cryptochat_db_call_duration_seconds',
+                             'Duration of the database coroutines, including cached calls.',
+                             ('call',))
+SIGNATURE_DURATION = Histogram('cryptochat_signature_verification_duration_seconds',
+                               'Duration of message signature verifications.')
+VALIDATION_DURATION = Histogram('cryptochat_schema_validation_duration_seconds',
+                                'Duration of JSON schema validations by schema.',
+                                ('schema',), buckets=FAST_BUCKETS)
+SERIALIZATION_DURATION = Histogram('cryptochat_json_duration_seconds',
+                                   'Duration of JSON encoding and decoding.',
+                                   ('operation',), buckets=FAST_BUCKETS)
+DATABASE_SIZE = Gauge('cryptochat_database_size_bytes',
+                      'Size of the database files on the disk.')
+CACHE_LOOKUPS = Counter('cryptochat_cache_lookups_total',
+                        'Lookups in the database caches by result.', ('cache', 'result'))
+CACHE_SIZE = Gauge('cryptochat_cache_entries', 'Entries in the database caches.', ('cache',))
+CRYPTO_PENDING = Gauge('cryptochat_crypto_pending_operations',
+                       'Cryptographic operations submitted to the worker pool.')
+CRYPTO_REJECTED = Counter('cryptochat_crypto_rejected_operations_total',
+                          'Cryptographic operations rejected because the pool was full.')
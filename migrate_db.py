@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Split a database using the single table layout into per-type tables.
+
+Older databases keep every record in the default TinyDB table and tell users,
+chats, messages and contacts apart by the ``type`` field. The database module
+stores each type in its own table, see DBType.table.
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+from db import DBType, _get_default_db_path
+from logging_utils import get_logger, init_logging
+from storage import DEFAULT_TABLE, STORAGE_TABLE, Storage
+
+LOGGER = get_logger(__name__)
+
+
+def migrate(db_path):
+    """
+    Move the records of the default table into the tables of their types.
+    :param db_path: Path to the database file
+    :return: Number of migrated records
+    """
+    # fold a pending write-ahead log into the database file first
+    Storage(db_path).close()
+
+    with open(db_path, encoding='utf8') as db_file:
+        raw_tables = json.load(db_file)
+
+    legacy_records = raw_tables.pop(DEFAULT_TABLE, {})
+    for _, record in sorted(legacy_records.items(), key=lambda item: int(item[0])):
+        table = raw_tables.setdefault(DBType(record['type']).table, {})
+        table[str(len(table) + 1)] = record
+    # versions handed out before, e.g. in ETags, must not match the moved records
+    metadata = raw_tables[STORAGE_TABLE]['1']
+    metadata['changes'] += 1
+    metadata['versions'] = {table_name: metadata['changes'] for table_name in raw_tables
+                            if table_name != STORAGE_TABLE}
+
+    backup_path = db_path + '.bak'
+    shutil.copyfile(db_path, backup_path)
+    tmp_path = db_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as tmp_file:
+        json.dump(raw_tables, tmp_file)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, db_path)
+    LOGGER.info('Migrated %d records of %s, the original file was saved to %s.',
+                len(legacy_records), db_path, backup_path)
+    return len(legacy_records)
+
+
+def main():
+    """Parse the command line and migrate the database."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('db_path', nargs='?',
+                        default=os.getenv('DATABASE_LOCATION', _get_default_db_path()),
+                        help='path to the database file (default: $DATABASE_LOCATION)')
+    args = parser.parse_args()
+
+    init_logging()
+    migrate(args.db_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Module to wake up clients waiting for new messages.
+"""
+
+from tornado.concurrent import Future
+
+from logging_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class MessageNotifier:
+    """
+    Registry of clients parked until a new message arrives into a chat
+    and of subscribers receiving every new message of a chat.
+    """
+
+    def __init__(self, max_waiters):
+        self.max_waiters = max_waiters
+        self._waiters = {}
+        self._waiters_count = 0
+        self._subscribers = {}
+
+    @property
+    def waiters_count(self):
+        """Number of currently parked clients."""
+        return self._waiters_count
+
+    def wait(self, chat_id):
+        """
+        Park the caller until a new message arrives into the chat.
+        Cancel the returned future to stop waiting.
+        :param chat_id: ID of chat
+        :return: Future resolved on the next message or None if too many clients wait already
+        """
+        if self._waiters_count >= self.max_waiters:
+            LOGGER.warning('Limit of %d waiting clients reached, not parking the request.',
+                           self.max_waiters)
+            return None
+        future = Future()
+        self._waiters.setdefault(chat_id, set()).add(future)
+        self._waiters_count += 1
+        future.add_done_callback(lambda done_future: self._remove(chat_id, done_future))
+        return future
+
+    def _remove(self, chat_id, future):
+        waiters = self._waiters.get(chat_id)
+        if waiters is None or future not in waiters:
+            return
+        waiters.remove(future)
+        self._waiters_count -= 1
+        if not waiters:
+            del self._waiters[chat_id]
+
+    def subscribe(self, chat_id, callback):
+        """
+        Call the callback with every new message of the chat.
+        The callback runs on the IOLoop and must not block.
+        :param chat_id: ID of chat
+        :param callback: Callable taking the new message
+        """
+        self._subscribers.setdefault(chat_id, set()).add(callback)
+
+    def unsubscribe(self, chat_id, callback):
+        """
+        Stop calling the callback for new messages of the chat.
+        :param chat_id: ID of chat
+        :param callback: Callable registered by subscribe
+        """
+        subscribers = self._subscribers.get(chat_id)
+        if subscribers is None:
+            return
+        subscribers.discard(callback)
+        if not subscribers:
+            del self._subscribers[chat_id]
+
+    def notify(self, chat_id, message=None):
+        """
+        Wake up all clients waiting for messages of the chat and pass the message to subscribers.
+        :param chat_id: ID of chat
+        :param message: The new message
+        """
+        for future in list(self._waiters.get(chat_id, ())):
+            if not future.done():
+                future.set_result(True)
+        for callback in list(self._subscribers.get(chat_id, ())):
+            callback(message)
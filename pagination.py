@@ -0,0 +1,31 @@
+"""
+Module to split long lists of the API responses into pages.
+
+A page holds at most limit items ordered by their sort key. The next_cursor of
+the response is the sort key to continue from, passed as after to read the
+following page or as before to read the preceding one. It is null once there
+are no more items in that direction.
+"""
+
+MAX_PAGE_SIZE = 1000
+
+
+async def select_page(select, sort_field, *, after=None, before=None, limit):
+    """
+    Select a page of items and the cursor of the next page.
+    :param select: Coroutine function taking after, before and limit keyword arguments
+    :param sort_field: Field of the items the pages are ordered by
+    :param after: Return only items with a higher sort key
+    :param before: Return only items with a lower sort key, paging backwards
+    :param limit: Maximum number of items of the page
+    :return: Tuple of the list of items and next_cursor
+    """
+    # one more item tells whether there is any further page
+    items = await select(after=after, before=before, limit=limit + 1)
+    if len(items) <= limit:
+        return items, None
+    if before is not None:
+        items = items[1:]
+        return items, items[0][sort_field]
+    items = items[:limit]
+    return items, items[-1][sort_field]
@@ -0,0 +1,120 @@
+"""
+Module profiling a sample of the API requests with cProfile.
+
+PROFILE_SAMPLE_RATE is the fraction of requests profiled, 0 (default)
+disables the profiling. It can be changed at runtime through
+/admin/profiles. Profiles are written in the pstats format to
+PROFILE_DIRECTORY, only the newest PROFILE_KEEP of them are kept.
+
+cProfile records everything running in the thread of the IOLoop, so the
+profile of a request also holds the work of the requests processed meanwhile.
+At most one request is profiled at a time.
+"""
+
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import time
+
+from logging_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIRECTORY = os.getenv('PROFILE_DIRECTORY', '/tmp/cryptochat_profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '100'))
+PROFILE_SUFFIX = '.prof'
+# names of the profile files, also matched by the admin route
+PROFILE_NAME = r'[\w.-]+\.prof'
+
+
+class RequestProfiler:
+    """
+    Decides which requests are profiled and stores their profiles.
+    :param sample_rate: Fraction of the requests to profile, from 0 to 1
+    :param directory: Directory the profiles are written to
+    :param keep: Number of the newest profiles kept in the directory
+    :param rand: Function returning a random number from 0 to 1
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, directory=PROFILE_DIRECTORY,
+                 keep=PROFILE_KEEP, rand=random.random):
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.keep = keep
+        self.profiled = 0
+        self._random = rand
+        self._active = False
+
+    def sample(self):
+        """Return True when the next request should be profiled."""
+        return (self.sample_rate > 0 and not self._active
+                and self._random() < self.sample_rate)
+
+    @contextlib.contextmanager
+    def profile(self, handler_name, method):
+        """
+        Profile the block and write the profile into the directory.
+        :param handler_name: Name of the request handler, part of the file name
+        :param method: HTTP method of the request, part of the file name
+        """
+        self._active = True
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._active = False
+            name = '{}.{:03d}-{}-{}-{}{}'.format(
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(start)),
+                int(start * 1000) % 1000, handler_name, method, os.getpid(), PROFILE_SUFFIX)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.directory, name))
+                self.profiled += 1
+                self._prune()
+            except OSError as err:
+                LOGGER.error('Can not write the profile %s: %s', name, err)
+
+    def _prune(self):
+        for name in self.list_profiles()[self.keep:]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.directory, name))
+
+    def list_profiles(self):
+        """Return the names of the stored profiles, the newest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted((name for name in names if re.fullmatch(PROFILE_NAME, name)),
+                      reverse=True)
+
+    def report(self, name, sort='cumulative', limit=50):
+        """
+        Return the statistics of a stored profile as text.
+        :param name: Name of the profile returned by list_profiles
+        :param sort: pstats sort key, e.g. "cumulative" or "tottime"
+        :param limit: Number of the printed functions
+        :return: Text report or None when there is no such profile
+        """
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise ValueError('Unknown sort key "{}".'.format(sort))
+        path = os.path.join(self.directory, os.path.basename(name))
+        if not re.fullmatch(PROFILE_NAME, name) or not os.path.exists(path):
+            return None
+        output = io.StringIO()
+        pstats.Stats(path, stream=output).sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def status(self):
+        """Return the settings of the profiler and the stored profiles."""
+        return {'sample_rate': self.sample_rate, 'directory': self.directory,
+                'keep': self.keep, 'profiled': self.profiled,
+                'profiles': self.list_profiles()}
@@ -0,0 +1,157 @@
+"""
+Registry of JSON schemas of the API requests.
+
+Every schema is checked and compiled into a validator once, when the module
+is imported, and the validators are reused by all requests.
+"""
+
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+from metrics import VALIDATION_DURATION
+from pagination import MAX_PAGE_SIZE
+
+MAX_BATCH_SIZE = 100
+
+LIMIT_SCHEMA = {'type': 'integer', 'minimum': 1, 'maximum': MAX_PAGE_SIZE}
+
+MESSAGE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'chat_id': {'type': 'integer'},
+        'sender_id': {'type': 'integer'},
+        'message': {'type': 'string'},
+        'hash': {'type': 'integer'}
+    },
+    'required': ['chat_id', 'sender_id', 'message', 'hash']
+}
+
+SCHEMAS = {
+    'messages_new': MESSAGE_SCHEMA,
+    'messages_batch': {
+        'type': 'object',
+        'properties': {
+            'messages': {'type': 'array',
+                         'items': MESSAGE_SCHEMA,
+                         'maxItems': MAX_BATCH_SIZE
+                         },
+        },
+        'required': ['messages']
+    },
+    'messages_updates': {
+        'type': 'object',
+        'properties': {
+            'cursor': {'type': 'number'},
+            'before': {'type': 'number'},
+            'limit': LIMIT_SCHEMA,
+            'chat_id': {'type': 'integer'}
+        },
+        'required': ['cursor', 'chat_id']
+    },
+    'messages_subscribe': {
+        'type': 'object',
+        'properties': {
+            'chat_ids': {'type': 'array',
+                         'items': {'type': 'integer'}
+                         },
+        },
+        'required': ['chat_ids']
+    },
+    'users_post': {
+        'type': 'object',
+        'properties': {
+            'user_id': {'type': 'integer'},
+            'public_key': {'type': 'string'},
+        },
+        'required': ['user_id', 'public_key']
+    },
+    'users_get': {
+        'type': 'object',
+        'properties': {
+            'user_id': {'type': 'integer'},
+        },
+        'required': ['user_id']
+    },
+    'chats_post': {
+        'type': 'object',
+        'properties': {
+            'users': {'type': 'array',
+                      'items': {'type': 'integer'}
+                      },
+            'sym_key_enc_by_owners_pub_keys': {'type': 'array',
+                                               'items': {'type': 'string'}
+                                               },
+        },
+        'required': ['users', 'sym_key_enc_by_owners_pub_keys']
+    },
+    'chats_get': {
+        'type': 'object',
+        'properties': {
+            'chat_id': {'type': 'integer'},
+        },
+        'required': ['chat_id']
+    },
+    'chats_user_get': {
+        'type': 'object',
+        'properties': {
+            'user_id': {'type': 'integer'},
+            'after': {'type': 'integer'},
+            'before': {'type': 'integer'},
+            'limit': LIMIT_SCHEMA,
+        },
+        'required': ['user_id']
+    },
+    'contacts_post': {
+        'type': 'object',
+        'properties': {
+            'owner_id': {'type': 'integer'},
+            'user_id': {'type': 'integer'},
+            'encrypted_alias': {'type': 'string'},
+        },
+        'required': ['owner_id', 'user_id', 'encrypted_alias']
+    },
+    'contacts_get': {
+        'type': 'object',
+        'properties': {
+            'owner_id': {'type': 'integer'},
+            'after': {'type': 'integer'},
+            'before': {'type': 'integer'},
+            'limit': LIMIT_SCHEMA,
+        },
+        'required': ['owner_id']
+    },
+    'profiling_post': {
+        'type': 'object',
+        'properties': {
+            'sample_rate': {'type': 'number', 'minimum': 0, 'maximum': 1},
+        },
+        'required': ['sample_rate']
+    },
+}
+
+
+def compile_schema(schema):
+    """
+    Check the schema and return a validator for it.
+    :param schema: JSON schema
+    :return: jsonschema validator instance
+    """
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+VALIDATORS = {name: compile_schema(schema) for name, schema in SCHEMAS.items()}
+
+
+def validate(data, schema_name):
+    """
+    Validate the data against the registered schema.
+    Raises the same error jsonschema.validate would.
+    :param data: json request parsed into data structure
+    :param schema_name: Name of the schema in SCHEMAS
+    """
+    with VALIDATION_DURATION.time(schema_name):
+        error = best_match(VALIDATORS[schema_name].iter_errors(data))
+    if error is not None:
+        raise error
@@ -1,4 +0,0 @@
-#!/bin/sh
-
-cmd="$@"
-exec /usr/bin/scl enable rh-python36 "$cmd"
@@ -0,0 +1,114 @@
+"""
+Module to encode and decode JSON of requests, responses and the database.
+
+orjson is used when it is installed, the standard json module otherwise. The
+JSON_LIBRARY environment variable selects the library: "orjson", "json" or
+"auto" (default). orjson handles only integers of up to 64 bits, values with
+larger integers, such as message signatures, are passed to the json module.
+Searching for them costs about as much as decoding with the json module, so
+the callers which expect them, e.g. for signed messages, skip the search.
+"""
+
+import json
+import os
+import re
+
+from metrics import SERIALIZATION_DURATION
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None  # pylint: disable=invalid-name
+
+JSON_LIBRARY = os.getenv('JSON_LIBRARY', 'auto')
+
+# orjson would decode integers of 20 and more digits to floats
+_LONG_NUMBER_DIGITS = 20
+_LONG_NUMBER = re.compile(rb'\d{%d}' % _LONG_NUMBER_DIGITS)
+_DIGITS = b'0123456789'
+
+
+def _select_library(name):
+    if name == 'auto':
+        return 'orjson' if orjson is not None else 'json'
+    if name == 'orjson' and orjson is None:
+        raise ValueError('JSON_LIBRARY is "orjson", but orjson is not installed.')
+    if name not in ('orjson', 'json'):
+        raise ValueError('Unknown JSON library "{}", use "orjson", "json" or "auto".'
+                         .format(name))
+    return name
+
+
+LIBRARY = _select_library(JSON_LIBRARY)
+
+
+def _json_dumpb(value):
+    return json.dumps(value).encode('utf8')
+
+
+def _orjson_dumpb(value):
+    try:
+        return orjson.dumps(value)
+    except TypeError:
+        # integers over 64 bits or keys which are not strings
+        return _json_dumpb(value)
+
+
+def _json_loads(data, big_integers):  # pylint: disable=unused-argument
+    return json.loads(data)
+
+
+def _orjson_loads(data, big_integers):
+    if big_integers:
+        return json.loads(data)
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    # counting the digits is much cheaper than the search, which most data skips
+    if len(data) - len(data.translate(None, _DIGITS)) >= _LONG_NUMBER_DIGITS and \
+            _LONG_NUMBER.search(data):
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+_CODECS = {'orjson': (_orjson_dumpb, _orjson_loads),
+           'json': (_json_dumpb, _json_loads)}
+_codec = _CODECS[LIBRARY]  # pylint: disable=invalid-name
+
+
+def use_library(name):
+    """
+    Switch the library used by the module, e.g. to compare them in benchmarks.
+    :param name: "orjson", "json" or "auto"
+    """
+    global LIBRARY, _codec  # pylint: disable=global-statement,invalid-name
+    LIBRARY = _select_library(name)
+    _codec = _CODECS[LIBRARY]
+
+
+@SERIALIZATION_DURATION.time('encode')
+def dumpb(value, html_safe=False):
+    """
+    Encode the value into JSON.
+    :param value: JSON serializable value
+    :param html_safe: Escape "</" as tornado.escape.json_encode does, to embed the JSON into HTML
+    :return: UTF-8 encoded bytes
+    """
+    data = _codec[0](value)
+    return data.replace(b'</', b'<\\/') if html_safe else data
+
+
+def dumps(value, html_safe=False):
+    """Encode the value into a JSON str, see dumpb."""
+    return dumpb(value, html_safe).decode('utf8')
+
+
+@SERIALIZATION_DURATION.time('decode')
+def loads(data, big_integers=False):
+    """
+    Decode JSON.
+    :param data: str or bytes
+    :param big_integers: The data is expected to hold integers over 64 bits, such as
+        message signatures, decode it with the json module right away
+    :return: Decoded value, raises ValueError for malformed JSON
+    """
+    return _codec[1](data, big_integers)
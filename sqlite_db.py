@@ -0,0 +1,720 @@
+"""
+Module to handle database calls with SQLite as the storage.
+
+SQLiteDB provides the same coroutines as db.DB and returns the same documents.
+Queries run in a pool of threads, each with its own connection, so they never
+block the IOLoop. Every write runs in a single immediate transaction, which
+serializes it with writers of other threads and processes.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import rsa
+import tornado.ioloop
+
+import serialization
+from cache import LRUCache, read_through
+from database_error import DatabaseError
+from db import (ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL, ITER_CHUNK_SIZE, MESSAGE_RETENTION_AGE,
+                MESSAGE_RETENTION_COUNT, PUBLIC_KEY_CACHE_SIZE, RETENTION_BATCH_SIZE, DBType,
+                _membership_key, _retention_batch)
+from logging_utils import get_logger
+from metrics import DB_CALL_DURATION, time_coroutines
+
+LOGGER = get_logger(__name__)
+
+SQLITE_THREADS = int(os.getenv('SQLITE_THREADS', '4'))
+# FULL makes every commit durable before the request is answered, as the JSON backend does
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'FULL')
+_BUSY_TIMEOUT = 30
+_TIMESTAMP_STEP = 1e-6
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER NOT NULL UNIQUE,
+    public_key TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    members TEXT NOT NULL UNIQUE,
+    users TEXT NOT NULL,
+    sym_key_enc_by_owners_pub_keys TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_users (
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    -- never reused, refresh finds the messages of other processes by higher IDs
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    sender_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_id_timestamp ON messages (chat_id, timestamp);
+CREATE TABLE IF NOT EXISTS contacts (
+    owner_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    alias TEXT NOT NULL,
+    UNIQUE (owner_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+) WITHOUT ROWID;
+'''
+
+# versions start at random, so a recreated database does not repeat the versions of the old one
+_VERSION_SCHEMA = '''
+INSERT OR IGNORE INTO table_versions (name, version) VALUES ('{table}', abs(random() % 4294967296));
+CREATE TRIGGER IF NOT EXISTS {table}_insert_version AFTER INSERT ON {table} BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_update_version AFTER UPDATE ON {table} BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_delete_version AFTER DELETE ON {table} BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+END;
+'''
+
+
+def connect(db_path):
+    """
+    Open a connection to the database and create the tables when missing.
+    :param db_path: Path to the SQLite database file
+    :return: sqlite3.Connection in autocommit mode, transactions are started explicitly
+    """
+    connection = sqlite3.connect(db_path, timeout=_BUSY_TIMEOUT, isolation_level=None,
+                                 check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous={}'.format(SQLITE_SYNCHRONOUS))
+    connection.executescript(SCHEMA + ''.join(_VERSION_SCHEMA.format(table=db_type.table)
+                                              for db_type in DBType))
+    return connection
+
+
+def _select_range(connection, select, key_condition, sort_column, *, after, before, limit):  # pylint: disable=too-many-arguments
+    """
+    Return rows within the range of the sort column, ordered by it.
+    With a limit, the rows closest to before are returned when it is given, the ones
+    closest to after otherwise.
+    :param select: SELECT ... FROM ... part of the query
+    :param key_condition: Condition and its parameters, e.g. ('chat_id = ?', (1,))
+    """
+    condition, parameters = key_condition
+    conditions = [condition]
+    parameters = list(parameters)
+    if after is not None:
+        conditions.append('{} > ?'.format(sort_column))
+        parameters.append(after)
+    if before is not None:
+        conditions.append('{} < ?'.format(sort_column))
+        parameters.append(before)
+    query = '{} WHERE {} ORDER BY {} {}'.format(select, ' AND '.join(conditions), sort_column,
+                                               'DESC' if before is not None else 'ASC')
+    if limit is not None:
+        query += ' LIMIT ?'
+        parameters.append(limit)
+    rows = connection.execute(query, parameters).fetchall()
+    if before is not None:
+        rows.reverse()
+    return rows
+
+
+def _user(row):
+    return {'type': DBType.USERS.value, 'id': row[0], 'public_key': row[1]}
+
+
+def _chat(row):
+    return {'type': DBType.CHATS.value, 'id': row[0], 'users': serialization.loads(row[1]),
+            'sym_key_enc_by_owners_pub_keys': serialization.loads(row[2])}
+
+
+def _message(row):
+    return {'type': DBType.MESSAGES.value, 'chat_id': row[0], 'sender_id': row[1],
+            'timestamp': row[2], 'message': row[3]}
+
+
+def _contact(row):
+    return {'type': DBType.CONTACTS.value, 'owner_id': row[0], 'user_id': row[1],
+            'alias': row[2]}
+
+
+@time_coroutines(DB_CALL_DURATION)
+class SQLiteDB:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    """
+    Database class for handling the database queries, stored in SQLite.
+    """
+
+    def __init__(self, db_string, public_key_cache_size=PUBLIC_KEY_CACHE_SIZE, shared=False,
+                 threads=SQLITE_THREADS):
+        """
+        :param shared: Ignored, SQLite can always be shared by several processes
+        """
+        # pylint: disable=unused-argument
+        self.db_string = db_string
+        self.public_keys = LRUCache(public_key_cache_size)
+        self.users = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        self.chats = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        # all contacts of a user by the owner ID
+        self.contacts = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        self._executor = ThreadPoolExecutor(threads)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._message_listeners = []
+        # messages inserted by this process, not to be reported as remote by refresh
+        self._local_message_ids = set()
+        self._local_message_ids_lock = threading.Lock()
+        self._last_message_id = self._connection().execute(
+            'SELECT COALESCE(MAX(rowid), 0) FROM messages').fetchone()[0]
+        # changed by other processes too, refresh drops the cached contacts then
+        self._contacts_version = self._contacts_table_version(self._connection())
+        LOGGER.info('Using SQLite database located at %s', db_string)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = connect(self.db_string)
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    async def _read(self, func, *args):
+        """Run the function with a connection in the pool."""
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            self._executor, lambda: func(self._connection(), *args))
+
+    async def _write(self, func, *args):
+        """Run the function with a connection in the pool, in a write transaction."""
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            self._executor, self._in_transaction, func, args)
+
+    def _in_transaction(self, func, args):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(connection, *args)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    def add_message_listener(self, callback):
+        """
+        Call the callback with every message inserted by another process sharing the database.
+        :param callback: Callable taking the inserted message
+        """
+        self._message_listeners.append(callback)
+
+    async def refresh(self):
+        """
+        Report the messages inserted by other processes sharing the database and
+        drop the cached contacts when any of them changed the contacts.
+        """
+        contacts_version, rows = await self._read(
+            self._changes_after, self._last_message_id if self._message_listeners else None)
+        if contacts_version != self._contacts_version:
+            self._contacts_version = contacts_version
+            self.contacts.clear()
+        for row in rows:
+            self._last_message_id = row[0]
+            with self._local_message_ids_lock:
+                if row[0] in self._local_message_ids:
+                    self._local_message_ids.discard(row[0])
+                    continue
+            for callback in self._message_listeners:
+                callback(_message(row[1:]))
+
+    @staticmethod
+    def _contacts_table_version(connection):
+        return connection.execute('SELECT version FROM table_versions WHERE name = ?',
+                                  (DBType.CONTACTS.table,)).fetchone()[0]
+
+    @staticmethod
+    def _changes_after(connection, rowid):
+        """Return the version of the contacts and the messages after the rowid, if any."""
+        rows = []
+        if rowid is not None:
+            rows = connection.execute(
+                'SELECT rowid, chat_id, sender_id, timestamp, message FROM messages '
+                'WHERE rowid > ? ORDER BY rowid', (rowid,)).fetchall()
+        return SQLiteDB._contacts_table_version(connection), rows
+
+    def cache_stats(self):
+        """Return the statistics of the caches of the database."""
+        return {'users': self.users.stats(), 'chats': self.chats.stats(),
+                'contacts': self.contacts.stats(), 'public_keys': self.public_keys.stats()}
+
+    def file_size(self):
+        """Return the size of the database file and of its write-ahead log in bytes."""
+        return sum(os.path.getsize(path) for path in (self.db_string, self.db_string + '-wal')
+                   if os.path.exists(path))
+
+    def close(self):
+        """Wait for running queries and close the connections."""
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    async def data_version(self, *db_types):
+        """
+        Return a token which changes whenever any of the tables changes, e.g. to build ETags.
+        :param db_types: DBType of the tables
+        """
+        return await self._read(self._data_version, db_types)
+
+    @staticmethod
+    def _data_version(connection, db_types):
+        versions = dict(connection.execute('SELECT name, version FROM table_versions'))
+        return '-'.join(str(versions[db_type.table]) for db_type in db_types)
+
+    async def compact(self):
+        """
+        Fold the SQLite write-ahead log into the database file and truncate it.
+        :return: True if the database was compacted
+        """
+        busy, _, _ = await self._read(
+            lambda connection: connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone())
+        return not busy
+
+    async def enforce_retention(self, max_age=MESSAGE_RETENTION_AGE,
+                                max_count=MESSAGE_RETENTION_COUNT,
+                                batch_size=RETENTION_BATCH_SIZE):
+        """Remove the messages over the retention limits, see db.DB.enforce_retention."""
+        if not max_age and not max_count:
+            return 0
+        oldest_kept = time.time() - max_age if max_age else None
+        chat_ids = await self._read(
+            lambda connection: [row[0] for row in connection.execute(
+                'SELECT DISTINCT chat_id FROM messages')])
+        removed = 0
+        for chat_id in chat_ids:
+            while True:
+                batch = await self._write(self._remove_old_messages, chat_id, oldest_kept,
+                                          max_count, batch_size)
+                removed += batch
+                if batch < batch_size:
+                    break
+        return removed
+
+    @staticmethod
+    def _remove_old_messages(connection, chat_id, oldest_kept, max_count, batch_size):
+        expired = 0
+        if oldest_kept is not None:
+            expired = connection.execute(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM messages '
+                'WHERE chat_id = ? AND timestamp < ? LIMIT ?)',
+                (chat_id, oldest_kept, batch_size)).fetchone()[0]
+        count = connection.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ?',
+                                   (chat_id,)).fetchone()[0]
+        batch = _retention_batch(count, expired, max_count, batch_size)
+        if batch:
+            connection.execute(
+                'DELETE FROM messages WHERE rowid IN (SELECT rowid FROM messages '
+                'WHERE chat_id = ? ORDER BY timestamp LIMIT ?)', (chat_id, batch))
+        return batch
+
+    async def insert_user(self, user_id, public_key):
+        """
+        Insert a new user to database.
+        :param user_id: Users ID
+        :param public_key: Public key of user
+        """
+        await self._write(self._insert_user, user_id, public_key)
+        self.users.invalidate(user_id)
+        self.public_keys.invalidate(user_id)
+
+    @staticmethod
+    def _insert_user(connection, user_id, public_key):
+        if connection.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone():
+            raise DatabaseError(reason=
+                                'Can not insert user into the database. '
+                                'User with ID "{}" already exist.'.format(user_id))
+        if connection.execute('SELECT 1 FROM users WHERE public_key = ?',
+                              (public_key,)).fetchone():
+            raise DatabaseError(reason='Can not insert user into the database. '
+                                       'User with public key "{}" already exist.'
+                                .format(public_key))
+        connection.execute('INSERT INTO users (id, public_key) VALUES (?, ?)',
+                           (user_id, public_key))
+
+    @read_through('users')
+    async def select_user(self, user_id):
+        """
+        Return the user that was searched, cached by user ID.
+        :param user_id: Users ID
+        :return: user or None
+        """
+        return await self._read(self._select_user, user_id)
+
+    @staticmethod
+    def _select_user(connection, user_id):
+        row = connection.execute('SELECT id, public_key FROM users WHERE id = ?',
+                                 (user_id,)).fetchone()
+        return _user(row) if row else None
+
+    async def select_public_key(self, user_id):
+        """
+        Return the parsed public key of the user, cached by user ID.
+        :param user_id: Users ID
+        :return: rsa.PublicKey of the user
+        """
+        public_key = self.public_keys.get(user_id)
+        if public_key is None:
+            user = await self.select_user(user_id)
+            if not user:
+                raise DatabaseError(reason='User with ID {} not found in the database.'
+                                    .format(user_id))
+            public_key = rsa.PublicKey.load_pkcs1(user['public_key'])
+            self.public_keys.put(user_id, public_key)
+        return public_key
+
+    async def user_pubkey_exist(self, pubkey):
+        """Check if the given pubkey exist in the database.
+        :param pubkey: Public key of the user
+        :return: True if the public key is found in the database, false otherwise
+        """
+        return await self._read(
+            lambda connection: connection.execute('SELECT 1 FROM users WHERE public_key = ?',
+                                                  (pubkey,)).fetchone() is not None)
+
+    async def select_all_user_ids(self):
+        """
+        Get all user ids and return them.
+        :return: array: all user IDs stored in the database in
+        """
+        return await self._read(
+            lambda connection: [row[0] for row in connection.execute(
+                'SELECT id FROM users ORDER BY rowid')])
+
+    async def insert_chat(self, users, sym_key_enc_by_owners_pub_keys):
+        """
+        Inserts the new entry to the particular chat.
+        :param users: IDs of users in chat
+        :param sym_key_enc_by_owners_pub_keys: encrypted symmetric keys using public keys of user
+        :return: ID of the inserted chat
+        """
+        chat_id = await self._write(self._insert_chat, users, sym_key_enc_by_owners_pub_keys)
+        self.chats.invalidate(chat_id)
+        return chat_id
+
+    @staticmethod
+    def _insert_chat(connection, users, sym_key_enc_by_owners_pub_keys):
+        missing_users = {str(user_id) for user_id in users
+                         if not connection.execute('SELECT 1 FROM users WHERE id = ?',
+                                                   (user_id,)).fetchone()}
+        if missing_users:
+            raise DatabaseError(reason=
+                                'Can not insert chat into the database. '
+                                'User/users {} not found in the database.'
+                                .format(','.join(sorted(missing_users))))
+        # the unique column compares the text, keep its format independent of JSON_LIBRARY
+        members = json.dumps(_membership_key(users))
+        if connection.execute('SELECT 1 FROM chats WHERE members = ?', (members,)).fetchone():
+            raise DatabaseError(reason=
+                                'Can not insert chat into the database. '
+                                'Chat with users "{}" already exist.'
+                                .format(','.join(str(x) for x in users)))
+        if len(users) != len(sym_key_enc_by_owners_pub_keys):
+            raise DatabaseError(reason=
+                                'Can not insert chat into the database. '
+                                'Number of users should be the same as number of '
+                                'symmetric keys.')
+        chat_id = connection.execute(
+            'INSERT INTO chats (members, users, sym_key_enc_by_owners_pub_keys) '
+            'VALUES (?, ?, ?)',
+            (members, serialization.dumps(users),
+             serialization.dumps(sym_key_enc_by_owners_pub_keys))).lastrowid
+        connection.executemany('INSERT OR IGNORE INTO chat_users (user_id, chat_id) '
+                               'VALUES (?, ?)', [(user_id, chat_id) for user_id in users])
+        return chat_id
+
+    async def select_chat(self, chat_id):
+        """
+        Return the chat ID that was searched for.
+        :param chat_id: ID of chat
+        :return: Chat that was searched for user's id
+        """
+        chat = await self._select_chat(chat_id)
+        if not chat:
+            raise DatabaseError(reason='Chat with ID {} does not exist in the database.'
+                                .format(chat_id))
+        return chat
+
+    @read_through('chats')
+    async def _select_chat(self, chat_id):
+        row = await self._read(
+            lambda connection: connection.execute(
+                'SELECT id, users, sym_key_enc_by_owners_pub_keys FROM chats WHERE id = ?',
+                (chat_id,)).fetchone())
+        return _chat(row) if row else None
+
+    async def select_my_chats(self, my_id, after=None, before=None, limit=None):
+        """
+        Return the chats for the particular user, ordered by chat ID.
+        :param my_id: User ID
+        :param after: Return only chats with a higher ID
+        :param before: Return only chats with a lower ID
+        :param limit: Maximum number of chats, the closest to before if given, else to after
+        :return: Chats ID for the particular user
+        """
+        if not await self.select_user(my_id):
+            raise DatabaseError(reason='User with ID {} not found in the database.'
+                                .format(my_id))
+        return await self._read(self._select_my_chats, my_id, after, before, limit)
+
+    @staticmethod
+    def _select_my_chats(connection, my_id, after, before, limit):  # pylint: disable=too-many-arguments
+        return [_chat(row) for row in _select_range(
+            connection, 'SELECT chats.id, chats.users, chats.sym_key_enc_by_owners_pub_keys '
+            'FROM chat_users JOIN chats ON chats.id = chat_users.chat_id',
+            ('chat_users.user_id = ?', (my_id,)), 'chat_users.chat_id',
+            after=after, before=before, limit=limit)]
+
+    async def iter_my_chats(self, my_id, chunk_size=ITER_CHUNK_SIZE):
+        """
+        Return the chats of the user as an asynchronous iterator, ordered by chat ID.
+        Only chunk_size chats are held in memory at once.
+        :param my_id: User ID
+        :param chunk_size: Number of chats read at once
+        :return: Asynchronous iterator of chats
+        """
+        if not await self.select_user(my_id):
+            raise DatabaseError(reason='User with ID {} not found in the database.'
+                                .format(my_id))
+        return self._iter_chunks(
+            'SELECT chats.id, chats.users, chats.sym_key_enc_by_owners_pub_keys '
+            'FROM chat_users JOIN chats ON chats.id = chat_users.chat_id '
+            'WHERE chat_users.user_id = ? AND chat_users.chat_id > ? '
+            'ORDER BY chat_users.chat_id LIMIT ?', my_id, 0,
+            to_document=_chat, sort_field='id', chunk_size=chunk_size)
+
+    async def _iter_chunks(self, query, key, after,  # pylint: disable=too-many-arguments
+                           *, to_document, sort_field, chunk_size):
+        """
+        Yield the documents of the query, reading chunk_size of them at once.
+        The query takes the key, the exclusive lower bound of the sort field and the limit.
+        """
+        while True:
+            rows = await self._read(
+                lambda connection, after: connection.execute(
+                    query, (key, after, chunk_size)).fetchall(), after)
+            for row in rows:
+                yield to_document(row)
+            if len(rows) < chunk_size:
+                return
+            after = to_document(rows[-1])[sort_field]
+
+    async def get_last_chat(self):
+        """
+        Get the last ID of chat in the database.
+        :return: ID of the last inserted chat
+        """
+        return await self._read(
+            lambda connection: connection.execute(
+                'SELECT COALESCE(MAX(id), 0) FROM chats').fetchone()[0])
+
+    async def chat_id_exist(self, chat_id):
+        """
+        Check whether the chat exist.
+        :return: true if the chat exist, false otherwise
+        """
+        return await self._select_chat(chat_id) is not None
+
+    async def insert_message(self, chat_id, sender_id, message):
+        """
+        Insert a message into the chat.
+        :param chat_id: Chat of ID
+        :param sender_id: ID of user that sends message
+        :param message: Message content (encrypted)
+        :return: Timestamp of the message, unique and increasing within the chat
+        """
+        timestamps = await self.insert_messages([{'chat_id': chat_id,
+                                                  'sender_id': sender_id,
+                                                  'message': message}])
+        return timestamps[0]
+
+    async def insert_messages(self, messages):
+        """
+        Insert messages, possibly into several chats, in a single transaction.
+        Either all the messages are inserted or none of them.
+        :param messages: list of dicts with chat_id, sender_id and message
+        :return: Timestamps of the messages, unique and increasing within each chat
+        """
+        return await self._write(self._insert_messages, messages)
+
+    def _insert_messages(self, connection, messages):
+        # the clock is read in the transaction, so that timestamps follow the commit order
+        last_timestamps = {}
+        rows = []
+        for item in messages:
+            chat_id = item['chat_id']
+            sender_id = item['sender_id']
+            if not self._select_user(connection, sender_id):
+                raise DatabaseError(reason='User with ID {} not found in the database.'
+                                    .format(sender_id))
+            if not connection.execute('SELECT 1 FROM chats WHERE id = ?',
+                                      (chat_id,)).fetchone():
+                raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                    .format(chat_id))
+            if chat_id not in last_timestamps:
+                last_timestamps[chat_id] = connection.execute(
+                    'SELECT COALESCE(MAX(timestamp), 0) FROM messages WHERE chat_id = ?',
+                    (chat_id,)).fetchone()[0]
+            # timestamps serve as cursors, keep them strictly increasing within the chat
+            timestamp = max(time.time(), last_timestamps[chat_id] + _TIMESTAMP_STEP)
+            last_timestamps[chat_id] = timestamp
+            rows.append((chat_id, sender_id, timestamp, item['message']))
+        message_ids = [connection.execute('INSERT INTO messages (chat_id, sender_id, timestamp, '
+                                          'message) VALUES (?, ?, ?, ?)', row).lastrowid
+                       for row in rows]
+        if self._message_listeners:
+            with self._local_message_ids_lock:
+                self._local_message_ids.update(message_ids)
+        return [row[2] for row in rows]
+
+    async def select_my_messages(self, chat_id, after=None, before=None, limit=None):
+        """
+        Return messages of the chat ordered by their timestamps.
+        :param chat_id: ID of chat
+        :param after: Return only messages newer than this timestamp (cursor)
+        :param before: Return only messages older than this timestamp
+        :param limit: Maximum number of messages, the closest to before if given, else to after
+        :return: Returns json of all messages in chat
+        """
+        return await self._read(self._select_my_messages, chat_id, after, before, limit)
+
+    @staticmethod
+    def _select_my_messages(connection, chat_id, after, before, limit):  # pylint: disable=too-many-arguments
+        if not connection.execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone():
+            raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                .format(chat_id))
+        return [_message(row) for row in _select_range(
+            connection, 'SELECT chat_id, sender_id, timestamp, message FROM messages',
+            ('chat_id = ?', (chat_id,)), 'timestamp', after=after, before=before, limit=limit)]
+
+    async def iter_my_messages(self, chat_id, after=None, chunk_size=ITER_CHUNK_SIZE):
+        """
+        Return messages of the chat as an asynchronous iterator, ordered by their timestamps.
+        Only chunk_size messages are held in memory at once.
+        :param chat_id: ID of chat
+        :param after: Return only messages newer than this timestamp (cursor)
+        :param chunk_size: Number of messages read at once
+        :return: Asynchronous iterator of messages
+        """
+        if not await self.chat_id_exist(chat_id):
+            raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                .format(chat_id))
+        # timestamps are unique within the chat, so they serve as the position of the scan
+        return self._iter_chunks(
+            'SELECT chat_id, sender_id, timestamp, message FROM messages '
+            'WHERE chat_id = ? AND timestamp > ? ORDER BY timestamp LIMIT ?',
+            chat_id, float('-inf') if after is None else after,
+            to_document=_message, sort_field='timestamp', chunk_size=chunk_size)
+
+    async def has_new_messages(self, chat_id, after=None):
+        """
+        Check whether the chat has messages newer than the cursor.
+        :param chat_id: ID of chat
+        :param after: Timestamp of the last seen message (cursor)
+        :return: True if there are newer messages, False otherwise
+        """
+        if not await self.chat_id_exist(chat_id):
+            raise DatabaseError(reason='Chat with ID {} not found in the database.'
+                                .format(chat_id))
+        return await self._read(
+            lambda connection: connection.execute(
+                'SELECT 1 FROM messages WHERE chat_id = ? AND timestamp > ? LIMIT 1',
+                (chat_id, float('-inf') if after is None else after)).fetchone() is not None)
+
+    async def insert_contact(self, owner_id, user_id, encrypted_alias):
+        """
+        Inserts a contact into the database.
+        :param owner_id: ID of user
+        :param user_id: ID of contact.
+        :param encrypted_alias: Encrypted alias of contact
+        """
+        await self._write(self._insert_contact, owner_id, user_id, encrypted_alias)
+        self.contacts.invalidate(owner_id)
+
+    @staticmethod
+    def _insert_contact(connection, owner_id, user_id, encrypted_alias):
+        if connection.execute('SELECT 1 FROM contacts WHERE owner_id = ? AND user_id = ?',
+                              (owner_id, user_id)).fetchone():
+            raise DatabaseError(reason=
+                                'Can not insert contact into the database. User with ID '
+                                '{} already exist in the contacts for the user with ID {}.'
+                                .format(user_id, owner_id))
+        for contact_user_id in (owner_id, user_id):
+            if not SQLiteDB._select_user(connection, contact_user_id):
+                raise DatabaseError(reason=
+                                    'Can not insert contact into the database. User with ID '
+                                    '{} does not exist in the database.'
+                                    .format(contact_user_id))
+        connection.execute('INSERT INTO contacts (owner_id, user_id, alias) VALUES (?, ?, ?)',
+                           (owner_id, user_id, encrypted_alias))
+
+    async def select_my_contacts(self, owner_id, after=None, before=None, limit=None):
+        """
+        Return contacts of the user, ordered by the user ID of the contact.
+        :param owner_id: User ID which wants his contacts.
+        :param after: Return only contacts with a higher user ID
+        :param before: Return only contacts with a lower user ID
+        :param limit: Maximum number of contacts, the closest to before if given, else to after
+        :return: Returns user's contacts in json.
+        """
+        if not await self.select_user(owner_id):
+            raise DatabaseError(reason='User with ID {} does not exist in the database.'
+                                .format(owner_id))
+        if after is None and before is None and limit is None:
+            return list(await self._select_all_contacts(owner_id))
+        return await self._read(self._select_my_contacts, owner_id, after, before, limit)
+
+    @read_through('contacts')
+    async def _select_all_contacts(self, owner_id):
+        return await self._read(self._select_my_contacts, owner_id, None, None, None)
+
+    @staticmethod
+    def _select_my_contacts(connection, owner_id, after, before, limit):  # pylint: disable=too-many-arguments
+        return [_contact(row) for row in _select_range(
+            connection, 'SELECT owner_id, user_id, alias FROM contacts',
+            ('owner_id = ?', (owner_id,)), 'user_id', after=after, before=before, limit=limit)]
+
+    async def delete_my_contact(self, owner_id, user_id):
+        """Delete contact of the selected user."""
+        removed = await self._write(self._delete_my_contact, owner_id, user_id)
+        self.contacts.invalidate(owner_id)
+        return removed
+
+    @staticmethod
+    def _delete_my_contact(connection, owner_id, user_id):
+        removed = [row[0] for row in connection.execute(
+            'SELECT rowid FROM contacts WHERE owner_id = ? AND user_id = ?', (owner_id, user_id))]
+        connection.execute('DELETE FROM contacts WHERE owner_id = ? AND user_id = ?',
+                           (owner_id, user_id))
+        return removed
+
+    async def alter_my_contact(self, owner_id, user_id, new_alias):
+        """
+        Alters the contact for the specified user.
+        :param owner_id: User ID which has this contact
+        :param user_id: ID of user which is in contact
+        :param new_alias: New alias for user in contact
+        """
+        await self._write(
+            lambda connection: connection.execute(
+                'UPDATE contacts SET alias = ? WHERE owner_id = ? AND user_id = ?',
+                (new_alias, owner_id, user_id)))
+        self.contacts.invalidate(owner_id)
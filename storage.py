@@ -0,0 +1,823 @@
+"""
+Long-lived storage engine behind the database module.
+
+The database file is loaded into memory once, reads are served from memory and
+every change is appended to a write-ahead log stored next to the database file.
+The log is folded back into the database file by a compaction running in the
+background, which writes the file in a thread, once the log grows over the
+configured threshold, and by a checkpoint when the storage is closed.
+
+Appended records reach the disk in batches, see GroupCommit.
+"""
+
+import asyncio
+import bisect
+import fcntl
+import os
+from contextlib import contextmanager
+
+import serialization
+from logging_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+DEFAULT_TABLE = '_default'
+# table of the database file holding the state of the storage instead of documents
+STORAGE_TABLE = '_storage'
+DEFAULT_CHECKPOINT_THRESHOLD = int(os.getenv('STORAGE_CHECKPOINT_THRESHOLD', '1000'))
+DEFAULT_COMMIT_DELAY = float(os.getenv('STORAGE_COMMIT_DELAY', '0.002'))
+DEFAULT_COMMIT_BATCH = int(os.getenv('STORAGE_COMMIT_BATCH', '128'))
+
+
+class HashIndex:
+    """
+    Secondary index mapping a key computed from a document to the IDs of documents.
+
+    The key function returns the key of the document, or None when the document
+    should not be indexed. Multi-valued indexes expect an iterable of keys instead.
+    """
+
+    def __init__(self, key_func, multi=False):
+        self.key_func = key_func
+        self.multi = multi
+        self._entries = {}
+
+    def _keys(self, document):
+        if self.multi:
+            return set(self.key_func(document))
+        key = self.key_func(document)
+        return () if key is None else (key,)
+
+    def add(self, doc_id, document):
+        """Index the document."""
+        for key in self._keys(document):
+            self._entries.setdefault(key, {})[doc_id] = None
+
+    def discard(self, doc_id, document):
+        """Remove the document from the index."""
+        for key in self._keys(document):
+            doc_ids = self._entries.get(key)
+            if doc_ids is None:
+                continue
+            doc_ids.pop(doc_id, None)
+            if not doc_ids:
+                del self._entries[key]
+
+    def lookup(self, key):
+        """Return the IDs of documents indexed under the key, in insertion order."""
+        return list(self._entries.get(key, ()))
+
+    def keys(self):
+        """Return all indexed keys."""
+        return list(self._entries)
+
+    def count(self, key):
+        """Return the number of documents indexed under the key."""
+        return len(self._entries.get(key, ()))
+
+    def clear(self):
+        """Remove all documents from the index."""
+        self._entries = {}
+
+
+class OrderedIndex(HashIndex):
+    """
+    Secondary index keeping the documents of every key ordered by a sort key.
+
+    Documents are expected to arrive mostly in order, so adding one is an append
+    in the common case and range reads are binary searches.
+    """
+
+    def __init__(self, key_func, sort_key, multi=False):
+        super().__init__(key_func, multi)
+        self.sort_key = sort_key
+
+    def add(self, doc_id, document):
+        """Index the document."""
+        entry = (self.sort_key(document), doc_id)
+        for key in self._keys(document):
+            entries = self._entries.setdefault(key, [])
+            if not entries or entries[-1] < entry:
+                entries.append(entry)
+            else:
+                bisect.insort(entries, entry)
+
+    def discard(self, doc_id, document):
+        """Remove the document from the index."""
+        entry = (self.sort_key(document), doc_id)
+        for key in self._keys(document):
+            entries = self._entries.get(key)
+            if entries is None:
+                continue
+            position = bisect.bisect_left(entries, entry)
+            if position < len(entries) and entries[position] == entry:
+                del entries[position]
+            if not entries:
+                del self._entries[key]
+
+    def lookup(self, key):
+        """Return the IDs of documents indexed under the key, ordered by the sort key."""
+        return [doc_id for _, doc_id in self._entries.get(key, ())]
+
+    def range(self, key, after=None, before=None,  # pylint: disable=too-many-arguments
+              limit=None, from_end=False):
+        """
+        Return the IDs of documents indexed under the key with the sort key in the range.
+        :param key: Key to look up
+        :param after: Exclusive lower bound of the sort key, None for no bound
+        :param before: Exclusive upper bound of the sort key, None for no bound
+        :param limit: Maximum number of returned IDs
+        :param from_end: Keep the highest sort keys instead of the lowest ones within the limit
+        :return: IDs ordered by the sort key
+        """
+        entries = self._entries.get(key, ())
+        start = 0 if after is None else bisect.bisect_right(entries, (after, float('inf')))
+        stop = len(entries) if before is None else \
+            bisect.bisect_left(entries, (before, float('-inf')), start)
+        if limit is not None:
+            if from_end:
+                start = max(start, stop - limit)
+            else:
+                stop = min(stop, start + limit)
+        return [doc_id for _, doc_id in entries[start:stop]]
+
+    def last(self, key):
+        """Return the ID of the document with the highest sort key or None."""
+        entries = self._entries.get(key)
+        return entries[-1][1] if entries else None
+
+
+def _write_snapshot(path, tables, versions):
+    """
+    Write the tables into the file in the TinyDB layout and wait until it is on the disk.
+    :param versions: Number of changes so far and the versions of the tables
+    """
+    raw_tables = {table_name: {str(doc_id): document for doc_id, document in table.items()}
+                  for table_name, table in tables.items()}
+    change_count, table_versions = versions
+    raw_tables[STORAGE_TABLE] = {'1': {'changes': change_count, 'versions': table_versions}}
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(serialization.dumpb(raw_tables))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+
+def _temporary_file(path):
+    """
+    Create an empty file with a unique name next to the path, which replaces it later.
+    :return: Path of the created file, with the permissions of the replaced file, or
+             the default ones when it does not exist yet
+    """
+    while True:
+        tmp_path = '{}.{}.tmp'.format(path, os.urandom(4).hex())
+        try:
+            # unlike tempfile.mkstemp, the umask applies as to any other new file
+            descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        break
+    os.close(descriptor)
+    try:
+        os.chmod(tmp_path, os.stat(path).st_mode)
+    except FileNotFoundError:
+        pass
+    return tmp_path
+
+
+def _sync_directory(path):
+    """Wait until a rename to the path in its directory is on the disk."""
+    descriptor = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _remove_leftover(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class GroupCommit:  # pylint: disable=too-many-instance-attributes
+    """
+    Makes the records appended to the write-ahead log durable in batches.
+
+    Writers append records without waiting for the disk and then wait for the
+    commit. The log is fsynced once the first waiter waited for the commit delay
+    or once batch_size writers wait, and all waiters of the batch are woken by
+    the same fsync.
+    """
+
+    def __init__(self, fileno, delay, batch_size):
+        """
+        :param fileno: Callable returning the file descriptor of the current log
+        :param delay: Seconds the first writer of a batch waits for others to join
+        :param batch_size: Number of waiting writers flushing the batch immediately
+        """
+        self.delay = delay
+        self.batch_size = batch_size
+        self.batches = 0
+        self.committed = 0
+        self._fileno = fileno
+        # writes are counted, a waiter is done once an fsync started after its write ended
+        self._written = 0
+        self._synced = 0
+        self._waiters = []
+        self._timer = None
+        self._fsyncs = set()
+
+    def written(self):
+        """Register records appended to the log."""
+        self._written += 1
+
+    def synced(self):
+        """Register that everything written so far is durable, e.g. by a checkpoint."""
+        self._synced = self._written
+        self._wake(self._waiters)
+        self._waiters = []
+        self._cancel_timer()
+
+    async def wait(self):
+        """Wait until the records written so far are durable."""
+        if self._synced >= self._written:
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.append(future)
+        if len(self._waiters) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.delay, self._flush)
+        await future
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush(self):
+        self._cancel_timer()
+        waiters, self._waiters = self._waiters, []
+        if not waiters:
+            return
+        task = asyncio.ensure_future(self._fsync(waiters, self._written))
+        self._fsyncs.add(task)
+        task.add_done_callback(self._fsyncs.discard)
+
+    async def _fsync(self, waiters, position):
+        # the log may be replaced by a checkpoint meanwhile, keep the file open
+        descriptor = os.dup(self._fileno())
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, descriptor)
+        except OSError as error:
+            LOGGER.error('Can not write the write-ahead log to the disk: %s', error)
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        finally:
+            os.close(descriptor)
+        self._synced = max(self._synced, position)
+        self.batches += 1
+        self._wake(waiters)
+
+    def _wake(self, waiters):
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+        self.committed += len(waiters)
+
+    def stats(self):
+        """Return the number of fsynced batches and of writers woken by them."""
+        return {'batches': self.batches, 'committed': self.committed,
+                'waiting': len(self._waiters)}
+
+
+class Storage:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    """
+    In-memory document storage persisted through a write-ahead log.
+
+    The database file keeps the TinyDB layout, ``{table: {doc_id: document}}``,
+    so existing database files can be opened without any conversion. The versions
+    of the tables are kept in the additional ``_storage`` table.
+
+    A shared storage may be opened by several processes at once. Writers hold
+    an exclusive lock on the ``.lock`` file while appending to the log, and every
+    process applies the records appended by the others before it reads or
+    writes. A checkpoint replaces the log with a new file, which tells the other
+    processes to finish reading the old one and continue with the new one.
+    """
+
+    def __init__(self, path,  # pylint: disable=too-many-arguments
+                 checkpoint_threshold=DEFAULT_CHECKPOINT_THRESHOLD, shared=False,
+                 commit_delay=DEFAULT_COMMIT_DELAY, commit_batch=DEFAULT_COMMIT_BATCH):
+        self.path = path
+        self.wal_path = path + '.wal'
+        self.checkpoint_threshold = checkpoint_threshold
+        self.shared = shared
+        self._tables = {}
+        self._indexes = {}
+        self._last_ids = {}
+        # number of the last change of every table, stored in the database file,
+        # processes replaying the same log count the same numbers
+        self._versions = {}
+        self._change_count = 0
+        self._listeners = []
+        self._wal = None
+        self._wal_offset = 0
+        self._wal_records = 0
+        self._compacting = False
+        self._compactions = set()
+        self.group_commit = GroupCommit(self._wal_fileno, commit_delay, commit_batch)
+        self._lock_file = None
+        if shared:
+            self._lock_file = open(path + '.lock', 'a', encoding='utf8')  # pylint: disable=consider-using-with
+        self._lock_depth = 0
+        with self._locked(fcntl.LOCK_EX):
+            self._load()
+
+    def _wal_fileno(self):
+        return self._wal.fileno()
+
+    @contextmanager
+    def _locked(self, mode):
+        """Hold the inter-process lock of a shared storage, re-entrant within the process."""
+        if not self.shared:
+            yield
+            return
+        if not self._lock_depth:
+            fcntl.flock(self._lock_file, mode)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if not self._lock_depth:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        """Load the database file and replay the write-ahead log on top of it."""
+        self._load_snapshot()
+        self._wal = open(self.wal_path, 'a+b')  # pylint: disable=consider-using-with
+        self._read_wal()
+        wal_size = os.fstat(self._wal.fileno()).st_size
+        if wal_size > self._wal_offset:
+            # only the last record can be torn by a crash during append
+            LOGGER.warning('Dropping %d bytes of a damaged record at the end of %s.',
+                           wal_size - self._wal_offset, self.wal_path)
+            self._wal.truncate(self._wal_offset)
+
+    def _load_snapshot(self):
+        """Load the tables of the database file."""
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb') as db_file:
+                raw_tables = serialization.loads(db_file.read())
+            metadata = raw_tables.pop(STORAGE_TABLE, {}).get('1', {})
+            self._change_count = metadata.get('changes', 0)
+            self._versions = dict(metadata.get('versions', {}))
+            for table_name, documents in raw_tables.items():
+                table = self._table(table_name)
+                for doc_id, document in documents.items():
+                    table[int(doc_id)] = document
+                self._last_ids[table_name] = max(table, default=0)
+
+    def _read_wal(self, remote=False, known=None):
+        """
+        Apply the records appended to the write-ahead log since the last read.
+        :param known: Tables held before the snapshot was reloaded, see _apply
+        """
+        self._wal.seek(self._wal_offset)
+        for line in self._wal:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = serialization.loads(line)
+            except ValueError:
+                break
+            self._apply(record, remote, known)
+            self._wal_offset += len(line)
+            self._wal_records += 1
+
+    def _sync(self):
+        """Catch up with the records written by other processes, the lock must be held."""
+        if not self.shared:
+            return
+        if os.stat(self.wal_path).st_ino != os.fstat(self._wal.fileno()).st_ino:
+            # another process made a checkpoint, the old log is complete now
+            self._read_wal(remote=True)
+            self._wal.close()
+            known = self._reload_snapshot()
+            self._wal = open(self.wal_path, 'a+b')  # pylint: disable=consider-using-with
+            self._wal_offset = 0
+            self._wal_records = 0
+            # a compaction carries the records appended meanwhile over to the new log
+            self._read_wal(remote=True, known=known)
+        self._read_wal(remote=True)
+
+    def _reload_snapshot(self):
+        """
+        Replace the in-memory tables by the database file checkpointed by another process.
+        More checkpoints may have happened since the last sync, so the records of the
+        logs in between are only found in the database file. The listeners are called
+        only for the records replayed from the log afterwards, a document of the file
+        may have been removed by a record carried over to the new log.
+        :return: Tables held before the reload
+        """
+        previous_tables = self._tables
+        previous_indexes = self._indexes
+        self._tables = {}
+        self._indexes = {}
+        self._last_ids = {}
+        self._load_snapshot()
+        for table_name, indexes in previous_indexes.items():
+            table = self._table(table_name)
+            self._indexes[table_name] = indexes
+            for index in indexes.values():
+                index.clear()
+                for doc_id, document in table.items():
+                    index.add(doc_id, document)
+        return previous_tables
+
+    def refresh(self):
+        """Apply the changes written by other processes sharing the storage."""
+        if not self.shared or self._lock_depth:
+            return
+        if os.stat(self.wal_path).st_ino == os.fstat(self._wal.fileno()).st_ino and \
+                os.fstat(self._wal.fileno()).st_size == self._wal_offset:
+            return
+        with self._locked(fcntl.LOCK_SH):
+            self._sync()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group reads and writes that must not interleave with writes of other processes.
+        Without sharing, changes are atomic anyway as the storage is not accessed
+        from other threads.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            if self._lock_depth <= 1:
+                self._sync()
+            yield
+
+    def add_listener(self, callback):
+        """
+        Call the callback for every applied change.
+        :param callback: Callable taking the table name, the changed (or removed) document,
+                         a flag telling whether the change came from another process
+                         and a flag telling whether the document was removed
+        """
+        self._listeners.append(callback)
+
+    def _table(self, table_name):
+        table = self._tables.get(table_name)
+        if table is None:
+            table = self._tables[table_name] = {}
+            self._indexes[table_name] = {}
+            self._last_ids[table_name] = 0
+        return table
+
+    def _apply(self, record, remote=False, known=None):
+        """
+        Apply a single write-ahead log record to the in-memory tables.
+        :param known: Tables held before the snapshot was reloaded, the listeners are not
+                      called for inserts of documents which were in them already
+        """
+        table_name = record['table']
+        table = self._table(table_name)
+        indexes = self._indexes[table_name].values()
+        doc_id = record['id']
+        operation = record['op']
+        if operation not in ('insert', 'update', 'remove'):
+            raise ValueError('Unknown write-ahead log operation "{}".'.format(operation))
+
+        old_document = table.get(doc_id)
+        if old_document is not None:
+            for index in indexes:
+                index.discard(doc_id, old_document)
+        if operation == 'insert':
+            table[doc_id] = record['doc']
+            self._last_ids[table_name] = max(self._last_ids[table_name], doc_id)
+        elif operation == 'update' and old_document is not None:
+            table[doc_id] = dict(old_document, **record['doc'])
+        else:
+            table.pop(doc_id, None)
+        if doc_id in table:
+            for index in indexes:
+                index.add(doc_id, table[doc_id])
+
+        self._touch(table_name)
+        if operation == 'insert' and known is not None and doc_id in known.get(table_name, ()):
+            return
+        changed_document = table.get(doc_id, old_document)
+        if changed_document is not None:
+            removed = doc_id not in table
+            for callback in self._listeners:
+                callback(table_name, changed_document, remote, removed)
+
+    def _touch(self, table_name):
+        self._change_count += 1
+        self._versions[table_name] = self._change_count
+
+    def version(self, table_name):
+        """
+        Return a token which changes whenever the table changes, e.g. to build ETags.
+        Processes sharing the storage return the same tokens for the same data.
+        """
+        self.refresh()
+        return str(self._versions.get(table_name, 0))
+
+    def _log(self, *records):
+        """Apply the records and append them to the write-ahead log in a single write."""
+        if not records:
+            return
+        with self.transaction():
+            for record in records:
+                self._apply(record)
+            data = b''.join(serialization.dumpb(record) + b'\n' for record in records)
+            self._wal.write(data)
+            self._wal.flush()
+            self.group_commit.written()
+            self._wal_offset += len(data)
+            self._wal_records += len(records)
+            if self._wal_records >= self.checkpoint_threshold:
+                self._schedule_compaction()
+
+    def _schedule_compaction(self):
+        """Compact in the background, or checkpoint at once when no event loop is running."""
+        if self._compacting or self._compactions:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.checkpoint()
+            return
+        task = loop.create_task(self._compact_in_background())
+        self._compactions.add(task)
+        task.add_done_callback(self._compactions.discard)
+
+    async def _compact_in_background(self):
+        try:
+            await self.compact()
+        except OSError as error:
+            LOGGER.error('Can not compact the database %s: %s', self.path, error)
+
+    def insert(self, table_name, document):
+        """
+        Insert a document into the table.
+        :param table_name: Name of the table
+        :param document: Document to insert
+        :return: ID of the inserted document
+        """
+        return self.insert_many(table_name, [document])[0]
+
+    def insert_many(self, table_name, documents):
+        """
+        Insert documents into the table in a single write-ahead log write.
+        :param table_name: Name of the table
+        :param documents: Documents to insert
+        :return: IDs of the inserted documents
+        """
+        with self.transaction():
+            first_id = self._last_ids.get(table_name, 0) + 1
+            doc_ids = list(range(first_id, first_id + len(documents)))
+            self._log(*({'op': 'insert', 'table': table_name, 'id': doc_id, 'doc': dict(document)}
+                        for doc_id, document in zip(doc_ids, documents)))
+        return doc_ids
+
+    def update(self, table_name, doc_id, fields):
+        """
+        Update fields of the stored document.
+        :param table_name: Name of the table
+        :param doc_id: ID of the document
+        :param fields: Fields to be changed
+        """
+        self._log({'op': 'update', 'table': table_name, 'id': doc_id, 'doc': dict(fields)})
+
+    def remove(self, table_name, doc_id):
+        """
+        Remove the document from the table.
+        :param table_name: Name of the table
+        :param doc_id: ID of the document
+        """
+        self._log({'op': 'remove', 'table': table_name, 'id': doc_id})
+
+    def remove_many(self, table_name, doc_ids):
+        """
+        Remove documents from the table in a single write-ahead log write.
+        :param table_name: Name of the table
+        :param doc_ids: IDs of the documents
+        """
+        self._log(*({'op': 'remove', 'table': table_name, 'id': doc_id} for doc_id in doc_ids))
+
+    def get(self, table_name, doc_id):
+        """
+        Return a copy of the document or None if it does not exist.
+        :param table_name: Name of the table
+        :param doc_id: ID of the document
+        """
+        self.refresh()
+        document = self._tables.get(table_name, {}).get(doc_id)
+        return dict(document) if document is not None else None
+
+    def count(self, table_name):
+        """
+        Return the number of documents in the table.
+        :param table_name: Name of the table
+        """
+        self.refresh()
+        return len(self._tables.get(table_name, ()))
+
+    def search(self, table_name, predicate):
+        """
+        Return copies of all documents of the table matching the predicate.
+        :param table_name: Name of the table
+        :param predicate: Callable taking a document and returning bool
+        :return: list of (doc_id, document) tuples
+        """
+        self.refresh()
+        return [(doc_id, dict(document))
+                for doc_id, document in self._tables.get(table_name, {}).items()
+                if predicate(document)]
+
+    def create_index(self, table_name, index_name, key_func,  # pylint: disable=too-many-arguments
+                     multi=False, sort_key=None):
+        """
+        Create a secondary index over the table, kept up to date on every change.
+        :param table_name: Name of the table
+        :param index_name: Name of the index
+        :param key_func: Callable returning the key of a document (see HashIndex)
+        :param multi: True if the key function returns multiple keys
+        :param sort_key: Callable returning the sort key of a document, creates an OrderedIndex
+        """
+        if sort_key is None:
+            index = HashIndex(key_func, multi)
+        else:
+            index = OrderedIndex(key_func, sort_key, multi)
+        for doc_id, document in self._table(table_name).items():
+            index.add(doc_id, document)
+        self._indexes[table_name][index_name] = index
+
+    def lookup(self, table_name, index_name, key):
+        """
+        Return copies of the documents indexed under the key.
+        :param table_name: Name of the table
+        :param index_name: Name of the index
+        :param key: Key to look up
+        :return: list of (doc_id, document) tuples
+        """
+        self.refresh()
+        table = self._tables[table_name]
+        return [(doc_id, dict(table[doc_id]))
+                for doc_id in self._indexes[table_name][index_name].lookup(key)]
+
+    def lookup_range(self, table_name, index_name, key,  # pylint: disable=too-many-arguments
+                     *, after=None, before=None, limit=None, from_end=False):
+        """
+        Return copies of the documents indexed under the key within the sort key range.
+        :param table_name: Name of the table
+        :param index_name: Name of an ordered index
+        :param key: Key to look up
+        :param after: Exclusive lower bound of the sort key, None for no bound
+        :param before: Exclusive upper bound of the sort key, None for no bound
+        :param limit: Maximum number of returned documents
+        :param from_end: Keep the highest sort keys instead of the lowest ones within the limit
+        :return: list of (doc_id, document) tuples ordered by the sort key
+        """
+        self.refresh()
+        table = self._tables[table_name]
+        return [(doc_id, dict(table[doc_id]))
+                for doc_id in self._indexes[table_name][index_name].range(
+                    key, after, before, limit, from_end)]
+
+    def lookup_last(self, table_name, index_name, key):
+        """
+        Return a copy of the document with the highest sort key under the key or None.
+        :param table_name: Name of the table
+        :param index_name: Name of an ordered index
+        :param key: Key to look up
+        """
+        self.refresh()
+        doc_id = self._indexes[table_name][index_name].last(key)
+        return None if doc_id is None else dict(self._tables[table_name][doc_id])
+
+    def index_count(self, table_name, index_name, key):
+        """
+        Return the number of documents indexed under the key.
+        :param table_name: Name of the table
+        :param index_name: Name of the index
+        :param key: Key to look up
+        """
+        self.refresh()
+        return self._indexes[table_name][index_name].count(key)
+
+    def index_keys(self, table_name, index_name):
+        """
+        Return all keys of the index.
+        :param table_name: Name of the table
+        :param index_name: Name of the index
+        """
+        self.refresh()
+        return self._indexes[table_name][index_name].keys()
+
+    def checkpoint(self):
+        """Write the in-memory tables to the database file and start a new write-ahead log."""
+        with self.transaction():
+            snapshot_path = tmp_path = None
+            try:
+                snapshot_path = _temporary_file(self.path)
+                _write_snapshot(snapshot_path, self._tables, (self._change_count, self._versions))
+                # created empty, becomes the new log
+                tmp_path = _temporary_file(self.wal_path)
+                os.replace(snapshot_path, self.path)
+                _sync_directory(self.path)
+                # replaying the old log over the new file is idempotent, a crash here loses nothing
+                os.replace(tmp_path, self.wal_path)
+                _sync_directory(self.wal_path)
+            finally:
+                for path in (snapshot_path, tmp_path):
+                    if path is not None:
+                        _remove_leftover(path)
+            self._wal.close()
+            self._wal = open(self.wal_path, 'a+b')  # pylint: disable=consider-using-with
+            self._wal_offset = 0
+            self._wal_records = 0
+            self.group_commit.synced()
+
+    @property
+    def wal_records(self):
+        """Number of records in the write-ahead log, folded into the file by a checkpoint."""
+        return self._wal_records
+
+    async def compact(self):
+        """
+        Checkpoint the storage without blocking the IOLoop while the file is written.
+
+        The tables are copied and written to the database file in a thread. The
+        records appended meanwhile, by this or other processes, are carried over
+        to the new write-ahead log.
+        :return: False if the compaction was skipped because of another checkpoint
+        """
+        if self._compacting or self._wal is None:
+            return False
+        self._compacting = True
+        snapshot_path = tmp_path = None
+        try:
+            # other processes may compact at the same time, each one writes its own files
+            snapshot_path = _temporary_file(self.path)
+            with self.transaction():
+                # documents are never changed in place, copies of the tables are enough
+                tables = {table_name: dict(table) for table_name, table in self._tables.items()}
+                versions = self._change_count, dict(self._versions)
+                wal_file = self._wal
+                offset = self._wal_offset
+            await asyncio.get_running_loop().run_in_executor(
+                None, _write_snapshot, snapshot_path, tables, versions)
+            if self._wal is None:
+                # closed meanwhile
+                return False
+            with self.transaction():
+                if self._wal is not wal_file:
+                    # another process made a checkpoint meanwhile and the log was
+                    # reopened, its inode number may have been reused
+                    return False
+                self._wal.seek(offset)
+                tail = self._wal.read(self._wal_offset - offset)
+                tmp_path = _temporary_file(self.wal_path)
+                with open(tmp_path, 'wb') as tmp_file:
+                    tmp_file.write(tail)
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+                os.replace(snapshot_path, self.path)
+                _sync_directory(self.path)
+                # replaying the old log over the new file is idempotent, a crash here loses nothing
+                os.replace(tmp_path, self.wal_path)
+                _sync_directory(self.wal_path)
+                self._wal.close()
+                self._wal = open(self.wal_path, 'a+b')  # pylint: disable=consider-using-with
+                self._wal_offset = len(tail)
+                self._wal_records = tail.count(b'\n')
+                self.group_commit.synced()
+        finally:
+            self._compacting = False
+            # left behind when the compaction was skipped or failed
+            for path in (snapshot_path, tmp_path):
+                if path is not None:
+                    _remove_leftover(path)
+        return True
+
+    async def wait_durable(self):
+        """Wait until all changes made so far are safely stored on the disk."""
+        await self.group_commit.wait()
+
+    def close(self):
+        """Checkpoint the data and close the write-ahead log."""
+        if self._wal is None:
+            return
+        self.checkpoint()
+        self._wal.close()
+        self._wal = None
+        if self._lock_file is not None:
+            self._lock_file.close()
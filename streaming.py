@@ -0,0 +1,65 @@
+"""
+Module to encode large JSON responses piece by piece.
+
+An API may return a response dict with JSONArrayStream values instead of lists.
+The arrays are then encoded item by item while their items are read from the
+database, and the response is sent to the client in chunks.
+"""
+
+import os
+
+import serialization
+
+STREAM_CHUNK_BYTES = int(os.getenv('STREAM_CHUNK_BYTES', str(64 * 1024)))
+
+
+class JSONArrayStream:
+    """
+    JSON array of a response, produced by an asynchronous iterator of its items.
+    """
+
+    def __init__(self, items):
+        """
+        :param items: Asynchronous iterator of JSON serializable items
+        """
+        self.items = items
+
+
+def is_streamed(response):
+    """Check whether the response holds any JSONArrayStream."""
+    return isinstance(response, dict) and \
+        any(isinstance(value, JSONArrayStream) for value in response.values())
+
+
+def _encode(value):
+    return serialization.dumps(value, html_safe=True)
+
+
+async def iter_json_chunks(response, chunk_bytes=STREAM_CHUNK_BYTES):
+    """
+    Encode the response dict into JSON, yielding it in pieces of about chunk_bytes.
+    :param response: dict with JSON serializable or JSONArrayStream values
+    :param chunk_bytes: Size of the yielded pieces (the last one may be shorter)
+    :return: Asynchronous iterator of str
+    """
+    parts = ['{']
+    size = 1
+    for number, (key, value) in enumerate(response.items()):
+        parts.append('{}{}: '.format(', ' if number else '', _encode(key)))
+        if not isinstance(value, JSONArrayStream):
+            parts.append(_encode(value))
+            continue
+        parts.append('[')
+        first = True
+        async for item in value.items:
+            encoded = _encode(item)
+            parts.append(encoded if first else ', ' + encoded)
+            first = False
+            size += len(encoded) + 2
+            if size >= chunk_bytes:
+                yield ''.join(parts)
+                parts = []
+                size = 0
+        parts.append(']')
+    parts.append('}')
+    yield ''.join(parts)
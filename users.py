@@ -2,7 +2,7 @@
 Module to handle /users API calls.
 """
 
-from jsonschema import validate
+from schemas import validate
 
 
 class UsersAPI:
@@ -17,16 +17,7 @@ class UsersAPI:
         :param data: json request parsed into data structure
         :returns: json response with inserted user
         """
-        json_schema = {
-            'type': 'object',
-            'properties': {
-                'user_id': {'type': 'integer'},
-                'public_key': {'type': 'string'},
-            },
-            'required': ['user_id', 'public_key']
-        }
-
-        validate(data, json_schema)
+        validate(data, 'users_post')
 
         public_key = data.get('public_key')
         user_id = data.get('user_id')
@@ -46,15 +37,7 @@ class UsersAPI:
         :param data: json request parsed into data structure
         :returns: json response with user info
         """
-        json_schema = {
-            'type': 'object',
-            'properties': {
-                'user_id': {'type': 'integer'},
-            },
-            'required': ['user_id']
-        }
-
-        validate(data, json_schema)
+        validate(data, 'users_get')
 
         user_id = data.get('user_id')
 
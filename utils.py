@@ -1,9 +1,91 @@
+"""
+Cryptographic helpers.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import rsa
+import tornado.ioloop
+from tornado.web import HTTPError
+
+from logging_utils import get_logger
+
+LOGGER = get_logger(__name__)
+
+CRYPTO_POOL = os.getenv('CRYPTO_POOL', 'process')
+CRYPTO_WORKERS = int(os.getenv('CRYPTO_WORKERS', str(os.cpu_count() or 1)))
+CRYPTO_MAX_QUEUE = int(os.getenv('CRYPTO_MAX_QUEUE', '1000'))
 
 
 def rsa_verification(public_key_of_receiver, signature, block_bits):
-    boolean_value = rsa.verify(block_bits, signature, public_key_of_receiver)
-    if boolean_value:
-        return True
-    else:
+    """
+    Verify the signature of the data.
+    :param public_key_of_receiver: rsa.PublicKey of the signer
+    :param signature: Signature bytes
+    :param block_bits: Signed data
+    :return: True if the signature matches, False otherwise
+    """
+    try:
+        rsa.verify(block_bits, signature, public_key_of_receiver)
+    except rsa.VerificationError:
         return False
+    return True
+
+
+class CryptoExecutor:
+    """
+    Worker pool running CPU-bound cryptographic operations outside of the IOLoop.
+
+    At most max_queue operations may be submitted at once, further ones are
+    rejected with HTTP 503 instead of piling up behind the busy workers.
+    """
+
+    def __init__(self, pool=CRYPTO_POOL, max_workers=CRYPTO_WORKERS,
+                 max_queue=CRYPTO_MAX_QUEUE):
+        if pool == 'process':
+            self._executor = ProcessPoolExecutor(max_workers)
+        elif pool == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers)
+        else:
+            raise ValueError('Unknown crypto pool "{}", use "process" or "thread".'
+                             .format(pool))
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.rejected = 0
+        self.completed = 0
+        LOGGER.info('Running cryptographic operations in a %s pool of %d workers.',
+                    pool, max_workers)
+
+    async def run(self, func, *args):
+        """
+        Run the function in the pool and return its result.
+        :param func: Picklable function to run
+        :param args: Picklable arguments of the function
+        """
+        if self.pending >= self.max_queue:
+            self.rejected += 1
+            raise HTTPError(status_code=503,
+                            reason='Server is too busy to verify the message, try again later.')
+        self.pending += 1
+        try:
+            return await tornado.ioloop.IOLoop.current().run_in_executor(
+                self._executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def rsa_verification(self, public_key_of_receiver, signature, block_bits):
+        """Run rsa_verification in the pool."""
+        return await self.run(rsa_verification, public_key_of_receiver, signature, block_bits)
+
+    def stats(self):
+        """Return queue depth and counters of the pool."""
+        return {'pending': self.pending, 'max_queue': self.max_queue,
+                'workers': self.max_workers, 'completed': self.completed,
+                'rejected': self.rejected}
+
+    def shutdown(self):
+        """Stop the workers."""
+        self._executor.shutdown(wait=False)